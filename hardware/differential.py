@@ -1,15 +1,21 @@
 from math import asin
 import functools
-from copy import copy, deepcopy
+from copy import copy
 
 from solid import *
 from solid.utils import * 
 
-from gear import Gear
+from gear import Gear, module_definitions
 
 
 GEAR_MODULE = 2.5
 PRESSURE_ANGLE = 25
+HELIX_ANGLE = 25
+
+OUT_GEAR_TEETH = 30
+OUT_GEAR_WIDTH = 30
+PLANET_TEETH = 10
+BORE = 8
 
 OUT_GEARS_DISTANCE = 22
 PLANET_GEARS_MESH_HEIGHT = 20
@@ -32,28 +38,37 @@ def Slot(root: Optional[OpenSCADObject] = None) -> OpenSCADObject:
             return get_root_child(el.children[path[0]], path[1:])
         else:
             return el
+    def copy_path(root):
+        # only the transforms down to the slot are copied, the rest of the tree is shared
+        new = copy(root)
+        new.children = list(root.children)
+        new._child_path = list(root._child_path)
+        el = new
+        for i in new._child_path:
+            child = copy(el.children[i])
+            child.children = list(child.children)
+            child.set_parent(el)
+            el.children[i] = child
+            el = child
+        return new, el
     root = root or union()
-    orig_add = root.add.__func__
     root._child_path = find_root_child(root)
 
     @functools.wraps(root.add)
     def add(self, o: OpenSCADObjectPlus) -> OpenSCADObject:
-        new = deepcopy(self)
-        if isinstance(o, Sequence):
-            for obj in o:
-                new.add(obj)
-        elif isinstance(o, OpenSCADObject):
-            if len(new._child_path) > 0:
-                get_root_child(new, new._child_path).add(o)
-            else:
-                orig_add(new, o)
-        else:
-            raise TypeError
+        new, slot = copy_path(self)
+        objs = o if isinstance(o, Sequence) else [o]
+        for obj in objs:
+            if not isinstance(obj, OpenSCADObject):
+                raise TypeError
+            # not slot.add, the slot can be a Slot itself
+            OpenSCADObject.add(slot, obj)
         return new
 
     def stack(self, slot):
-        self.add(slot)
-        self._child_path += [len(get_root_child(self, self._child_path).children)-1]
+        el = get_root_child(self, self._child_path)
+        OpenSCADObject.add(el, slot)
+        self._child_path = self._child_path + [len(el.children)-1]
         return self
 
     name = f"{type(root).__name__}_Slot"
@@ -62,37 +77,42 @@ def Slot(root: Optional[OpenSCADObject] = None) -> OpenSCADObject:
     return root
 
 
-def out_gear(mock: bool):
-    return Gear(modul=GEAR_MODULE, tooth_number=30,
-                width=30, bore=8,
+def out_gear(mock: bool, modul: float = GEAR_MODULE,
+             tooth_number: int = OUT_GEAR_TEETH, helix_angle: float = HELIX_ANGLE):
+    return Gear(modul=modul, tooth_number=tooth_number,
+                width=OUT_GEAR_WIDTH, bore=BORE,
                 pressure_angle=PRESSURE_ANGLE,
-                helix_angle=25,
+                helix_angle=helix_angle,
                 optimized=False,
                 mock=mock)
 
-def planet_gear(mock: bool):
-    return Gear(modul=GEAR_MODULE, tooth_number=10,
-                width=30 + PLANET_GEARS_MESH_HEIGHT, bore=8,
+def planet_gear(mock: bool, modul: float = GEAR_MODULE,
+                tooth_number: int = PLANET_TEETH, helix_angle: float = HELIX_ANGLE):
+    return Gear(modul=modul, tooth_number=tooth_number,
+                width=OUT_GEAR_WIDTH + PLANET_GEARS_MESH_HEIGHT, bore=BORE,
                 pressure_angle=PRESSURE_ANGLE,
-                helix_angle=25,
+                helix_angle=helix_angle,
                 optimized=False,
                 mock=mock)
 
 
-def assembly(mock: bool = False):
-    lower_sun = out_gear(mock)
-    upper_sun = out_gear(mock)
+def assembly(mock: bool = False, modul: float = GEAR_MODULE,
+             out_gear_teeth: int = OUT_GEAR_TEETH, planet_teeth: int = PLANET_TEETH,
+             num_planets: int = NUM_PLANETS, helix_angle: float = HELIX_ANGLE,
+             out_gears_distance: float = OUT_GEARS_DISTANCE):
+    lower_sun = out_gear(mock, modul, out_gear_teeth, helix_angle)
+    upper_sun = out_gear(mock, modul, out_gear_teeth, helix_angle)
     upper_sun.helix_angle *= -1
 
-    upper_r = Slot(up(upper_sun.width + OUT_GEARS_DISTANCE))
+    upper_r = Slot(up(upper_sun.width + out_gears_distance))
     suns_mesh_r = Slot(rotate((0, 0, lower_sun.mesh_rotation)))
 
     planets = union()
 
-    for i in range(NUM_PLANETS):
-        lower_planet = planet_gear(mock)
+    for i in range(num_planets):
+        lower_planet = planet_gear(mock, modul, planet_teeth, helix_angle)
         lower_planet.helix_angle *= -1
-        upper_planet = planet_gear(mock)
+        upper_planet = planet_gear(mock, modul, planet_teeth, helix_angle)
 
         planets_r = Slot(forward(lower_sun.pitch_radius + lower_planet.pitch_radius))
         planets_distance = upper_sun.pitch_radius + lower_planet.pitch_radius 
@@ -107,11 +127,11 @@ def assembly(mock: bool = False):
                               )
                               )
         
-        distance_from_bot = OUT_GEARS_DISTANCE - PLANET_GEARS_MESH_HEIGHT
+        distance_from_bot = out_gears_distance - PLANET_GEARS_MESH_HEIGHT
         torsion_compensation = upper_planet.torsion_angle * (distance_from_bot / upper_planet.width)
         upper_mesh_rotation = upper_planet.mesh_rotation + torsion_compensation
 
-        planets += rotate(360 / NUM_PLANETS * i)(
+        planets += rotate(360 / num_planets * i)(
                           planets_r(lower_planet()),
                           upper_planet_r(
                                          rotate((0, 0, upper_mesh_rotation))(
@@ -126,11 +146,16 @@ def assembly(mock: bool = False):
                    planets)
 
 
+def render(root: OpenSCADObject, filepath: Optional[str] = None,
+           out_dir: Optional[str] = None) -> str:
+    return scad_render_to_file(root, filepath=filepath, out_dir=out_dir,
+                               include_orig_code=False,
+                               file_header="$fn=100;\n" + module_definitions(root))
+
+
 def main():
     return assembly(mock=False)
 
 
 if __name__ == "__main__":
-    scad_render_to_file(main(), out_dir="export",
-                        include_orig_code=False,
-                        file_header="$fn=100;")
+    render(main(), out_dir="export")
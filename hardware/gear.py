@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import astuple, dataclass
+import functools
 from math import atan, tan, cos, acos, radians
 
 from solid import *
@@ -7,6 +8,39 @@ from solid.utils import *
 gears = import_scad("./third-party/gears/gears.scad")
 
 
+class ModuleCall(OpenSCADObject):
+    """
+    Call of a SCAD module without arguments, defined by module_definitions,
+    so that identical geometry is rendered once however often it is placed
+    """
+
+    def __init__(self, name: str, definition: OpenSCADObject):
+        super().__init__(name, {})
+        self.definition = definition
+
+
+def module_definitions(root: OpenSCADObject) -> str:
+    """Definitions of the modules called in the tree and the files they use, for the file header"""
+    definitions = {}
+    includes = set()
+
+    def find(el):
+        if isinstance(el, IncludedOpenSCADObject):
+            includes.add(el.include_string)
+        if isinstance(el, ModuleCall) and el.name not in definitions:
+            definitions[el.name] = el.definition
+            find(el.definition)
+        for child in el.children:
+            find(child)
+
+    find(root)
+    modules = []
+    for name, definition in definitions.items():
+        body = definition._render().replace("\n", "\n\t")
+        modules.append(f"module {name}() {{{body}\n}}\n")
+    return "".join(sorted(includes)) + "\n" + "\n".join(modules)
+
+
 @dataclass
 class Gear:
     CLEARANCE = 0.05
@@ -22,6 +56,10 @@ class Gear:
     mock: bool = False
 
     def __call__(self) -> Any:
+        name, definition = _gear_module(*astuple(self))
+        return ModuleCall(name, definition)
+
+    def geometry(self) -> Any:
         if self.mock:
             return cylinder(h=self.width, d=self.tip_diam)
         else:
@@ -106,3 +144,13 @@ class Gear:
     @property
     def mesh_rotation(self) -> float:
         return 180 / self.tooth_number * (1 if self.tooth_number % 2 == 0 else 2)
+
+
+@functools.lru_cache(maxsize=None)
+def _gear_module(*params) -> Tuple[str, OpenSCADObject]:
+    gear = Gear(*params)
+    name = (f"{'mock_gear' if gear.mock else 'spur_gear'}_m{gear.modul}_z{gear.tooth_number}"
+            f"_w{gear.width}_b{gear.bore}_a{gear.pressure_angle}_h{gear.helix_angle}"
+            f"{'_optimized' if gear.optimized else ''}")
+    # an identifier, 2.5 -> 2p5 and -25 -> n25
+    return name.replace(".", "p").replace("-", "n"), gear.geometry()
@@ -0,0 +1,161 @@
+"""
+Design-space sweep of the planetary differential.
+
+Every combination of the parameters of differential.assembly is checked at
+once with NumPy, with the formulas of gear.Gear, and only the best feasible
+ones are rendered, in parallel. Run from this directory, like differential.py:
+
+    python sweep.py --top 5 --max-diameter 120
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import radians
+
+import numpy as np
+
+from differential import (BORE, OUT_GEAR_WIDTH, PLANET_GEARS_MESH_HEIGHT, PRESSURE_ANGLE,
+                          assembly, render)
+
+MODULES = (1.5, 2, 2.5, 3)
+OUT_GEAR_TEETH = range(12, 49)
+PLANET_TEETH = range(6, 25)
+NUM_PLANETS = range(2, 9)
+HELIX_ANGLES = range(0, 36, 5)
+OUT_GEARS_DISTANCES = range(16, 33, 2)
+
+PLANET_CLEARANCE = 1  # mm between the tips of the planets which do not mesh
+AXIAL_CLEARANCE = 1  # mm between a planet and the out gear it does not mesh with
+MIN_RIM = 2  # mm between the bore and the tooth roots
+MIN_OVERLAP = 1  # pitches the helix turns over the planets' mesh, for a smooth mesh
+MAX_PLANET_RATIO = 4  # of the planets' speed to the carrier's, with one wheel stopped
+
+PARAMETERS = ("modul", "out_gear_teeth", "planet_teeth", "num_planets",
+              "helix_angle", "out_gears_distance")
+# the rest only places the same gears differently
+DESIGN_PARAMETERS = ("modul", "out_gear_teeth", "planet_teeth", "num_planets")
+
+
+def candidates() -> dict:
+    """Every combination of the parameters, as columns"""
+    grid = np.meshgrid(MODULES, OUT_GEAR_TEETH, PLANET_TEETH, NUM_PLANETS,
+                       HELIX_ANGLES, OUT_GEARS_DISTANCES, indexing="ij")
+    return {name: values.ravel() for name, values in zip(PARAMETERS, grid)}
+
+
+def tip_radius(modul: np.ndarray, pitch_radius: np.ndarray) -> np.ndarray:
+    # Gear.tip_diam
+    return pitch_radius + np.where(modul < 1, 1.1, 1) * modul
+
+
+def root_radius(modul: np.ndarray, teeth: np.ndarray) -> np.ndarray:
+    # Gear.root_diam
+    tip_clearance = np.where(teeth < 3, 0, modul / 6)
+    return modul * teeth / 2 - (modul + tip_clearance)
+
+
+def evaluate(c: dict) -> dict:
+    """Derived dimensions and the feasibility of every candidate"""
+    modul, z_out, z_planet, n = c["modul"], c["out_gear_teeth"], c["planet_teeth"], c["num_planets"]
+    helix = np.radians(c["helix_angle"])
+    planet_width = OUT_GEAR_WIDTH + PLANET_GEARS_MESH_HEIGHT
+
+    out_radius = modul * z_out / 2
+    planet_radius = modul * z_planet / 2
+    planet_tip = tip_radius(modul, planet_radius)
+    distance = out_radius + planet_radius
+
+    # the upper planet of a pair is this far around from the lower one, as in assembly
+    pair_angle = 2 * np.arcsin(planet_radius / distance)
+    spacing = 2 * np.pi / n
+    # the upper planet of a pair and the lower planet of the next share the mesh height
+    gap_angle = spacing - pair_angle
+    gap = 2 * distance * np.sin(np.clip(gap_angle, 0, None) / 2) - 2 * planet_tip
+
+    # Gear.torsion_angle and the compensation of assembly, degrees
+    torsion = np.degrees(planet_width * np.tan(helix) / planet_radius)
+    torsion_compensation = torsion * (c["out_gears_distance"] - PLANET_GEARS_MESH_HEIGHT) / planet_width
+    overlap = torsion * PLANET_GEARS_MESH_HEIGHT / planet_width / (360 / z_planet)
+
+    # fewest teeth without undercut (DIN 3960), with Gear.alpha_spur
+    alpha_spur = np.arctan(np.tan(radians(PRESSURE_ANGLE)) / np.cos(helix))
+    min_teeth = 2 * np.cos(helix) / np.sin(alpha_spur) ** 2
+
+    planet_ratio = z_out / z_planet
+    result = dict(c,
+                  outer_diameter=2 * (distance + planet_tip),
+                  height=2 * OUT_GEAR_WIDTH + c["out_gears_distance"],
+                  planet_gap=gap,
+                  torsion_compensation=torsion_compensation,
+                  overlap=overlap,
+                  planet_ratio=planet_ratio)
+    result["feasible"] = ((gap_angle > 0) & (gap >= PLANET_CLEARANCE)
+                          # the pairs are copies rotated by the spacing, the out gears have to be too
+                          & (z_out % n == 0)
+                          & (np.minimum(z_out, z_planet) >= min_teeth)
+                          & (root_radius(modul, z_planet) >= BORE / 2 + MIN_RIM)
+                          & (c["out_gears_distance"] - PLANET_GEARS_MESH_HEIGHT >= AXIAL_CLEARANCE)
+                          & ((overlap >= MIN_OVERLAP) | (helix == 0))
+                          & (planet_ratio <= MAX_PLANET_RATIO))
+    return result
+
+
+def rank(result: dict, max_diameter: float = np.inf) -> np.ndarray:
+    """
+    Indices of the feasible designs, the best first:
+    the smallest, then the lowest, then the most planets to share the load,
+    then the strongest teeth. A design is a set of gears, it is listed once,
+    with the lowest out gears distance and the smallest helix angle which work,
+    the smallest helix has the smallest axial load.
+    """
+    feasible = np.flatnonzero(result["feasible"] & (result["outer_diameter"] <= max_diameter))
+    order = feasible[np.lexsort((result["helix_angle"][feasible],
+                                 -result["modul"][feasible],
+                                 -result["num_planets"][feasible],
+                                 result["height"][feasible],
+                                 result["outer_diameter"][feasible]))]
+
+    design = np.stack([result[name][order] for name in DESIGN_PARAMETERS], axis=1)
+    _, first = np.unique(design, axis=0, return_index=True)
+    return order[np.sort(first)]
+
+
+def _render(args) -> str:
+    parameters, mock, filepath = args
+    return render(assembly(mock, **parameters), filepath=filepath)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweeps the parameters of the differential")
+    parser.add_argument("--top", type=int, default=5, help="candidates rendered")
+    parser.add_argument("--max-diameter", type=float, default=np.inf, help="mm")
+    parser.add_argument("--out-dir", default="export/sweep")
+    parser.add_argument("--jobs", type=int, default=None, help="render processes")
+    parser.add_argument("--mock", action="store_true", help="render cylinders instead of gears")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    result = evaluate(candidates())
+    best = rank(result, args.max_diameter)
+    elapsed = time.perf_counter() - start
+    print(f"{result['feasible'].sum()} of {len(result['feasible'])} candidates feasible, "
+          f"{len(best)} designs within the diameter, {elapsed * 1e3:.0f} ms")
+
+    columns = PARAMETERS + ("outer_diameter", "height", "planet_gap",
+                            "torsion_compensation", "overlap", "planet_ratio")
+    print(" ".join(f"{c:>10.10}" for c in ("#",) + columns))
+    jobs = []
+    for i, index in enumerate(best[:args.top]):
+        print(" ".join([f"{i:>10}"] + [f"{result[c][index]:>10.4g}" for c in columns]))
+        parameters = {name: result[name][index].item() for name in PARAMETERS}
+        jobs.append((parameters, args.mock, os.path.join(args.out_dir, f"differential_{i}.scad")))
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    with ProcessPoolExecutor(args.jobs) as executor:
+        for path in executor.map(_render, jobs):
+            print(path)
+
+
+if __name__ == "__main__":
+    main()
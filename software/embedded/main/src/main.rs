@@ -31,10 +31,8 @@ macro_rules! wheel_alias {
 
 #[rtic::app(device = stm32f4xx_hal::pac, peripherals = true, dispatchers = [EXTI1, EXTI2, EXTI3])]
 mod app {
-    use core::fmt::Write;
-
     use embedded_hal::{digital::v2::OutputPin, blocking::{i2c, delay::DelayMs}};
-    use motor::GetSpeed;
+    use motor::{GetSpeed, SetSpeed};
     use rtt_target::{rtt_init_print, rprintln, rprint};
 
     use stm32f4xx_hal::{
@@ -55,7 +53,6 @@ mod app {
     };
 
     use fugit::{RateExtU32, HertzU32, Duration};
-    use numtoa::NumToA;
     use array_init::from_iter;
     use itertools::Itertools;
 
@@ -63,10 +60,15 @@ mod app {
 
     use stepper::{Stepper, StepperDireciton};
     use rotary_encoder::RotaryEncoder;
-    use encoder::Update;
+    use encoder::{Update, GetPosition};
     use dc_motor::TwoWirteDriver;
     use wheel::Wheel;
 
+    use interfacing::{
+        Interfacing, CommandId, commands::{Command, SetSpeedParams},
+        message::{Telemetry, LineSensorReading, MessageBuffer, IdType, TimeType, LINE_SENSORS}
+    };
+
     use crate::line_sensor::{LineSensor, NUM_SENSORS};
 
     const LINE_DEBUG: bool = false;
@@ -77,6 +79,11 @@ mod app {
     const WHEEL_ENCODER_PPR: f32 = 48.0;
     const WHEEL_MAX_ROTARY_SPEED: f32 = 100.0;
     const WHEEL_RADIUS: f32 = 100.0;
+    const TELEMETRY_INTERVAL_MS: u32 = 20;
+    // the host fuses the readings with the camera between its frames, see the line-stream feature
+    const LINE_STREAM_INTERVAL_US: u32 = 5_000;
+
+    const _: () = assert!(NUM_SENSORS == LINE_SENSORS);
 
     #[monotonic(binds = TIM2, default = true)]
     type MicrosecMono = MonoTimer<pac::TIM2, 1_000_000>;
@@ -105,15 +112,17 @@ mod app {
         left: left_wheel::WheelT,
         right: right_wheel::WheelT,
 
-        serial_tx: serial::Tx<USART2>,
-        serial_rx: serial::Rx<USART2>,
+        interfacing: Interfacing,
     }
 
     #[local]
     struct Local<'a> {
         speed: HertzU32,
         direction: StepperDireciton,
-        line_sensor: LineSensor<I2cType>
+        line_sensor: LineSensor<I2cType>,
+
+        serial_tx: serial::Tx<USART2>,
+        serial_rx: serial::Rx<USART2>,
     }
 
     #[init]
@@ -208,27 +217,41 @@ mod app {
 
         line::spawn().ok();
         updater::spawn().ok();
+        telemetry::spawn().ok();
         if WHEELS_DEBUG { speed_printer::spawn().ok(); }
 
         (
             Shared {
                 left: left_wheel,
                 right: right_wheel,
-                serial_tx, serial_rx,
+                interfacing: Interfacing::new(),
             },
             Local {
                 speed: 400_u32.Hz(),
                 direction: StepperDireciton::Clockwise,
-                line_sensor
+                line_sensor,
+                serial_tx, serial_rx,
             },
             init::Monotonics(mono),
         )
     }
 
-    #[task(local = [line_sensor], shared = [serial_tx])]
-    fn line(mut cx: line::Context) {
+    #[task(local = [line_sensor, last_streamed: u32 = 0], shared = [interfacing])]
+    fn line(cx: line::Context) {
         let vals: [_; NUM_SENSORS] = cx.local.line_sensor.read();
 
+        // only for the host's LINE_SENSOR_FUSION, the port is busy enough without it
+        if cfg!(feature = "line-stream") {
+            let now = monotonics::now().ticks();
+            if now.wrapping_sub(*cx.local.last_streamed) >= LINE_STREAM_INTERVAL_US {
+                *cx.local.last_streamed = now;
+                let mut interfacing = cx.shared.interfacing;
+                let reading = LineSensorReading { time: now, values: vals };
+                interfacing.lock(|interfacing| interfacing.send_line_sensor(&reading)).ok();
+                send();
+            }
+        }
+
         let derivative: [i32; NUM_SENSORS - 1] = unsafe { from_iter(vals
                                                                     .into_iter()
                                                                     .tuple_windows()
@@ -257,29 +280,19 @@ mod app {
             rprintln!("Line: {:?}", line);
         }
 
-        cx.shared.serial_tx.lock(|tx| {
-            for v in derivative {
-                let mut s = [0_u8; 11];
-                tx.bwrite_all(v.numtoa(10, &mut s)).unwrap();
-                if LINE_DEBUG { block!(tx.write(' ' as u8)).unwrap(); }
-            }
-            for v in vals {
-                let mut s = [0_u8; 11];
-                tx.bwrite_all(v.numtoa(10, &mut s)).unwrap();
-                if LINE_DEBUG { block!(tx.write(' ' as u8)).unwrap(); }
-            }
-            if LINE_DEBUG { block!(tx.write('\n' as u8)).unwrap(); }
-        });
+        // the serial port is used by the interfacing protocol
+        if LINE_DEBUG {
+            rprintln!("{:?} {:?}", derivative, vals);
+        }
 
         line::spawn_after(100_u32.micros()).ok();
     }
 
-    #[task(shared = [left, right, serial_tx])]
+    #[task(shared = [left, right])]
     fn speed_printer(cx: speed_printer::Context) {
-        (cx.shared.left, cx.shared.right,
-         cx.shared.serial_tx).lock(|left, right, serial_tx| {
-            writeln!(serial_tx, "{} {} {} {}", left.get_target_speed(), left.get_speed(),
-                                               right.get_target_speed(), right.get_speed()).ok();
+        (cx.shared.left, cx.shared.right).lock(|left, right| {
+            rprintln!("{} {} {} {}", left.get_target_speed(), left.get_speed(),
+                                     right.get_target_speed(), right.get_speed());
         });
         speed_printer::spawn_after(100_u32.millis()).ok();
     }
@@ -299,6 +312,25 @@ mod app {
         updater::spawn_after(25.millis()).ok();
     }
 
+    #[task(shared = [left, right, interfacing])]
+    fn telemetry(cx: telemetry::Context) {
+        let (mut left, mut right, mut interfacing) =
+            (cx.shared.left, cx.shared.right, cx.shared.interfacing);
+
+        let sample = (&mut left, &mut right).lock(|left, right| Telemetry {
+            time: monotonics::now().ticks(),
+            left_position: left.get_position(),
+            right_position: right.get_position(),
+            left_speed: left.get_speed(),
+            right_speed: right.get_speed()
+        });
+        // sent after the queued messages, a sample the port has not got to is replaced
+        interfacing.lock(|interfacing| interfacing.send_telemetry(&sample)).ok();
+        send();
+
+        telemetry::spawn_after(TELEMETRY_INTERVAL_MS.millis()).ok();
+    }
+
     /*
     #[task(shared = [platform_stepper], priority = 15)]
     fn platform(mut cx: platform::Context) {
@@ -311,17 +343,135 @@ mod app {
     }
     */
 
-    #[task(binds = USART2, shared = [serial_rx], priority = 10)]
-    fn uart_rx(mut cx: uart_rx::Context) {
-        cx.shared.serial_rx.lock(|rx| {
+    #[task(shared = [left, right, interfacing])]
+    fn executor(cx: executor::Context) {
+        let (mut left, mut right, mut interfacing) =
+            (cx.shared.left, cx.shared.right, cx.shared.interfacing);
+        // a command at a time, each once both of its replies fit the send queue: uart spawns
+        // this again as the queue is written, so the rest wait for it rather than overflow it
+        while (&mut left, &mut right, &mut interfacing).lock(|left, right, interfacing| {
+            if !interfacing.can_reply() {
+                return false;
+            }
+            let Some(id) = interfacing.get_command_to_execute() else { return false };
+            execute(left, right, interfacing, id);
+            true
+        }) {
+            send();
+        }
+    }
+
+    fn execute(left: &mut left_wheel::WheelT, right: &mut right_wheel::WheelT,
+               interfacing: &mut Interfacing, id: CommandId) {
+        // a batch is rejected as a whole, before any of it moves the robot
+        let supported = match interfacing.get_command(id) {
+            Command::Batch(batch) => batch.steps().all(|step| is_supported(step.into())),
+            command => is_supported(command)
+        };
+        if !supported {
+            interfacing.reject(id).ok();
+            return;
+        }
+
+        interfacing.start_executing(id, monotonics::now().ticks()).ok();
+        match interfacing.get_command(id) {
+            Command::Batch(batch) => {
+                for (i, step) in batch.steps().enumerate() {
+                    execute_command(left, right, step.into());
+                    interfacing.report_progress(id, (i + 1) as u8);
+                }
+            },
+            command => execute_command(left, right, command)
+        }
+        interfacing.finish_executing(id).ok();
+    }
+
+    /// The gripper is not connected yet, its commands are rejected
+    fn is_supported(command: Command) -> bool {
+        matches!(command, Command::Stop | Command::SetSpeed(_))
+    }
+
+    /// Only the supported commands get here
+    fn execute_command(left: &mut left_wheel::WheelT, right: &mut right_wheel::WheelT,
+                       command: Command) {
+        match command {
+            Command::Stop => {
+                left.set_speed(0.0);
+                right.set_speed(0.0);
+            },
+            Command::SetSpeed(SetSpeedParams { left: l, right: r }) => {
+                left.set_speed(l as f32);
+                right.set_speed(r as f32);
+            },
+            _ => {}
+        }
+    }
+
+    /// Starts sending the queued messages, see uart
+    fn send() {
+        rtic::pend(pac::Interrupt::USART2);
+    }
+
+    /// Receives a byte and writes the queued messages a byte at a time, whenever the transmitter
+    /// has room: nothing waits for the port, so a receive is never held up for a whole frame.
+    /// Raised by the receiver, by the transmitter while there is something to send, and by send.
+    #[task(binds = USART2,
+           local = [serial_rx, serial_tx,
+                    tx_frame: MessageBuffer = MessageBuffer::new(), tx_written: usize = 0,
+                    sync_request: Option<(IdType, TimeType)> = None],
+           shared = [interfacing], priority = 10)]
+    fn uart(mut cx: uart::Context) {
+        let (rx, tx) = (cx.local.serial_rx, cx.local.serial_tx);
+        let (frame, written) = (cx.local.tx_frame, cx.local.tx_written);
+        let sync_request = cx.local.sync_request;
+
+        cx.shared.interfacing.lock(|interfacing| {
             match rx.read() {
                 Ok(byte) => {
-                    rprintln!("Recv: {}", byte);
+                    if let Err(e) = interfacing.handle_received_byte(byte) {
+                        rprintln!("Receive err: {:?}", e);
+                    }
+                    if let Some(id) = interfacing.get_time_sync_request() {
+                        *sync_request = Some((id, monotonics::now().ticks()));
+                    }
+                    executor::spawn().ok();
                 },
+                // raised to send
+                Err(nb::Error::WouldBlock) => {},
                 Err(e) => {
                     rprintln!("Err: {:?}", e);
                 }
             }
+
+            loop {
+                if *written == frame.len() {
+                    // a time sync reply goes first, stamped right before its first byte is written
+                    let next = sync_request.take()
+                        .and_then(|(id, receive_time)| interfacing.time_sync_response(
+                            id, receive_time, monotonics::now().ticks()).ok())
+                        .or_else(|| interfacing.get_message_to_send());
+                    match next {
+                        Some(next) => {
+                            *frame = next;
+                            *written = 0;
+                            // a waiting command may fit now
+                            executor::spawn().ok();
+                        },
+                        None => {
+                            tx.unlisten();
+                            break;
+                        }
+                    }
+                }
+                match tx.write(frame[*written]) {
+                    Ok(()) => *written += 1,
+                    // the rest once the transmitter has room
+                    Err(_) => {
+                        tx.listen();
+                        break;
+                    }
+                }
+            }
         });
     }
 }
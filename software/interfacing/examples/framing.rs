@@ -0,0 +1,82 @@
+//! Bytes per speed update and the highest command rate the link allows,
+//! the full framing against the compact one.
+//!
+//! A command is a SetSpeed to the embedded side and an Ack and a Done back; the link
+//! is full duplex, so the busier direction limits the rate. The encode and decode
+//! time of the whole exchange on this machine is reported too.
+//!
+//! cargo run --release --example framing -- [commands]
+
+use std::env;
+use std::time::Instant;
+
+use interfacing::{Interfacing, BAUD_RATE, commands::{Command, SetSpeedParams}};
+
+const BITS_PER_BYTE: usize = 10; // start and stop bits
+const MAX_SPEED: i32 = 2000;
+
+struct Stats {
+    to_embedded: usize,
+    to_host: usize,
+    seconds: f64,
+}
+
+fn exchange(compact: bool, commands: u32) -> Stats {
+    let mut host = Interfacing::new();
+    host.set_compact(compact);
+    let mut embedded = Interfacing::new();
+
+    let mut stats = Stats { to_embedded: 0, to_host: 0, seconds: 0.0 };
+    let start = Instant::now();
+
+    for i in 0..commands {
+        // a wobbling line following correction
+        let correction = ((i as f32 * 0.1).sin() * 300.0) as i32;
+        let params = SetSpeedParams {
+            left: (300 + correction).clamp(-MAX_SPEED, MAX_SPEED),
+            right: (300 - correction).clamp(-MAX_SPEED, MAX_SPEED),
+        };
+        let id = host.execute(Command::SetSpeed(params), Some(0)).unwrap();
+
+        while let Some(msg) = host.get_message_to_send() {
+            stats.to_embedded += msg.len();
+            for byte in msg {
+                embedded.handle_received_byte(byte).unwrap();
+            }
+        }
+
+        while let Some(received) = embedded.get_command_to_execute() {
+            embedded.start_executing(received, i.wrapping_mul(100_000)).unwrap();
+            embedded.finish_executing(received).unwrap();
+        }
+
+        while let Some(msg) = embedded.get_message_to_send() {
+            stats.to_host += msg.len();
+            for byte in msg {
+                host.handle_received_byte(byte).unwrap();
+            }
+        }
+
+        assert!(host.is_finished(id));
+        host.ack_finish(id);
+    }
+
+    stats.seconds = start.elapsed().as_secs_f64();
+    stats
+}
+
+fn main() {
+    let commands: u32 = env::args().nth(1).map_or(100_000, |a| a.parse().expect("expected a number"));
+    let bytes_per_second = BAUD_RATE as f64 / BITS_PER_BYTE as f64;
+
+    println!("{:<8} {:>12} {:>12} {:>14} {:>12}",
+             "framing", "to embedded", "to host", "max rate /s", "cpu us/cmd");
+    for (name, compact) in [("full", false), ("compact", true)] {
+        let stats = exchange(compact, commands);
+        let to_embedded = stats.to_embedded as f64 / commands as f64;
+        let to_host = stats.to_host as f64 / commands as f64;
+        let rate = bytes_per_second / to_embedded.max(to_host);
+        println!("{:<8} {:>12.1} {:>12.1} {:>14.0} {:>12.2}",
+                 name, to_embedded, to_host, rate, stats.seconds * 1e6 / commands as f64);
+    }
+}
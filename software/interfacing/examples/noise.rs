@@ -0,0 +1,132 @@
+//! Noise injection benchmark of the receiver's resynchronization.
+//!
+//! A stream of time sync responses is corrupted every few messages: a byte is flipped,
+//! dropped or inserted, or a fake frame header appears. For every kind of corruption
+//! it reports how many messages are lost per event and how long it takes the receiver
+//! to deliver a message again, at the link's baud rate.
+//!
+//! cargo run --release --example noise -- [messages] [interval] [seed]
+
+use std::env;
+use std::vec::Vec;
+
+use interfacing::{Interfacing, BAUD_RATE, START_BYTE, message::IdType};
+
+const BITS_PER_BYTE: u64 = 10; // start and stop bits
+
+#[derive(Clone, Copy, Debug, PartialEq)]
+enum Corruption {
+    Flip,
+    Drop,
+    Insert,
+    FakeHeader,
+}
+
+const KINDS: [Corruption; 4] = [Corruption::Flip, Corruption::Drop,
+                                Corruption::Insert, Corruption::FakeHeader];
+
+struct XorShift(u64);
+
+impl XorShift {
+    fn next(&mut self) -> u64 {
+        self.0 ^= self.0 << 13;
+        self.0 ^= self.0 >> 7;
+        self.0 ^= self.0 << 17;
+        self.0
+    }
+
+    fn below(&mut self, n: usize) -> usize {
+        (self.next() % n as u64) as usize
+    }
+}
+
+struct Event {
+    kind: Corruption,
+    message: IdType,
+    offset: usize, // in the stream
+}
+
+fn main() {
+    let args: Vec<u64> = env::args().skip(1).map(|a| a.parse().expect("expected a number")).collect();
+    let messages = *args.get(0).unwrap_or(&20_000) as IdType;
+    let interval = *args.get(1).unwrap_or(&10) as IdType;
+    let mut rng = XorShift(*args.get(2).unwrap_or(&0x2545F4914F6CDD1D) | 1);
+
+    let sender = Interfacing::new();
+    let mut stream: Vec<u8> = Vec::new();
+    let mut events: Vec<Event> = Vec::new();
+
+    for id in 0..messages {
+        let mut frame: Vec<u8> = sender.time_sync_response(id, id, id).unwrap().into_iter().collect();
+
+        if id % interval == interval / 2 {
+            let kind = KINDS[events.len() % KINDS.len()];
+            let pos = rng.below(frame.len());
+            match kind {
+                Corruption::Flip => frame[pos] ^= 1 << rng.below(8),
+                Corruption::Drop => { frame.remove(pos); },
+                Corruption::Insert => frame.insert(pos, rng.next() as u8),
+                Corruption::FakeHeader => {
+                    let len = 9 + rng.below(32) as u8;
+                    frame.splice(pos..pos, [START_BYTE, len]);
+                }
+            }
+            events.push(Event { kind, message: id, offset: stream.len() + pos });
+        }
+
+        stream.extend_from_slice(&frame);
+    }
+
+    // where in the stream each message has been delivered
+    let mut delivered: Vec<Option<usize>> = vec![None; messages as usize];
+    let mut receiver = Interfacing::new();
+    let mut errors = 0;
+    for (offset, byte) in stream.iter().enumerate() {
+        if receiver.handle_received_byte(*byte).is_err() {
+            errors += 1;
+        }
+        while let Some(reply) = receiver.get_time_sync_reply() {
+            // a badly damaged frame may be "corrected" into some other id
+            if let Some(d) = delivered.get_mut(reply.id as usize) {
+                d.get_or_insert(offset);
+            }
+        }
+    }
+
+    let byte_us = BITS_PER_BYTE as f64 * 1e6 / BAUD_RATE as f64;
+    let lost_total = delivered.iter().filter(|d| d.is_none()).count();
+    println!("{} messages, {} bytes, {} corruption events, {} receive errors, {} messages lost",
+             messages, stream.len(), events.len(), errors, lost_total);
+    println!("{:<11} {:>7} {:>10} {:>9} {:>16} {:>15}",
+             "corruption", "events", "lost/event", "max lost", "recover mean us", "recover max us");
+
+    for kind in KINDS {
+        let mut count = 0;
+        let mut lost = 0;
+        let mut max_lost = 0;
+        let mut recover_sum = 0.0;
+        let mut recover_max: f64 = 0.0;
+
+        for (i, event) in events.iter().enumerate().filter(|(_, e)| e.kind == kind) {
+            // up to the next event, so that the events do not overlap
+            let end = events.get(i + 1).map_or(messages, |e| e.message);
+            let range = event.message as usize..end as usize;
+
+            let event_lost = delivered[range.clone()].iter().filter(|d| d.is_none()).count();
+            let recovered = delivered[range].iter().flatten().next();
+
+            count += 1;
+            lost += event_lost;
+            max_lost = max_lost.max(event_lost);
+            if let Some(recovered) = recovered {
+                let us = (recovered.saturating_sub(event.offset) + 1) as f64 * byte_us;
+                recover_sum += us;
+                recover_max = recover_max.max(us);
+            }
+        }
+
+        println!("{:<11} {:>7} {:>10.2} {:>9} {:>16.1} {:>15.1}",
+                 format!("{:?}", kind), count, lost as f64 / count.max(1) as f64, max_lost,
+                 recover_sum / count.max(1) as f64, recover_max);
+    }
+}
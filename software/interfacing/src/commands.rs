@@ -1,5 +1,9 @@
 use bincode::{Decode, Encode};
 
+/// Steps a batch can hold: the message has to fit MAX_MESSAGE_LEN,
+/// a gripper step takes two bytes, a speed update up to twelve
+pub const MAX_BATCH_STEPS: usize = 6;
+
 #[derive(Clone, Copy, Encode, Decode, PartialEq, Debug)]
 pub enum Command {
     Stop,
@@ -7,7 +11,20 @@ pub enum Command {
     OpenGripper,
     CloseGripper,
     LiftGripper,
-    LowerGripper
+    LowerGripper,
+    /// Executed one step after another, acknowledged once, the progress is reported after every step
+    Batch(CommandBatch)
+}
+
+impl Command {
+    /// Commands which set the wheels' speeds, a newer one makes the queued ones obsolete
+    pub fn is_motion(&self) -> bool {
+        match self {
+            Command::Stop | Command::SetSpeed(_) => true,
+            Command::Batch(batch) => batch.steps().any(|step| Command::from(step).is_motion()),
+            _ => false
+        }
+    }
 }
 
 #[derive(Clone, Copy, Encode, Decode, PartialEq, Debug)]
@@ -16,3 +33,68 @@ pub struct SetSpeedParams {
     pub right: i32
 }
 
+/// Any command but a batch, a batch cannot contain itself
+#[derive(Clone, Copy, Encode, Decode, PartialEq, Debug)]
+pub enum Step {
+    Stop,
+    SetSpeed(SetSpeedParams),
+    OpenGripper,
+    CloseGripper,
+    LiftGripper,
+    LowerGripper
+}
+
+impl From<Step> for Command {
+    fn from(step: Step) -> Self {
+        match step {
+            Step::Stop => Command::Stop,
+            Step::SetSpeed(params) => Command::SetSpeed(params),
+            Step::OpenGripper => Command::OpenGripper,
+            Step::CloseGripper => Command::CloseGripper,
+            Step::LiftGripper => Command::LiftGripper,
+            Step::LowerGripper => Command::LowerGripper
+        }
+    }
+}
+
+impl TryFrom<Command> for Step {
+    type Error = ();
+
+    fn try_from(command: Command) -> Result<Self, Self::Error> {
+        Ok(match command {
+            Command::Stop => Step::Stop,
+            Command::SetSpeed(params) => Step::SetSpeed(params),
+            Command::OpenGripper => Step::OpenGripper,
+            Command::CloseGripper => Step::CloseGripper,
+            Command::LiftGripper => Step::LiftGripper,
+            Command::LowerGripper => Step::LowerGripper,
+            Command::Batch(_) => return Err(())
+        })
+    }
+}
+
+/// The steps come first, the unused slots are None
+#[derive(Clone, Copy, Encode, Decode, PartialEq, Debug)]
+pub struct CommandBatch(pub [Option<Step>; MAX_BATCH_STEPS]);
+
+impl CommandBatch {
+    /// None if there are too many steps
+    pub fn new(steps: &[Step]) -> Option<Self> {
+        if steps.len() > MAX_BATCH_STEPS {
+            return None;
+        }
+        let mut batch = [None; MAX_BATCH_STEPS];
+        for (slot, step) in batch.iter_mut().zip(steps) {
+            *slot = Some(*step);
+        }
+        Some(Self(batch))
+    }
+
+    pub fn steps(&self) -> impl Iterator<Item = Step> + '_ {
+        self.0.iter().map_while(|step| *step)
+    }
+
+    pub fn len(&self) -> usize {
+        self.steps().count()
+    }
+}
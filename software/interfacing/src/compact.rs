@@ -0,0 +1,186 @@
+//! Compact framing of the messages which are sent on every control step.
+//!
+//! A frame is COMPACT_START_BYTE, the kind, the fixed-size payload and a CRC-8
+//! of the kind and the payload. The length follows from the kind, ids are the
+//! low byte of the full ones and the speeds are packed into i16. A corrupted
+//! frame is dropped rather than corrected: the next speed update replaces it anyway,
+//! and acks are retried.
+
+use crate::{
+    commands::{Command, SetSpeedParams},
+    message::{Message, MessageBuffer, IdType, TimeType},
+};
+
+pub const COMPACT_START_BYTE: u8 = 0b1101001;
+
+/// Low byte of a command id, enough to tell apart the few commands in flight
+pub type ShortId = u8;
+
+const KIND_SET_SPEED: u8 = 1;
+const KIND_ACK: u8 = 2;
+const KIND_DONE: u8 = 3;
+
+const CRC_POLYNOMIAL: u8 = 0x07;
+
+#[derive(Clone, Copy, PartialEq, Debug)]
+pub enum CompactMessage {
+    SetSpeed(ShortId, SetSpeedParams),
+    Ack(ShortId, TimeType),
+    Done(ShortId),
+}
+
+#[derive(Debug, PartialEq)]
+pub enum CompactDecodeError {
+    BadKind(u8),
+    Crc,
+}
+
+impl CompactMessage {
+    /// None if the message has no compact form
+    pub fn from_message(msg: &Message) -> Option<Self> {
+        Some(match *msg {
+            Message::Command(id, Command::SetSpeed(params)) => {
+                if i16::try_from(params.left).is_err() || i16::try_from(params.right).is_err() {
+                    return None;
+                }
+                Self::SetSpeed(id as ShortId, params)
+            },
+            Message::Ack(id, time) => Self::Ack(id as ShortId, time),
+            Message::Done(id) => Self::Done(id as ShortId),
+            _ => return None
+        })
+    }
+
+    /// The full message, with the id resolved by the receiver
+    pub fn with_id(self, id: IdType) -> Message {
+        match self {
+            Self::SetSpeed(_, params) => Message::Command(id, Command::SetSpeed(params)),
+            Self::Ack(_, time) => Message::Ack(id, time),
+            Self::Done(_) => Message::Done(id),
+        }
+    }
+
+    pub fn short_id(&self) -> ShortId {
+        match *self {
+            Self::SetSpeed(id, _) | Self::Ack(id, _) | Self::Done(id) => id
+        }
+    }
+
+    /// Bytes which follow the kind: the payload and the CRC
+    pub fn remaining_len(kind: u8) -> Option<usize> {
+        match kind {
+            KIND_SET_SPEED => Some(1 + 2 + 2 + 1),
+            KIND_ACK => Some(1 + 4 + 1),
+            KIND_DONE => Some(1 + 1),
+            _ => None
+        }
+    }
+
+    /// The whole frame, start byte included
+    pub fn encode(&self) -> MessageBuffer {
+        let mut frame = MessageBuffer::new();
+        frame.push(COMPACT_START_BYTE).unwrap();
+        match *self {
+            Self::SetSpeed(id, params) => {
+                frame.push(KIND_SET_SPEED).unwrap();
+                frame.push(id).unwrap();
+                frame.extend_from_slice(&(params.left as i16).to_le_bytes()).unwrap();
+                frame.extend_from_slice(&(params.right as i16).to_le_bytes()).unwrap();
+            },
+            Self::Ack(id, time) => {
+                frame.push(KIND_ACK).unwrap();
+                frame.push(id).unwrap();
+                frame.extend_from_slice(&time.to_le_bytes()).unwrap();
+            },
+            Self::Done(id) => {
+                frame.push(KIND_DONE).unwrap();
+                frame.push(id).unwrap();
+            }
+        }
+        let crc = crc8(&frame[1..]);
+        frame.push(crc).unwrap();
+        frame
+    }
+
+    /// data is what follows the kind, CRC included
+    pub fn decode(kind: u8, data: &[u8]) -> Result<Self, CompactDecodeError> {
+        let len = Self::remaining_len(kind).ok_or(CompactDecodeError::BadKind(kind))?;
+        if data.len() != len {
+            return Err(CompactDecodeError::BadKind(kind));
+        }
+
+        let (payload, crc) = data.split_at(len - 1);
+        if crc8_continue(crc8(&[kind]), payload) != crc[0] {
+            return Err(CompactDecodeError::Crc);
+        }
+
+        let id = payload[0];
+        Ok(match kind {
+            KIND_SET_SPEED => Self::SetSpeed(id, SetSpeedParams {
+                left: i16::from_le_bytes([payload[1], payload[2]]).into(),
+                right: i16::from_le_bytes([payload[3], payload[4]]).into(),
+            }),
+            KIND_ACK => Self::Ack(id, TimeType::from_le_bytes([payload[1], payload[2],
+                                                               payload[3], payload[4]])),
+            _ => Self::Done(id),
+        })
+    }
+}
+
+pub fn crc8(data: &[u8]) -> u8 {
+    crc8_continue(0, data)
+}
+
+fn crc8_continue(mut crc: u8, data: &[u8]) -> u8 {
+    for byte in data {
+        crc ^= byte;
+        for _ in 0..8 {
+            crc = if crc & 0x80 != 0 { (crc << 1) ^ CRC_POLYNOMIAL } else { crc << 1 };
+        }
+    }
+    crc
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn roundtrip(msg: CompactMessage) -> Result<CompactMessage, CompactDecodeError> {
+        let frame = msg.encode();
+        assert_eq!(frame[0], COMPACT_START_BYTE);
+        assert_eq!(CompactMessage::remaining_len(frame[1]), Some(frame.len() - 2));
+        CompactMessage::decode(frame[1], &frame[2..])
+    }
+
+    #[test]
+    fn roundtrip_test() {
+        for msg in [
+            CompactMessage::SetSpeed(7, SetSpeedParams { left: -1500, right: 32767 }),
+            CompactMessage::Ack(255, 0xDEADBEEF),
+            CompactMessage::Done(0),
+        ] {
+            assert_eq!(roundtrip(msg), Ok(msg));
+        }
+    }
+
+    #[test]
+    fn corrupted_test() {
+        let mut frame = CompactMessage::Ack(3, 1234).encode();
+        frame[4] ^= 0x10;
+        assert_eq!(CompactMessage::decode(frame[1], &frame[2..]), Err(CompactDecodeError::Crc));
+        assert_eq!(CompactMessage::decode(42, &frame[2..]), Err(CompactDecodeError::BadKind(42)));
+    }
+
+    #[test]
+    fn from_message_test() {
+        let msg = Message::Command(0x1234, Command::SetSpeed(SetSpeedParams { left: 10, right: -10 }));
+        let compact = CompactMessage::from_message(&msg).unwrap();
+        assert_eq!(compact.short_id(), 0x34);
+        assert_eq!(compact.with_id(0x1234), msg);
+
+        let too_fast = Message::Command(1, Command::SetSpeed(SetSpeedParams { left: 40000, right: 0 }));
+        assert!(CompactMessage::from_message(&too_fast).is_none());
+        assert!(CompactMessage::from_message(&Message::Command(1, Command::Stop)).is_none());
+        assert!(CompactMessage::from_message(&Message::TimeSyncRequest(1)).is_none());
+    }
+}
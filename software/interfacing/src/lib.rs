@@ -5,72 +5,269 @@ extern crate std;
 
 pub mod commands;
 pub mod message;
+pub mod compact;
 
 use crate::{
     commands::Command,
+    compact::{CompactMessage, CompactDecodeError, ShortId, COMPACT_START_BYTE},
     message::{
-        Message, MessageBuffer, IdType,
+        Message, MessageBuffer, IdType, TimeType, Telemetry, LineSensorReading,
+        MAX_MESSAGE_LEN, ECC_LEN,
         MessageSerializeErorr, MessageDeserializeErorr
     },
 };
 
 use core::{ops::Deref, mem::take};
 
-use heapless::{spsc::Queue, FnvIndexMap};
+use heapless::{spsc::Queue, FnvIndexMap, HistoryBuffer};
 
 pub const BAUD_RATE: u32 = 1_000_000;
 pub const START_BYTE: u8 = 0b1010101;
 pub const RETRY_TIMEOUT: u32 = 50; // ms
+pub const PRIORITY_RETRY_TIMEOUT: u32 = 5; // ms
 
 const INTERFACING_QUEUE_SIZE: usize = 5;
 const REGISTRY_CAPACITY: usize = 4;
+const TIME_SYNC_QUEUE_SIZE: usize = 4;
+const PRIORITY_QUEUE_SIZE: usize = 2;
+const FORGOTTEN_IDS: usize = 8;
+const TELEMETRY_QUEUE_SIZE: usize = 8;
+const LINE_SENSOR_QUEUE_SIZE: usize = 16;
+
+// the parity alone is ECC_LEN bytes, there is at least one byte of data
+const MIN_MESSAGE_LEN: usize = ECC_LEN + 1;
+
+/// A broken frame's bytes after the start byte (length and data) and the byte being handled
+type ResyncBuffer = heapless::Vec<u8, { MAX_MESSAGE_LEN + 2 }>;
+
+pub type DroppedCommands = heapless::Vec<CommandId, REGISTRY_CAPACITY>;
 
 pub struct Interfacing {
-    send: Queue<MessageBuffer, INTERFACING_QUEUE_SIZE>,
+    // the id of the command a message carries, if any, so that it can be dropped
+    send: Queue<(Option<IdType>, MessageBuffer), INTERFACING_QUEUE_SIZE>,
+    priority_send: Queue<MessageBuffer, PRIORITY_QUEUE_SIZE>,
 
     next_id: u32,
 
-    waiting_execute: Queue<CommandId, REGISTRY_CAPACITY>,
+    // a queue of N holds N - 1, and every registered command may be waiting
+    waiting_execute: Queue<CommandId, { REGISTRY_CAPACITY + 1 }>,
     commands: FnvIndexMap<IdType, CommandHandle, REGISTRY_CAPACITY>,
+    // dropped or finished commands, late acks and retransmitted dones of them are expected
+    forgotten: HistoryBuffer<IdType, FORGOTTEN_IDS>,
+    // the commands executed here and whether they were rejected,
+    // a retransmission of one gets its reply again instead of being executed twice
+    executed: HistoryBuffer<(IdType, bool), FORGOTTEN_IDS>,
+
+    next_time_sync_id: IdType,
+    time_sync_requests: Queue<IdType, TIME_SYNC_QUEUE_SIZE>,
+    time_sync_replies: Queue<TimeSyncReply, TIME_SYNC_QUEUE_SIZE>,
+
+    telemetry: Queue<Telemetry, TELEMETRY_QUEUE_SIZE>,
+    line_sensor: Queue<LineSensorReading, LINE_SENSOR_QUEUE_SIZE>,
 
     receiving_status: ReceiveStatus,
-    receiving_buffer: MessageBuffer
+    receiving_buffer: MessageBuffer,
+
+    compact: bool,
+    // only the latest progress matters, so it is not queued
+    progress_to_send: Option<(IdType, u8)>,
+    // nor the latest sample of a stream, they go after everything queued
+    telemetry_to_send: Option<MessageBuffer>,
+    line_sensor_to_send: Option<MessageBuffer>
 }
 
 impl Interfacing {
     pub fn new() -> Self {
         Self { 
             send: Queue::new(),
+            priority_send: Queue::new(),
             next_id: 0,
             waiting_execute: Queue::new(),
             commands: FnvIndexMap::new(),
+            forgotten: HistoryBuffer::new(),
+            executed: HistoryBuffer::new(),
+            next_time_sync_id: 0,
+            time_sync_requests: Queue::new(),
+            time_sync_replies: Queue::new(),
+            telemetry: Queue::new(),
+            line_sensor: Queue::new(),
             receiving_status: ReceiveStatus::NotStarted,
-            receiving_buffer: MessageBuffer::new()
+            receiving_buffer: MessageBuffer::new(),
+            compact: false,
+            progress_to_send: None,
+            telemetry_to_send: None,
+            line_sensor_to_send: None
         }
     }
 
+    /// Sends the speed updates in the compact framing, see the compact module.
+    /// Both framings are always received, and the acks of a command use the framing it came in,
+    /// so only the side which sends the commands has to choose.
+    pub fn set_compact(&mut self, compact: bool) {
+        self.compact = compact;
+    }
+
     // TODO: it is ugly that you need to pass time here,
     //       but i dunno how to do this properly right now
-    pub fn execute(&mut self, command: Command, time: Option<u32>) -> Result<CommandId, MessageSerializeErorr> {
+    pub fn execute(&mut self, command: Command, time: Option<u32>) -> Result<CommandId, SendErorr> {
         let id = self.next_id;
         self.next_id += 1;
 
-        self.send_message(&Message::Command(id, command.clone()))?;
+        let message = Message::Command(id, command.clone());
+        let compact = self.compact && CompactMessage::from_message(&message).is_some();
+        self.send_message(&message, compact)?;
 
-        self.commands.insert(id, CommandHandle::new(command, time)).unwrap();
+        let mut handle = CommandHandle::new(command, time);
+        handle.compact = compact;
+        self.commands.insert(id, handle).unwrap();
 
         Ok(CommandId::new(id))
     }
 
+    /// Stops the robot ahead of everything queued.
+    /// The motion commands which have not been started yet are dropped, they would
+    /// only override the stop. If the registry is still full, the command least worth
+    /// tracking is dropped as well to make room for the stop, see evictable_command.
+    /// The returned message has to be written to the port right away,
+    /// it is retransmitted every PRIORITY_RETRY_TIMEOUT until acknowledged.
+    pub fn emergency_stop(&mut self, time: Option<u32>)
+        -> Result<(CommandId, MessageBuffer, DroppedCommands), MessageSerializeErorr> {
+        let mut dropped = DroppedCommands::new();
+        for (id, handle) in self.commands.iter() {
+            if handle.status == CommandExecutionStatus::NotStarted && handle.command.is_motion() {
+                dropped.push(CommandId::new(*id)).unwrap();
+            }
+        }
+        if dropped.is_empty() && self.commands.len() == self.commands.capacity() {
+            // cannot fail, the registry is not empty
+            dropped.push(CommandId::new(self.evictable_command().unwrap())).unwrap();
+        }
+        for id in &dropped {
+            self.commands.remove(&**id);
+            self.forgotten.write(**id);
+        }
+
+        let mut kept: heapless::Vec<(Option<IdType>, MessageBuffer), INTERFACING_QUEUE_SIZE> = heapless::Vec::new();
+        while let Some((id, msg)) = self.send.dequeue() {
+            if !id.map_or(false, |id| dropped.iter().any(|d| **d == id)) {
+                kept.push((id, msg)).unwrap();
+            }
+        }
+        for item in kept {
+            self.send.enqueue(item).unwrap();
+        }
+
+        let id = self.next_id;
+        self.next_id += 1;
+
+        let command = Command::Stop;
+        let encoded = Self::encode_message(&Message::Command(id, command), false)?;
+        let mut handle = CommandHandle::new(command, time);
+        handle.priority = true;
+        self.commands.insert(id, handle).unwrap();
+
+        Ok((CommandId::new(id), encoded, dropped))
+    }
+
+    /// The finished or rejected commands first, then the ones not started yet and the started
+    /// ones last, the oldest of them. Ids are sequential, so the oldest has the lowest one.
+    fn evictable_command(&self) -> Option<IdType> {
+        let statuses = [CommandExecutionStatus::Finished,
+                        CommandExecutionStatus::Rejected,
+                        CommandExecutionStatus::NotStarted,
+                        CommandExecutionStatus::Started];
+        statuses.iter()
+            .find_map(|status| self.commands.iter()
+                      .filter(|(_, handle)| handle.status == *status)
+                      .map(|(id, _)| *id)
+                      .min())
+    }
+
+    /// Feeds a byte to the receiving state machine.
+    /// When a frame turns out to be broken, the bytes after its start byte are scanned
+    /// again, since the next frame may begin among them. Only the first error is returned.
     pub fn handle_received_byte(&mut self, byte: u8) -> Result<(), UpdateErorr> {
+        let mut pending = ResyncBuffer::new();
+        pending.push(byte).unwrap();
+        let mut first_error = None;
+
+        let mut i = 0;
+        while i < pending.len() {
+            let byte = pending[i];
+            i += 1;
+
+            match self.receive_byte(byte) {
+                Ok(Some(received)) => {
+                    if let Err(e) = self.handle_received(received) {
+                        first_error.get_or_insert(e);
+                    }
+                },
+                Ok(None) => {},
+                Err((e, rest)) => {
+                    // the broken frame's bytes are a part of what has been consumed,
+                    // so this never grows beyond one frame and the current byte
+                    let mut next = rest;
+                    next.extend_from_slice(&pending[i..]).unwrap();
+                    pending = next;
+                    i = 0;
+                    first_error.get_or_insert(e);
+                }
+            }
+        }
+
+        match first_error {
+            Some(e) => Err(e),
+            None => Ok(())
+        }
+    }
+
+    /// Returns a message once it is complete. On a broken frame the state is reset
+    /// and the bytes which have to be scanned again are returned with the error.
+    fn receive_byte(&mut self, byte: u8) -> Result<Option<Received>, (UpdateErorr, ResyncBuffer)> {
         match self.receiving_status {
             ReceiveStatus::NotStarted => {
                 if byte == START_BYTE {
                     self.receiving_status = ReceiveStatus::Started;
+                } else if byte == COMPACT_START_BYTE {
+                    self.receiving_status = ReceiveStatus::CompactStarted;
+                }
+            },
+            ReceiveStatus::CompactStarted => {
+                match CompactMessage::remaining_len(byte) {
+                    Some(len) => self.receiving_status = ReceiveStatus::CompactReceiving(byte, len),
+                    None => {
+                        self.receiving_status = ReceiveStatus::NotStarted;
+                        let mut rest = ResyncBuffer::new();
+                        rest.push(byte).unwrap();
+                        return Err((CompactDecodeError::BadKind(byte).into(), rest));
+                    }
+                }
+            },
+            ReceiveStatus::CompactReceiving(kind, len) => {
+                self.receiving_buffer.push(byte).unwrap();
+                if self.receiving_buffer.len() == len {
+                    self.receiving_status = ReceiveStatus::NotStarted;
+                    let result = match CompactMessage::decode(kind, &self.receiving_buffer) {
+                        Ok(message) => Ok(Some(Received::Compact(message))),
+                        Err(e) => {
+                            let mut rest = ResyncBuffer::new();
+                            rest.push(kind).unwrap();
+                            rest.extend_from_slice(&self.receiving_buffer).unwrap();
+                            Err((e.into(), rest))
+                        }
+                    };
+                    self.receiving_buffer.clear();
+                    return result;
                 }
             },
             ReceiveStatus::Started => {
                 let size: usize = byte.into();
+                if size < MIN_MESSAGE_LEN || size > MAX_MESSAGE_LEN {
+                    self.receiving_status = ReceiveStatus::NotStarted;
+                    let mut rest = ResyncBuffer::new();
+                    rest.push(byte).unwrap();
+                    return Err((UpdateErorr::BadLength(size), rest));
+                }
                 self.receiving_status = ReceiveStatus::Receiving(size);
             },
             ReceiveStatus::Receiving(size) => {
@@ -78,91 +275,300 @@ impl Interfacing {
                 if self.receiving_buffer.len() == size {
                     let message = Message::deserialize(&self.receiving_buffer);
 
-                    self.receiving_buffer.clear();
-                    self.receiving_status = ReceiveStatus::NotStarted;
-
                     // need to reset the state despite any errors
-                    let message = message?;
-
-                    match message {
-                        Message::Command(id, cmd) => {
-                            // TODO: right now, commands are executed only on the embedded side
-                            //       and we do not need to keep track of the time when the command
-                            //       was started
-                            self.commands.insert(id, CommandHandle::new(cmd, None)).unwrap();
-                            self.waiting_execute.enqueue(CommandId::new(id)).unwrap();
-                        },
-                        Message::Ack(id) => {
-                            let handle = self.commands.get_mut(&id).ok_or(UpdateErorr::BadId(id))?;
-                            handle.status = CommandExecutionStatus::Started;
-                        },
-                        Message::Done(id) => {
-                            let handle = self.commands.get_mut(&id).ok_or(UpdateErorr::BadId(id))?;
-                            handle.status = CommandExecutionStatus::Finished;
+                    self.receiving_status = ReceiveStatus::NotStarted;
+                    let result = match message {
+                        Ok(message) => Ok(Some(Received::Full(message))),
+                        Err(e) => {
+                            let mut rest = ResyncBuffer::new();
+                            rest.push(size as u8).unwrap();
+                            rest.extend_from_slice(&self.receiving_buffer).unwrap();
+                            Err((e.into(), rest))
                         }
                     };
+                    self.receiving_buffer.clear();
+                    return result;
+                }
+            }
+        };
+        Ok(None)
+    }
+
+    fn handle_received(&mut self, received: Received) -> Result<(), UpdateErorr> {
+        match received {
+            Received::Full(message) => self.handle_message(message, false),
+            // the sender's registry is keyed by the short id, so are the replies to it
+            Received::Compact(message @ CompactMessage::SetSpeed(id, _)) => {
+                self.handle_message(message.with_id(id.into()), true)
+            },
+            Received::Compact(message) => {
+                match self.resolve_short_id(message.short_id())? {
+                    Some(id) => self.handle_message(message.with_id(id), true),
+                    None => Ok(())
                 }
             }
+        }
+    }
+
+    fn resolve_short_id(&self, short: ShortId) -> Result<Option<IdType>, UpdateErorr> {
+        // ids are sequential and only a few commands are in flight, so the low byte is unique
+        if let Some(id) = self.commands.keys().find(|id| **id as ShortId == short) {
+            return Ok(Some(*id));
+        }
+        if self.forgotten.as_slice().iter().any(|id| *id as ShortId == short) {
+            return Ok(None);
+        }
+        Err(UpdateErorr::BadId(short.into()))
+    }
+
+    fn handle_message(&mut self, message: Message, compact: bool) -> Result<(), UpdateErorr> {
+        match message {
+            Message::Command(id, cmd) => {
+                // TODO: right now, commands are executed only on the embedded side
+                //       and we do not need to keep track of the time when the command
+                //       was started
+                if self.resend_reply(id, compact) {
+                    return Ok(());
+                }
+                // a new command is not acknowledged when there is no room, the sender retries it
+                if self.commands.len() == self.commands.capacity() {
+                    return Err(UpdateErorr::RegistryFull(id));
+                }
+                let mut handle = CommandHandle::new(cmd, None);
+                handle.compact = compact;
+                self.commands.insert(id, handle).unwrap();
+                // cannot fail, there is room for every registered command
+                self.waiting_execute.enqueue(CommandId::new(id)).unwrap();
+            },
+            Message::Ack(id, time) => {
+                if let Some(handle) = self.get_handle(id)? {
+                    handle.status = CommandExecutionStatus::Started;
+                    handle.start_time = Some(time);
+                }
+            },
+            Message::Done(id) => {
+                if let Some(handle) = self.get_handle(id)? {
+                    handle.status = CommandExecutionStatus::Finished;
+                }
+            },
+            Message::Rejected(id) => {
+                if let Some(handle) = self.get_handle(id)? {
+                    handle.status = CommandExecutionStatus::Rejected;
+                }
+            },
+            Message::Progress(id, steps) => {
+                if let Some(handle) = self.get_handle(id)? {
+                    handle.progress = handle.progress.max(steps);
+                }
+            },
+            Message::TimeSyncRequest(id) => {
+                // a stale request is useless anyway, so just drop it if nobody answers
+                self.time_sync_requests.enqueue(id).ok();
+            },
+            Message::TimeSyncResponse(id, receive_time, transmit_time) => {
+                self.time_sync_replies.enqueue(TimeSyncReply {
+                    id, receive_time, transmit_time
+                }).ok();
+            },
+            Message::Telemetry(sample) => enqueue_latest(&mut self.telemetry, sample),
+            Message::LineSensor(reading) => enqueue_latest(&mut self.line_sensor, reading)
         };
         Ok(())
     }
 
+    /// Handles a retransmission of a command received before, the reply to which has been lost:
+    /// the latest one is sent again, nothing yet if the command is still waiting to be executed.
+    /// A full send queue is fine, the sender retries. Returns whether the command is known.
+    fn resend_reply(&mut self, id: IdType, compact: bool) -> bool {
+        let reply = if let Some(handle) = self.commands.get(&id) {
+            match (handle.status, handle.start_time) {
+                (CommandExecutionStatus::Started, Some(time)) => Some(Message::Ack(id, time)),
+                _ => None
+            }
+        } else if let Some((_, rejected)) = self.executed.as_slice().iter().find(|(executed, _)| *executed == id) {
+            Some(if *rejected { Message::Rejected(id) } else { Message::Done(id) })
+        } else {
+            return false;
+        };
+        if let Some(reply) = reply {
+            self.send_message(&reply, compact).ok();
+        }
+        true
+    }
+
+    fn get_handle(&mut self, id: IdType) -> Result<Option<&mut CommandHandle>, UpdateErorr> {
+        if !self.commands.contains_key(&id) && self.forgotten.as_slice().contains(&id) {
+            return Ok(None);
+        }
+        self.commands.get_mut(&id).map(Some).ok_or(UpdateErorr::BadId(id))
+    }
+
     pub fn retry_timed_out(&mut self, time: u32) -> Result<(), MessageSerializeErorr> {
         // TODO: this sucks but i cannot call send_message right in the loop
         //       because both iterator and the method mutably borrow self
-        let mut commands: heapless::Vec<Message, REGISTRY_CAPACITY> = heapless::Vec::new();
+        let mut commands: heapless::Vec<(bool, bool, Message), REGISTRY_CAPACITY> = heapless::Vec::new();
 
         for (id, cmd) in self.commands.iter_mut() {
             if cmd.status == CommandExecutionStatus::NotStarted{
                 if let Some(enqueue_time) = cmd.enqueue_time {
-                    if time.wrapping_sub(enqueue_time) > RETRY_TIMEOUT {
-                        commands.push(Message::Command(*id, cmd.command)).unwrap();
+                    let timeout = if cmd.priority { PRIORITY_RETRY_TIMEOUT } else { RETRY_TIMEOUT };
+                    if time.wrapping_sub(enqueue_time) > timeout {
+                        commands.push((cmd.priority, cmd.compact,
+                                       Message::Command(*id, cmd.command))).unwrap();
                         cmd.enqueue_time = Some(time);
                     }
                 }
             }
         }
 
-        for cmd in commands {
-            self.send_message(&cmd)?;
+        for (priority, compact, cmd) in commands {
+            if priority {
+                // a stale copy is as good as a new one, so a full queue is fine
+                self.priority_send.enqueue(Self::encode_message(&cmd, compact)?).ok();
+            } else {
+                match self.send_message(&cmd, compact) {
+                    // retried on the next timeout
+                    Ok(()) | Err(SendErorr::QueueFull) => {},
+                    Err(SendErorr::Serialize(e)) => return Err(e)
+                }
+            }
         }
 
         Ok(())
     }
 
     pub fn get_message_to_send(&mut self) -> Option<MessageBuffer> {
-        self.send.dequeue()
+        if let Some(msg) = self.priority_send.dequeue() {
+            return Some(msg);
+        }
+        if let Some((id, steps)) = self.progress_to_send.take() {
+            // cannot fail, the message is a few bytes long
+            return Self::encode_message(&Message::Progress(id, steps), false).ok();
+        }
+        if let Some((_, msg)) = self.send.dequeue() {
+            return Some(msg);
+        }
+        self.telemetry_to_send.take().or_else(|| self.line_sensor_to_send.take())
     }
 
     pub fn is_finished(&self, id: CommandId) -> bool {
         self.commands[&id].status == CommandExecutionStatus::Finished
     }
 
+    /// The other side cannot execute the command, see reject. It has to be ack_finish'ed too
+    pub fn is_rejected(&self, id: CommandId) -> bool {
+        self.commands[&id].status == CommandExecutionStatus::Rejected
+    }
+
     pub fn get_command(&self, id: CommandId) -> Command {
         self.commands[&id].command
     }
 
-    pub fn start_executing(&mut self, id: CommandId) {
-        self.commands[&id].status = CommandExecutionStatus::Started;
-        self.send_message(&Message::Ack(id.into())).unwrap();
+    /// Number of the finished steps of a batch, as reported by the other side
+    pub fn get_progress(&self, id: CommandId) -> u8 {
+        self.commands[&id].progress
+    }
+
+    /// Time at which the other side has started executing the command (in its own clock)
+    pub fn get_start_time(&self, id: CommandId) -> Option<TimeType> {
+        self.commands[&id].start_time
+    }
+
+    /// Whether the replies to a command, its ack and done, fit the send queue.
+    /// A command should be left waiting until they do, see start_executing
+    pub fn can_reply(&self) -> bool {
+        self.send.capacity() - self.send.len() >= 2
+    }
+
+    pub fn start_executing(&mut self, id: CommandId, time: TimeType) -> Result<(), SendErorr> {
+        let handle = &mut self.commands[&id];
+        handle.status = CommandExecutionStatus::Started;
+        handle.start_time = Some(time);
+        let compact = handle.compact;
+        self.send_message(&Message::Ack(id.into(), time), compact)
+    }
+
+    /// Reports that the given number of a batch's steps are done, replaces a report not sent yet
+    pub fn report_progress(&mut self, id: CommandId, steps: u8) {
+        self.commands[&id].progress = steps;
+        self.progress_to_send = Some((*id, steps));
+    }
+
+    pub fn finish_executing(&mut self, id: CommandId) -> Result<(), SendErorr> {
+        let compact = self.commands[&id].compact;
+        self.send_message(&Message::Done(id.into()), compact)?;
+
+        self.commands.remove(&id);
+        self.executed.write((*id, false));
+
+        Ok(())
     }
 
-    pub fn finish_executing(&mut self, id: CommandId) -> Result<(), MessageSerializeErorr> {
-        self.send_message(&Message::Done(id.into()))?;
+    /// Replies instead of start_executing when the command cannot be executed,
+    /// the sender's future fails instead of resolving
+    pub fn reject(&mut self, id: CommandId) -> Result<(), SendErorr> {
+        let compact = self.commands[&id].compact;
+        self.send_message(&Message::Rejected(id.into()), compact)?;
 
         self.commands.remove(&id);
+        self.executed.write((*id, true));
 
         Ok(())
     }
 
     pub fn ack_finish(&mut self, id: CommandId) {
         self.commands.remove(&id);
+        self.forgotten.write(*id);
     }
 
     pub fn get_command_to_execute(&mut self) -> Option<CommandId> {
         self.waiting_execute.dequeue()
     }
 
+    // time sync messages bypass the send queue: a timestamp is only meaningful
+    // if the message is written to the port right after it was taken
+
+    pub fn time_sync_request(&mut self) -> Result<(IdType, MessageBuffer), MessageSerializeErorr> {
+        let id = self.next_time_sync_id;
+        self.next_time_sync_id = self.next_time_sync_id.wrapping_add(1);
+
+        Ok((id, Self::encode_message(&Message::TimeSyncRequest(id), false)?))
+    }
+
+    pub fn get_time_sync_request(&mut self) -> Option<IdType> {
+        self.time_sync_requests.dequeue()
+    }
+
+    pub fn time_sync_response(&self, id: IdType,
+                              receive_time: TimeType,
+                              transmit_time: TimeType) -> Result<MessageBuffer, MessageSerializeErorr> {
+        Self::encode_message(&Message::TimeSyncResponse(id, receive_time, transmit_time), false)
+    }
+
+    pub fn get_time_sync_reply(&mut self) -> Option<TimeSyncReply> {
+        self.time_sync_replies.dequeue()
+    }
+
+    /// Sends the sample after the queued messages, replaces a sample not sent yet
+    pub fn send_telemetry(&mut self, sample: &Telemetry) -> Result<(), MessageSerializeErorr> {
+        self.telemetry_to_send = Some(Self::encode_message(&Message::Telemetry(*sample), false)?);
+        Ok(())
+    }
+
+    pub fn get_telemetry(&mut self) -> Option<Telemetry> {
+        self.telemetry.dequeue()
+    }
+
+    /// Like send_telemetry
+    pub fn send_line_sensor(&mut self, reading: &LineSensorReading) -> Result<(), MessageSerializeErorr> {
+        self.line_sensor_to_send = Some(Self::encode_message(&Message::LineSensor(*reading), false)?);
+        Ok(())
+    }
+
+    pub fn get_line_sensor(&mut self) -> Option<LineSensorReading> {
+        self.line_sensor.dequeue()
+    }
+
     fn add_message_preamble(msg: &mut MessageBuffer) {
         let mut tmp = MessageBuffer::new();
         tmp.push(START_BYTE).unwrap();
@@ -171,13 +577,25 @@ impl Interfacing {
         *msg = take(&mut tmp);
     }
 
-    fn send_message(&mut self, msg: &Message) -> Result<(), MessageSerializeErorr> {
+    /// Messages without a compact form are always encoded in full
+    fn encode_message(msg: &Message, compact: bool) -> Result<MessageBuffer, MessageSerializeErorr> {
+        if compact {
+            if let Some(compact) = CompactMessage::from_message(msg) {
+                return Ok(compact.encode());
+            }
+        }
         let mut encoded = msg.serialize()?;
         Self::add_message_preamble(&mut encoded);
-        let encoded = encoded;
-        self.send.enqueue(encoded).unwrap();
+        Ok(encoded)
+    }
 
-        Ok(())
+    fn send_message(&mut self, msg: &Message, compact: bool) -> Result<(), SendErorr> {
+        let encoded = Self::encode_message(msg, compact)?;
+        let id = match msg {
+            Message::Command(id, _) => Some(*id),
+            _ => None
+        };
+        self.send.enqueue((id, encoded)).map_err(|_| SendErorr::QueueFull)
     }
 }
 
@@ -186,6 +604,22 @@ enum ReceiveStatus {
     NotStarted,
     Started,
     Receiving(usize),
+    CompactStarted,
+    /// kind and the number of bytes after it
+    CompactReceiving(u8, usize),
+}
+
+enum Received {
+    Full(Message),
+    Compact(CompactMessage),
+}
+
+/// For the streams, where the newest samples matter: the oldest one makes room
+fn enqueue_latest<T, const N: usize>(queue: &mut Queue<T, N>, item: T) {
+    if queue.is_full() {
+        queue.dequeue();
+    }
+    queue.enqueue(item).ok();
 }
 
 #[derive(Debug, Clone, Copy)]
@@ -204,18 +638,24 @@ impl From<CommandId> for IdType {
     fn from(id: CommandId) -> Self { *id }
 }
 
-#[derive(Debug, PartialEq)]
+#[derive(Debug, Clone, Copy, PartialEq)]
 enum CommandExecutionStatus {
     NotStarted,
     Started,
-    Finished
+    Finished,
+    Rejected
 }
 
 #[derive(Debug)]
 pub struct CommandHandle {
     pub(crate) status: CommandExecutionStatus,
     pub(crate) command: Command,
-    pub(crate) enqueue_time: Option<u32>
+    pub(crate) enqueue_time: Option<u32>,
+    pub(crate) start_time: Option<TimeType>,
+    pub(crate) priority: bool,
+    // the framing of the command, its acks are sent the same way
+    pub(crate) compact: bool,
+    pub(crate) progress: u8
 }
 
 impl CommandHandle {
@@ -223,15 +663,53 @@ impl CommandHandle {
         Self {
             status: CommandExecutionStatus::NotStarted,
             command,
-            enqueue_time
+            enqueue_time,
+            start_time: None,
+            priority: false,
+            compact: false,
+            progress: 0
         }
     }
 }
 
+/// NTP-style exchange: the requester knows when it has sent the request
+/// and received the reply, the other side reports when it has received the request
+/// and sent the reply
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub struct TimeSyncReply {
+    pub id: IdType,
+    pub receive_time: TimeType,
+    pub transmit_time: TimeType
+}
+
 #[derive(Debug)]
 pub enum UpdateErorr {
     Decode(MessageDeserializeErorr),
-    BadId(IdType)
+    BadId(IdType),
+    /// A command has been received while the registry is full, it is dropped
+    RegistryFull(IdType),
+    /// The length byte of a frame is out of range, the frame is skipped
+    BadLength(usize),
+    Compact(CompactDecodeError)
+}
+
+#[derive(Debug)]
+pub enum SendErorr {
+    Serialize(MessageSerializeErorr),
+    /// The send queue is full, the message has not been queued
+    QueueFull
+}
+
+impl From<MessageSerializeErorr> for SendErorr {
+    fn from(err: MessageSerializeErorr) -> Self {
+        Self::Serialize(err)
+    }
+}
+
+impl From<CompactDecodeError> for UpdateErorr {
+    fn from(err: CompactDecodeError) -> Self {
+        Self::Compact(err)
+    }
 }
 
 impl From<MessageDeserializeErorr> for UpdateErorr {
@@ -243,6 +721,7 @@ impl From<MessageDeserializeErorr> for UpdateErorr {
 #[cfg(test)]
 mod tests {
     use super::*;
+    use crate::commands::SetSpeedParams;
     use std::vec::Vec;
 
     fn consume_message(i: &mut Interfacing, msg: &Message) {
@@ -259,7 +738,7 @@ mod tests {
         let id = i.execute(Command::Stop, None).unwrap();
         assert!(!i.is_finished(id));
 
-        i.start_executing(id);
+        i.start_executing(id, 0).unwrap();
         let cmd = i.get_command(id);
         assert_eq!(cmd, Command::Stop);
 
@@ -287,6 +766,509 @@ mod tests {
         assert!(i.is_finished(id));
     }
 
+    #[test]
+    fn ack_start_time_test() {
+        let mut i = Interfacing::new();
+        let id = i.execute(Command::Stop, None).unwrap();
+        assert_eq!(i.get_start_time(id), None);
+
+        consume_message(&mut i, &Message::Ack(*id, 1234));
+        assert!(!i.is_finished(id));
+        assert_eq!(i.get_start_time(id), Some(1234));
+    }
+
+    #[test]
+    fn time_sync_test() {
+        let mut host = Interfacing::new();
+        let mut embedded = Interfacing::new();
+
+        let (id, request) = host.time_sync_request().unwrap();
+        // requests are written directly, not queued
+        assert!(host.get_message_to_send().is_none());
+
+        for byte in request {
+            embedded.handle_received_byte(byte).unwrap();
+        }
+        assert_eq!(embedded.get_time_sync_request(), Some(id));
+        assert!(embedded.get_time_sync_request().is_none());
+        assert!(embedded.get_command_to_execute().is_none());
+
+        let response = embedded.time_sync_response(id, 100, 142).unwrap();
+        for byte in response {
+            host.handle_received_byte(byte).unwrap();
+        }
+        assert_eq!(host.get_time_sync_reply(), Some(TimeSyncReply {
+            id, receive_time: 100, transmit_time: 142
+        }));
+        assert!(host.get_time_sync_reply().is_none());
+
+        let (next_id, _) = host.time_sync_request().unwrap();
+        assert_ne!(id, next_id);
+    }
+
+    #[test]
+    fn largest_batch_framing_test() {
+        use crate::commands::{CommandBatch, Step, MAX_BATCH_STEPS};
+
+        // speeds of 126 and more take three bytes, ids of 251 and more five
+        let mut encoded = 0;
+        for steps in 1..=MAX_BATCH_STEPS {
+            for speed in [0, 126, i32::MAX] {
+                let step = Step::SetSpeed(SetSpeedParams { left: -speed, right: speed });
+                let batch = Command::Batch(CommandBatch::new(&[step; MAX_BATCH_STEPS][..steps]).unwrap());
+                let msg = Message::Command(IdType::MAX, batch);
+
+                let frame = match Interfacing::encode_message(&msg, false) {
+                    Ok(frame) => frame,
+                    Err(MessageSerializeErorr::Encode(_)) => continue
+                };
+                assert!(frame.len() <= MAX_MESSAGE_LEN);
+                encoded += 1;
+
+                let mut embedded = Interfacing::new();
+                for byte in frame {
+                    embedded.handle_received_byte(byte).unwrap();
+                }
+                let id = embedded.get_command_to_execute().unwrap();
+                assert_eq!(embedded.get_command(id), batch);
+            }
+        }
+        assert!(encoded > 0);
+    }
+
+    #[test]
+    fn telemetry_test() {
+        let mut embedded = Interfacing::new();
+        let mut host = Interfacing::new();
+        // a queue of N holds N - 1
+        let kept = TELEMETRY_QUEUE_SIZE - 1;
+
+        let samples = (0..kept as u32 + 2).map(|t| Telemetry {
+            time: t, left_position: t as f32, right_position: -(t as f32),
+            left_speed: 1.5, right_speed: -1.5
+        });
+        for sample in samples.clone() {
+            embedded.send_telemetry(&sample).unwrap();
+            for byte in embedded.get_message_to_send().unwrap() {
+                host.handle_received_byte(byte).unwrap();
+            }
+        }
+
+        // the oldest ones are dropped
+        let received: Vec<_> = core::iter::from_fn(|| host.get_telemetry()).collect();
+        let expected: Vec<_> = samples.skip(2).collect();
+        assert_eq!(received.len(), kept);
+        assert_eq!(received, expected);
+        assert!(host.get_message_to_send().is_none());
+    }
+
+    #[test]
+    fn streams_after_queued_test() {
+        let mut embedded = Interfacing::new();
+        let sample = |time| Telemetry {
+            time, left_position: 0.0, right_position: 0.0, left_speed: 0.0, right_speed: 0.0
+        };
+        let reading = LineSensorReading { time: 3, values: [7; crate::message::LINE_SENSORS] };
+        embedded.send_line_sensor(&reading).unwrap();
+        embedded.send_telemetry(&sample(1)).unwrap();
+        let id = embedded.execute(Command::Stop, None).unwrap();
+        embedded.send_telemetry(&sample(2)).unwrap();
+
+        let sent: Vec<_> = core::iter::from_fn(|| embedded.get_message_to_send())
+            .map(|msg| Message::deserialize(&msg[2..]).unwrap())
+            .collect();
+        // only the latest sample of a stream is sent
+        assert_eq!(sent, [Message::Command(*id, Command::Stop),
+                          Message::Telemetry(sample(2)),
+                          Message::LineSensor(reading)]);
+    }
+
+    #[test]
+    fn emergency_stop_drops_queued_motion_test() {
+        let mut i = Interfacing::new();
+        let speed = Command::SetSpeed(SetSpeedParams { left: 100, right: 100 });
+        let first = i.execute(speed, Some(0)).unwrap();
+        let gripper = i.execute(Command::OpenGripper, Some(0)).unwrap();
+        let second = i.execute(speed, Some(0)).unwrap();
+
+        let (stop, msg, dropped) = i.emergency_stop(Some(0)).unwrap();
+        let dropped: Vec<IdType> = dropped.iter().map(|id| **id).collect();
+        assert!(dropped.contains(&*first) && dropped.contains(&*second));
+        assert!(!dropped.contains(&*gripper));
+        assert_eq!(i.get_command(stop), Command::Stop);
+
+        // only the gripper command is left in the queue
+        let queued = i.get_message_to_send().unwrap();
+        assert!(i.get_message_to_send().is_none());
+        let mut embedded = Interfacing::new();
+        for byte in queued.into_iter().chain(msg) {
+            embedded.handle_received_byte(byte).unwrap();
+        }
+        let executed = embedded.get_command_to_execute().unwrap();
+        assert_eq!(embedded.get_command(executed), Command::OpenGripper);
+        let executed = embedded.get_command_to_execute().unwrap();
+        assert_eq!(embedded.get_command(executed), Command::Stop);
+
+        // the dropped command may have been on the wire already
+        consume_message(&mut i, &Message::Done(*first));
+    }
+
+    #[test]
+    fn emergency_stop_retry_test() {
+        let mut i = Interfacing::new();
+        let (stop, _, _) = i.emergency_stop(Some(0)).unwrap();
+
+        i.retry_timed_out(PRIORITY_RETRY_TIMEOUT).unwrap();
+        assert!(i.get_message_to_send().is_none());
+        i.retry_timed_out(PRIORITY_RETRY_TIMEOUT + 1).unwrap();
+        assert!(i.get_message_to_send().is_some());
+
+        consume_message(&mut i, &Message::Ack(*stop, 10));
+        i.retry_timed_out(10 * PRIORITY_RETRY_TIMEOUT).unwrap();
+        assert!(i.get_message_to_send().is_none());
+    }
+
+    #[test]
+    fn reject_test() {
+        let mut host = Interfacing::new();
+        let mut embedded = Interfacing::new();
+        let id = host.execute(Command::OpenGripper, Some(0)).unwrap();
+        for byte in host.get_message_to_send().unwrap() {
+            embedded.handle_received_byte(byte).unwrap();
+        }
+
+        let received = embedded.get_command_to_execute().unwrap();
+        embedded.reject(received).unwrap();
+        for byte in embedded.get_message_to_send().unwrap() {
+            host.handle_received_byte(byte).unwrap();
+        }
+        assert!(host.is_rejected(id) && !host.is_finished(id));
+
+        // not retried
+        host.retry_timed_out(RETRY_TIMEOUT + 1).unwrap();
+        assert!(host.get_message_to_send().is_none());
+        host.ack_finish(id);
+    }
+
+    #[test]
+    fn commands_wait_for_room_to_reply_test() {
+        let mut embedded = Interfacing::new();
+        // back to back, faster than their replies are written
+        let count = 3;
+        for id in 0..count {
+            consume_message(&mut embedded, &Message::Command(id, Command::Stop));
+        }
+
+        // like the executor of the firmware
+        let execute_waiting = |i: &mut Interfacing| {
+            let mut executed = 0;
+            while i.can_reply() {
+                let Some(id) = i.get_command_to_execute() else { break };
+                i.start_executing(id, 0).unwrap();
+                i.finish_executing(id).unwrap();
+                executed += 1;
+            }
+            executed
+        };
+        // a queue of N holds N - 1, the replies of two commands
+        let mut executed = execute_waiting(&mut embedded);
+        assert_eq!(executed, 2);
+
+        let mut replies = 0;
+        while embedded.get_message_to_send().is_some() {
+            replies += 1;
+            executed += execute_waiting(&mut embedded);
+        }
+        assert_eq!(executed, count);
+        assert_eq!(replies, 2 * count);
+    }
+
+    #[test]
+    fn full_send_queue_test() {
+        let mut i = Interfacing::new();
+        for _ in 0..INTERFACING_QUEUE_SIZE - 1 {
+            i.execute(Command::OpenGripper, Some(0)).unwrap();
+        }
+        assert!(matches!(i.execute(Command::OpenGripper, Some(0)), Err(SendErorr::QueueFull)));
+    }
+
+    #[test]
+    fn emergency_stop_full_registry_test() {
+        let mut i = Interfacing::new();
+        let gripper = i.execute(Command::OpenGripper, Some(0)).unwrap();
+        let mut started = Vec::new();
+        for _ in 1..REGISTRY_CAPACITY {
+            let id = i.execute(Command::Stop, Some(0)).unwrap();
+            consume_message(&mut i, &Message::Ack(*id, 0));
+            started.push(id);
+        }
+
+        // nothing to drop, the queued gripper command makes room
+        let (stop, _, dropped) = i.emergency_stop(Some(0)).unwrap();
+        assert_eq!(dropped.iter().map(|id| **id).collect::<Vec<_>>(), [*gripper]);
+        assert_eq!(i.get_command(stop), Command::Stop);
+        consume_message(&mut i, &Message::Done(*gripper));
+        consume_message(&mut i, &Message::Ack(*stop, 0));
+
+        // and with the started ones only, the oldest of them
+        let (_, _, dropped) = i.emergency_stop(Some(0)).unwrap();
+        assert_eq!(dropped.iter().map(|id| **id).collect::<Vec<_>>(), [*started[0]]);
+        consume_message(&mut i, &Message::Done(*started[0]));
+    }
+
+    #[test]
+    fn full_registry_receive_test() {
+        let mut embedded = Interfacing::new();
+        for id in 0..REGISTRY_CAPACITY as IdType {
+            consume_message(&mut embedded, &Message::Command(id, Command::OpenGripper));
+        }
+        // a retransmission still fits, and is not queued again
+        consume_message(&mut embedded, &Message::Command(0, Command::OpenGripper));
+        for id in 0..REGISTRY_CAPACITY as IdType {
+            assert_eq!(*embedded.get_command_to_execute().unwrap(), id);
+        }
+        assert!(embedded.get_command_to_execute().is_none());
+
+        let mut msg = Message::Command(REGISTRY_CAPACITY as IdType, Command::Stop).serialize().unwrap();
+        Interfacing::add_message_preamble(&mut msg);
+        let errors: Vec<_> = msg.into_iter().filter_map(|byte| embedded.handle_received_byte(byte).err()).collect();
+        assert!(matches!(&errors[..], [UpdateErorr::RegistryFull(id)] if *id == REGISTRY_CAPACITY as IdType));
+    }
+
+    #[test]
+    fn retransmitted_command_test() {
+        let mut embedded = Interfacing::new();
+        let sent = |i: &mut Interfacing| {
+            let mut messages = Vec::new();
+            while let Some(msg) = i.get_message_to_send() {
+                messages.push(Message::deserialize(&msg[2..]).unwrap());
+            }
+            messages
+        };
+
+        consume_message(&mut embedded, &Message::Command(0, Command::Stop));
+        // still waiting, it is acknowledged once started
+        consume_message(&mut embedded, &Message::Command(0, Command::Stop));
+        let id = embedded.get_command_to_execute().unwrap();
+        assert!(embedded.get_command_to_execute().is_none());
+
+        embedded.start_executing(id, 7).unwrap();
+        sent(&mut embedded);
+        // the ack got lost
+        consume_message(&mut embedded, &Message::Command(0, Command::Stop));
+        assert_eq!(sent(&mut embedded), [Message::Ack(0, 7)]);
+
+        embedded.finish_executing(id).unwrap();
+        sent(&mut embedded);
+        // so did the done, the command is not executed again
+        consume_message(&mut embedded, &Message::Command(0, Command::Stop));
+        assert!(embedded.get_command_to_execute().is_none());
+        assert_eq!(sent(&mut embedded), [Message::Done(0)]);
+
+        consume_message(&mut embedded, &Message::Command(1, Command::OpenGripper));
+        let id = embedded.get_command_to_execute().unwrap();
+        embedded.reject(id).unwrap();
+        sent(&mut embedded);
+        consume_message(&mut embedded, &Message::Command(1, Command::OpenGripper));
+        assert!(embedded.get_command_to_execute().is_none());
+        assert_eq!(sent(&mut embedded), [Message::Rejected(1)]);
+    }
+
+    #[test]
+    fn priority_messages_go_first_test() {
+        let mut i = Interfacing::new();
+        i.execute(Command::OpenGripper, Some(0)).unwrap();
+        let (stop, _, _) = i.emergency_stop(Some(0)).unwrap();
+        i.retry_timed_out(PRIORITY_RETRY_TIMEOUT + 1).unwrap();
+
+        let first = i.get_message_to_send().unwrap();
+        let message = Message::deserialize(&first[2..]).unwrap();
+        assert_eq!(message, Message::Command(*stop, Command::Stop));
+    }
+
+    #[test]
+    fn late_done_of_finished_command_test() {
+        let mut i = Interfacing::new();
+        let id = i.execute(Command::Stop, None).unwrap();
+        consume_message(&mut i, &Message::Done(*id));
+        i.ack_finish(id);
+        // a retransmitted command is executed and reported again
+        consume_message(&mut i, &Message::Done(*id));
+
+        let mut msg = Message::Done(12345).serialize().unwrap();
+        Interfacing::add_message_preamble(&mut msg);
+        let results: Vec<_> = msg.into_iter().map(|b| i.handle_received_byte(b)).collect();
+        assert!(matches!(results.last(), Some(Err(UpdateErorr::BadId(12345)))));
+    }
+
+    fn sync_frames(ids: core::ops::Range<IdType>) -> Vec<Vec<u8>> {
+        let i = Interfacing::new();
+        ids.map(|id| i.time_sync_response(id, 0, 0).unwrap().into_iter().collect()).collect()
+    }
+
+    fn received_replies(i: &mut Interfacing, stream: &[u8]) -> (Vec<IdType>, usize) {
+        let mut ids = Vec::new();
+        let mut errors = 0;
+        for byte in stream {
+            if i.handle_received_byte(*byte).is_err() {
+                errors += 1;
+            }
+            while let Some(reply) = i.get_time_sync_reply() {
+                ids.push(reply.id);
+            }
+        }
+        (ids, errors)
+    }
+
+    #[test]
+    fn bad_length_resync_test() {
+        let mut i = Interfacing::new();
+        let frames = sync_frames(0..1);
+        // the length would make the receiver wait for 255 bytes
+        let stream: Vec<u8> = [START_BYTE, 255].into_iter().chain(frames[0].clone()).collect();
+
+        let (ids, errors) = received_replies(&mut i, &stream);
+        assert_eq!(ids, [0]);
+        assert_eq!(errors, 1);
+    }
+
+    #[test]
+    fn start_byte_as_length_test() {
+        let mut i = Interfacing::new();
+        let frames = sync_frames(0..1);
+        let stream: Vec<u8> = [START_BYTE].into_iter().chain(frames[0].clone()).collect();
+
+        let (ids, _) = received_replies(&mut i, &stream);
+        assert_eq!(ids, [0]);
+    }
+
+    #[test]
+    fn spurious_frame_resync_test() {
+        let mut i = Interfacing::new();
+        let frames = sync_frames(0..2);
+        // a fake frame which covers the real one and a part of the next one
+        let fake_len = frames[0].len() + 3;
+        let stream: Vec<u8> = [START_BYTE, fake_len as u8].into_iter()
+            .chain(frames.concat())
+            .collect();
+
+        let (ids, errors) = received_replies(&mut i, &stream);
+        assert_eq!(ids, [0, 1]);
+        assert_eq!(errors, 1);
+    }
+
+    #[test]
+    fn dropped_byte_resync_test() {
+        let mut i = Interfacing::new();
+        let mut frames = sync_frames(0..6);
+        frames[0].remove(4);
+
+        let (ids, _) = received_replies(&mut i, &frames.concat());
+        // the broken frame eats the start of the next one, which is scanned again;
+        // whatever else is lost, the receiver is in sync by the end
+        assert_eq!(ids.last(), Some(&5));
+        assert!(ids.contains(&1) || ids.contains(&2));
+    }
+
+    #[test]
+    fn compact_command_exchange_test() {
+        let mut host = Interfacing::new();
+        host.set_compact(true);
+        let mut embedded = Interfacing::new();
+        // the short ids wrap around
+        host.next_id = 0x1FE;
+
+        let speed = Command::SetSpeed(SetSpeedParams { left: 300, right: -300 });
+        let id = host.execute(speed, Some(0)).unwrap();
+        let msg = host.get_message_to_send().unwrap();
+        assert_eq!(msg[0], COMPACT_START_BYTE);
+        for byte in msg {
+            embedded.handle_received_byte(byte).unwrap();
+        }
+
+        let received = embedded.get_command_to_execute().unwrap();
+        assert_eq!(embedded.get_command(received), speed);
+        embedded.start_executing(received, 1234).unwrap();
+        embedded.finish_executing(received).unwrap();
+
+        while let Some(msg) = embedded.get_message_to_send() {
+            assert_eq!(msg[0], COMPACT_START_BYTE);
+            for byte in msg {
+                host.handle_received_byte(byte).unwrap();
+            }
+        }
+        assert!(host.is_finished(id));
+        assert_eq!(host.get_start_time(id), Some(1234));
+    }
+
+    #[test]
+    fn compact_only_for_hot_messages_test() {
+        let mut host = Interfacing::new();
+        host.set_compact(true);
+        host.execute(Command::OpenGripper, Some(0)).unwrap();
+        assert_eq!(host.get_message_to_send().unwrap()[0], START_BYTE);
+
+        let fast = Command::SetSpeed(SetSpeedParams { left: 100_000, right: 0 });
+        host.execute(fast, Some(0)).unwrap();
+        assert_eq!(host.get_message_to_send().unwrap()[0], START_BYTE);
+    }
+
+    #[test]
+    fn batch_test() {
+        use crate::commands::{CommandBatch, Step};
+
+        let mut host = Interfacing::new();
+        let mut embedded = Interfacing::new();
+
+        let steps = [Step::LowerGripper, Step::OpenGripper, Step::CloseGripper, Step::LiftGripper];
+        let batch = Command::Batch(CommandBatch::new(&steps).unwrap());
+        let id = host.execute(batch, Some(0)).unwrap();
+        assert!(!batch.is_motion());
+
+        for byte in host.get_message_to_send().unwrap() {
+            embedded.handle_received_byte(byte).unwrap();
+        }
+        let received = embedded.get_command_to_execute().unwrap();
+        let received_batch = match embedded.get_command(received) {
+            Command::Batch(batch) => batch,
+            other => panic!("Expected a batch, got {:?}", other)
+        };
+        assert_eq!(received_batch.steps().collect::<Vec<_>>(), steps);
+
+        embedded.start_executing(received, 10).unwrap();
+        embedded.report_progress(received, 1);
+        embedded.report_progress(received, 2);
+        while let Some(msg) = embedded.get_message_to_send() {
+            for byte in msg {
+                host.handle_received_byte(byte).unwrap();
+            }
+        }
+        // the reports are coalesced
+        assert_eq!(host.get_progress(id), 2);
+        assert!(!host.is_finished(id));
+
+        embedded.report_progress(received, 4);
+        embedded.finish_executing(received).unwrap();
+        while let Some(msg) = embedded.get_message_to_send() {
+            for byte in msg {
+                host.handle_received_byte(byte).unwrap();
+            }
+        }
+        assert_eq!(host.get_progress(id), 4);
+        assert!(host.is_finished(id));
+    }
+
+    #[test]
+    fn batch_steps_test() {
+        use crate::commands::{CommandBatch, Step, MAX_BATCH_STEPS};
+
+        assert!(CommandBatch::new(&[Step::Stop; MAX_BATCH_STEPS + 1]).is_none());
+        let batch = CommandBatch::new(&[Step::OpenGripper, Step::Stop]).unwrap();
+        assert_eq!(batch.len(), 2);
+        assert!(Command::Batch(batch).is_motion());
+        assert!(Step::try_from(Command::Batch(batch)).is_err());
+    }
+
     #[test]
     fn many_commands_test() {
         let mut i = Interfacing::new();
@@ -5,15 +5,42 @@ use heapless::Vec;
 
 pub const MAX_MESSAGE_LEN: usize = 40;  
 pub const ECC_LEN: usize = 8;
+/// The start byte and the length, see Interfacing::add_message_preamble
+pub const PREAMBLE_LEN: usize = 2;
+
+pub const LINE_SENSORS: usize = 6;
 
 pub type MessageBuffer = Vec<u8, MAX_MESSAGE_LEN>;
 pub type IdType = u32;
+/// Microseconds of the embedded monotonic clock, wraps around every ~71 minutes
+pub type TimeType = u32;
 
 #[derive(Encode, Decode, PartialEq, Debug)]
 pub enum Message {
     Command(IdType, Command),
-    Ack(IdType),
+    /// Carries the embedded time at which the command has started executing
+    Ack(IdType, TimeType),
     Done(IdType),
+    TimeSyncRequest(IdType),
+    /// Embedded times at which the request was received and the response was sent
+    TimeSyncResponse(IdType, TimeType, TimeType),
+    /// Number of the finished steps of a batch
+    Progress(IdType, u8),
+    Telemetry(Telemetry),
+    LineSensor(LineSensorReading),
+    /// The command cannot be executed by the receiving side, none of it has been
+    Rejected(IdType),
+}
+
+/// The wheels' state, sent periodically by the embedded side.
+/// Positions and speeds are in the units of SetSpeedParams
+#[derive(Encode, Decode, PartialEq, Debug, Clone, Copy)]
+pub struct Telemetry {
+    pub time: TimeType,
+    pub left_position: f32,
+    pub right_position: f32,
+    pub left_speed: f32,
+    pub right_speed: f32
 }
 
 impl Message {
@@ -23,7 +50,10 @@ impl Message {
 
         let reed_solomon_encoder = reed_solomon::Encoder::new(ECC_LEN);
 
-        let data_size = bincode::encode_into_slice(self, &mut buffer[..], Self::get_config())?;
+        // the parity and the preamble have to fit too, a longer message is an encode error
+        let data_size = bincode::encode_into_slice(self,
+                                                   &mut buffer[..MAX_MESSAGE_LEN - PREAMBLE_LEN - ECC_LEN],
+                                                   Self::get_config())?;
         let reed_solomon_encoded = reed_solomon_encoder.encode(&buffer[..data_size]);
 
         buffer.resize(reed_solomon_encoded.len(), 0).unwrap();
@@ -74,6 +104,13 @@ impl From<DecodeError> for MessageDeserializeErorr {
     }
 }
 
+/// Calibrated reflectance of the line sensors, the leftmost first
+#[derive(Encode, Decode, PartialEq, Debug, Clone, Copy)]
+pub struct LineSensorReading {
+    pub time: TimeType,
+    pub values: [u16; LINE_SENSORS]
+}
+
 #[cfg(test)]
 mod tests {
     use crate::commands::SetSpeedParams;
@@ -91,6 +128,44 @@ mod tests {
         assert_eq!(deserialized, msg)
     }
 
+    #[test]
+    fn batch_fits_test() {
+        use crate::commands::{CommandBatch, Step, MAX_BATCH_STEPS};
+
+        let steps = [Step::OpenGripper; MAX_BATCH_STEPS];
+        let msg = Message::Command(IdType::MAX, Command::Batch(CommandBatch::new(&steps).unwrap()));
+        let serialized = msg.serialize().unwrap();
+        assert_eq!(Message::deserialize(&serialized[..]).unwrap(), msg);
+    }
+
+    #[test]
+    fn telemetry_test() {
+        let msg = Message::Telemetry(Telemetry {
+            time: TimeType::MAX, left_position: -12345.5, right_position: 1e9,
+            left_speed: -300.25, right_speed: 0.0
+        });
+        let serialized = msg.serialize().unwrap();
+        assert_eq!(Message::deserialize(&serialized[..]).unwrap(), msg);
+    }
+
+    #[test]
+    fn line_sensor_fits_test() {
+        let msg = Message::LineSensor(LineSensorReading {
+            time: TimeType::MAX, values: [u16::MAX; LINE_SENSORS]
+        });
+        let serialized = msg.serialize().unwrap();
+        assert_eq!(Message::deserialize(&serialized[..]).unwrap(), msg);
+    }
+
+    #[test]
+    fn too_long_test() {
+        use crate::commands::{CommandBatch, Step, MAX_BATCH_STEPS};
+
+        let step = Step::SetSpeed(SetSpeedParams { left: i32::MIN, right: i32::MIN });
+        let msg = Message::Command(0, Command::Batch(CommandBatch::new(&[step; MAX_BATCH_STEPS]).unwrap()));
+        assert!(msg.serialize().is_err());
+    }
+
     #[test]
     fn deserialize_corrupted_test() {
         let msg = Message::Command(42,
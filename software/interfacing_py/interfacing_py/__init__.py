@@ -1,29 +1,55 @@
 import asyncio
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 import aioserial
 import logging
 
 from .interfacing_py import Interfacing, Command, CommandId, SetSpeedParams, PyCommand, MessageBuffer
+from .clock import ClockSync, host_time
+from .telemetry import LineSensorBuffer, TelemetryBuffer, LINE_SENSOR_DTYPE, TELEMETRY_DTYPE
+
+TIME_SYNC_INTERVAL = 0.5  # s
+TIME_SYNC_STARTUP_INTERVAL = 0.05  # s
+TIME_SYNC_STARTUP_SAMPLES = 8
+SEND_POLL_INTERVAL = 0.01  # s, the sender is woken up right away when something is queued
+RETRY_POLL_INTERVAL = 0.005  # s, the emergency stop is retried every PRIORITY_RETRY_TIMEOUT
+
+
+class CommandRejected(Exception):
+    """The embedded side cannot execute the command, none of it has been executed"""
 
 
 class InterfacingManager:
-    def __init__(self, port: str, loop: asyncio.AbstractEventLoop) -> None:
+    def __init__(self, port: str, loop: asyncio.AbstractEventLoop, compact: bool = False) -> None:
+        """compact - send the speed updates in the compact framing, the firmware has to support it"""
         self._loop = loop or asyncio.get_event_loop()
 
         self._interfacing = Interfacing()
+        self._interfacing.set_compact(compact)
 
         self._logger = logging.Logger(__name__)
         self._serial = aioserial.AioSerial(port, baudrate=self._interfacing.BAUD_RATE)
-        self._command_futures: Dict[CommandId, asyncio.Future] = {}
+        # by the id's value, CommandId objects are not hashable
+        self._command_futures: Dict[int, Tuple[CommandId, asyncio.Future]] = {}
+        self._send_event = asyncio.Event()
+        # batch id -> [steps reported so far, callback]
+        self._progress_callbacks: Dict[int, List] = {}
+
+        self.clock = ClockSync()
+        self._time_sync_sent: Dict[int, float] = {}
+
+        # the wheels' measured state, stamped with host_time
+        self.telemetry = TelemetryBuffer(self.clock)
+        self.line_sensor = LineSensorBuffer(self.clock)
 
         self._tasks = [
             self._loop.create_task(self._updater()),
             self._loop.create_task(self._sender()),
-            self._loop.create_task(self._retry_timed_out())
+            self._loop.create_task(self._retry_timed_out()),
+            self._loop.create_task(self._time_sync())
         ]
 
     def stop(self):
-        for fut in self._command_futures.values():
+        for _, fut in self._command_futures.values():
             fut.cancel()
         for task in self._tasks:
             task.cancel()
@@ -33,43 +59,165 @@ class InterfacingManager:
             try:
                 bytes = await self._serial.read_async(size = 1)
                 self._interfacing.handle_received_byte(bytes[0])
+                received = host_time()
+
+                reply = self._interfacing.get_time_sync_reply()
+                if reply is not None:
+                    self._handle_time_sync_reply(reply, received)
+
+                while (sample := self._interfacing.get_telemetry()) is not None:
+                    self._handle_stream_sample(self.telemetry, sample)
+                while (sample := self._interfacing.get_line_sensor()) is not None:
+                    self._handle_stream_sample(self.line_sensor, sample)
 
-                for handle, future in list(self._command_futures.items()):
+                for id_, (handle, future) in list(self._command_futures.items()):
+                    if id_ in self._progress_callbacks:
+                        self._report_progress(id_, handle)
                     if self._interfacing.is_finished(handle):
-                        future.set_result(None)
+                        self._progress_callbacks.pop(id_, None)
+                        if not future.done():
+                            future.set_result(self._get_start_time(handle))
                         self._interfacing.ack_finish(handle)
-                        del self._command_futures[handle]
+                        del self._command_futures[id_]
+                    elif self._interfacing.is_rejected(handle):
+                        self._progress_callbacks.pop(id_, None)
+                        if not future.done():
+                            future.set_exception(CommandRejected(f"Command {id_} was rejected"))
+                        self._interfacing.ack_finish(handle)
+                        del self._command_futures[id_]
             except Exception:
                 self._logger.exception("Error while running update loop")
 
+    def _report_progress(self, id_: int, handle: CommandId):
+        reported = self._interfacing.get_progress(handle)
+        progress = self._progress_callbacks[id_]
+        if reported > progress[0]:
+            progress[0] = reported
+            try:
+                progress[1](reported)
+            except Exception:
+                self._logger.exception("Error in a progress callback")
+
     async def _sender(self):
         while True:
             try:
-                to_send = self._interfacing.get_message_to_send()
-                if to_send is not None:
-                    print(list(to_send))
+                self._send_event.clear()
+                while (to_send := self._interfacing.get_message_to_send()) is not None:
                     await self._serial.write_async(bytes(to_send))
-                await asyncio.sleep(0.01)
+                try:
+                    await asyncio.wait_for(self._send_event.wait(), SEND_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
             except Exception:
                 self._logger.exception("Error while running send loop")
 
+    async def _time_sync(self):
+        samples = 0
+        while True:
+            try:
+                id_, to_send = self._interfacing.time_sync_request()
+                self._time_sync_sent[id_] = host_time()
+                await self._serial.write_async(bytes(to_send))
+                samples += 1
+            except Exception:
+                self._logger.exception("Error while sending time sync request")
+
+            if samples < TIME_SYNC_STARTUP_SAMPLES:
+                await asyncio.sleep(TIME_SYNC_STARTUP_INTERVAL)
+            else:
+                await asyncio.sleep(TIME_SYNC_INTERVAL)
+
+    def _handle_time_sync_reply(self, reply, received: float):
+        id_, request_received, response_sent = reply
+        sent = self._time_sync_sent.pop(id_, None)
+        if sent is None:
+            self._logger.warning(f"Unexpected time sync reply {id_}")
+            return
+        # replies to the lost requests will never come
+        for stale in [i for i in self._time_sync_sent if i < id_]:
+            del self._time_sync_sent[stale]
+
+        self.clock.add_sample(sent, request_received, response_sent, received)
+
+    def _handle_stream_sample(self, buffer, sample):
+        # cannot be placed in the host timeline before the clocks are synchronized
+        if not self.clock.synchronized:
+            return
+        buffer.append(*sample)
+
+    def _get_start_time(self, handle: CommandId):
+        start_time = self._interfacing.get_start_time(handle)
+        if start_time is None or not self.clock.synchronized:
+            return None
+        return self.clock.to_host(start_time)
+
     async def _retry_timed_out(self):
         while True:
             try:
                 self._interfacing.retry_timed_out()
-                await asyncio.sleep(0.01)
+                self._send_event.set()
+                await asyncio.sleep(RETRY_POLL_INTERVAL)
             except Exception:
                 self._logger.exception("Error while retrying timed out commands")
 
 
     def execute(self, cmd: PyCommand) -> asyncio.Future:
+        """
+        The future resolves to the host time at which the command has started executing,
+        or to None if the clocks are not synchronized yet. It fails with CommandRejected
+        if the embedded side cannot execute the command
+        """
+        return self.execute_with_id(cmd)[1]
+
+    def execute_with_id(self, cmd: PyCommand) -> Tuple[int, asyncio.Future]:
+        """Same as execute, but the command's id is returned too, for logging"""
         handle = self._interfacing.execute(cmd)
         future = self._loop.create_future()
-        self._command_futures[handle] = future
-        return self._command_futures[handle]
+        self._command_futures[int(handle)] = (handle, future)
+        self._send_event.set()
+        return int(handle), future
+
+    def execute_batch(self, steps: Sequence[PyCommand],
+                      on_progress: Optional[Callable[[int], None]] = None) -> Tuple[int, asyncio.Future]:
+        """
+        The steps are executed one after another on the embedded side, with one
+        round trip and one registry slot for the whole sequence.
+        on_progress is called from the loop with the number of the finished steps.
+        The future resolves once the last step is done, to when the first one has started.
+        """
+        id_, future = self.execute_with_id(PyCommand(Command.Batch, list(steps)))
+        if on_progress is not None:
+            self._progress_callbacks[id_] = [0, on_progress]
+        return id_, future
+
+    def emergency_stop(self) -> Tuple[int, asyncio.Future]:
+        """
+        Stop which skips the send queue: the queued motion commands are dropped and
+        their futures are cancelled, so is the one of a command dropped to make room for
+        the stop when the registry is full. The stop is written to the port right away and
+        retransmitted until the embedded side acknowledges it.
+        Must be called from the loop's thread.
+        """
+        handle, to_send, dropped = self._interfacing.emergency_stop()
+        for id_ in map(int, dropped):
+            _, future = self._command_futures.pop(id_)
+            self._progress_callbacks.pop(id_, None)
+            future.cancel()
+
+        future = self._loop.create_future()
+        self._command_futures[int(handle)] = (handle, future)
+        self._loop.create_task(self._write_now(to_send))
+        return int(handle), future
+
+    async def _write_now(self, to_send: MessageBuffer):
+        try:
+            await self._serial.write_async(bytes(to_send))
+        except Exception:
+            self._logger.exception("Error while sending emergency stop")
 
 
 __all__ = [
-        "InterfacingManager",
+        "InterfacingManager", "CommandRejected", "ClockSync", "host_time", "TelemetryBuffer", "TELEMETRY_DTYPE",
+        "LineSensorBuffer", "LINE_SENSOR_DTYPE",
         "Interfacing", "Command", "CommandId", "SetSpeedParams", "PyCommand", "MessageBuffer"
         ]
@@ -0,0 +1,117 @@
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+EMBEDDED_CLOCK_HZ = 1_000_000
+EMBEDDED_CLOCK_WRAP = 2 ** 32
+
+
+def host_time() -> float:
+    """The host timebase: everything on the host side should be stamped with it"""
+    return time.monotonic()
+
+
+class ClockSync:
+    """
+    Estimates offset and drift of the embedded clock relative to the host one
+    from NTP-style exchanges.
+
+    Only a few samples with the smallest round trip delay are used for the fit,
+    since a delayed sample is most likely asymmetric as well.
+    """
+
+    def __init__(self, window: int = 32, best: int = 8) -> None:
+        self._best = best
+        # (host time in the middle of the exchange, offset, round trip delay)
+        self._samples: Deque[Tuple[float, float, float]] = deque(maxlen=window)
+
+        self._last_raw: Optional[int] = None
+        self._last_ticks = 0
+
+        self._offset = 0.0
+        self._drift = 0.0
+        self._ref_time = 0.0
+        self._delay: Optional[float] = None
+
+    @property
+    def synchronized(self) -> bool:
+        return len(self._samples) > 0
+
+    @property
+    def offset(self) -> float:
+        """Embedded time minus host time, in seconds, as of now"""
+        return self._offset_at(host_time())
+
+    @property
+    def drift(self) -> float:
+        """How much faster the embedded clock runs, in seconds per second"""
+        return self._drift
+
+    @property
+    def delay(self) -> Optional[float]:
+        """The smallest round trip delay seen recently"""
+        return self._delay
+
+    def unwrap(self, raw: int) -> float:
+        """
+        Converts a wrapping embedded timestamp to seconds.
+        Works for timestamps a bit older than the latest one too.
+        """
+        if self._last_raw is None:
+            self._last_raw = raw
+            self._last_ticks = raw
+
+        delta = (raw - self._last_raw) % EMBEDDED_CLOCK_WRAP
+        if delta >= EMBEDDED_CLOCK_WRAP // 2:
+            delta -= EMBEDDED_CLOCK_WRAP
+        ticks = self._last_ticks + delta
+
+        if delta > 0:
+            self._last_raw = raw
+            self._last_ticks = ticks
+
+        return ticks / EMBEDDED_CLOCK_HZ
+
+    def add_sample(self, request_sent: float, request_received: int,
+                   response_sent: int, response_received: float) -> None:
+        """Host times are in seconds, embedded ones are raw timestamps"""
+        embedded_received = self.unwrap(request_received)
+        embedded_sent = self.unwrap(response_sent)
+
+        delay = (response_received - request_sent) - (embedded_sent - embedded_received)
+        offset = ((embedded_received - request_sent) + (embedded_sent - response_received)) / 2
+        middle = (request_sent + response_received) / 2
+
+        self._samples.append((middle, offset, delay))
+        self._fit()
+
+    def to_host(self, raw: int) -> float:
+        return self.host_at(self.unwrap(raw))
+
+    def host_at(self, embedded):
+        """Host time of an unwrapped embedded time in seconds, of an array of them too"""
+        # embedded = host + offset + drift * (host - ref)
+        return (embedded - self._offset + self._drift * self._ref_time) / (1 + self._drift)
+
+    def to_embedded(self, host: float) -> float:
+        return host + self._offset_at(host)
+
+    def _offset_at(self, host: float) -> float:
+        return self._offset + self._drift * (host - self._ref_time)
+
+    def _fit(self) -> None:
+        best = sorted(self._samples, key=lambda s: s[2])[:self._best]
+        self._delay = best[0][2]
+
+        n = len(best)
+        mean_t = sum(s[0] for s in best) / n
+        mean_o = sum(s[1] for s in best) / n
+        var_t = sum((s[0] - mean_t) ** 2 for s in best)
+
+        self._ref_time = mean_t
+        self._offset = mean_o
+        # drift is not observable until the samples span some time
+        if n > 1 and var_t > 1e-6:
+            self._drift = sum((s[0] - mean_t) * (s[1] - mean_o) for s in best) / var_t
+        else:
+            self._drift = 0.0
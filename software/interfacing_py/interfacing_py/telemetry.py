@@ -0,0 +1,109 @@
+"""
+Host-side stores of the streams the embedded side sends: the wheel telemetry
+and the line sensor readings.
+
+Samples are written by the interfacing loop and read by the control thread,
+appending one is a single assignment into a preallocated ring buffer.
+"""
+import math
+import threading
+
+import numpy as np
+
+from .clock import ClockSync
+
+CAPACITY = 1024  # samples, about 20 s of the telemetry at 50 Hz, 5 s of the line sensor at 200 Hz
+LINE_SENSORS = 6
+
+TELEMETRY_DTYPE = np.dtype([
+    ("time", np.float64),  # host_time
+    ("embedded_time", np.uint32),  # raw embedded ticks
+    ("left_position", np.float32),
+    ("right_position", np.float32),
+    ("left_speed", np.float32),
+    ("right_speed", np.float32),
+    ])
+
+LINE_SENSOR_DTYPE = np.dtype([
+    ("time", np.float64),
+    ("embedded_time", np.uint32),
+    ("values", np.uint16, (LINE_SENSORS,)),  # the leftmost sensor first
+    ])
+
+
+class SampleBuffer:
+    """
+    Ring of the latest samples, the records have to start with the host time and the raw embedded time.
+    They are ordered by the embedded time, which the clock's fit does not move, and read
+    with the host time of the current fit.
+    """
+
+    def __init__(self, dtype: np.dtype, clock: ClockSync, capacity: int = CAPACITY) -> None:
+        self._buffer = np.zeros(capacity, dtype=dtype)
+        # unwrapped embedded times of the samples, s
+        self._embedded = np.zeros(capacity, dtype=np.float64)
+        self._clock = clock
+        self._capacity = capacity
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self._written, self._capacity)
+
+    @property
+    def written(self) -> int:
+        """Samples appended so far, the lost ones included"""
+        return self._written
+
+    def append(self, embedded_time: int, *fields) -> None:
+        """In the order of embedded_time, the raw one. The clocks have to be synchronized"""
+        with self._lock:
+            i = self._written % self._capacity
+            embedded = self._clock.unwrap(embedded_time)
+            self._embedded[i] = embedded
+            self._buffer[i] = (self._clock.host_at(embedded), embedded_time, *fields)
+            self._written += 1
+
+    def latest(self, n: int) -> np.ndarray:
+        """A copy of the last n samples at most, the oldest first"""
+        with self._lock:
+            return self._last(min(n, self._written, self._capacity))
+
+    def since(self, time: float) -> np.ndarray:
+        """A copy of the samples newer than time, the oldest first"""
+        # -inf for all of them, which the fit's arithmetic would turn into a nan
+        bound = self._clock.to_embedded(time) if math.isfinite(time) else time
+        with self._lock:
+            available = min(self._written, self._capacity)
+            start = (self._written - available) % self._capacity
+            # the older samples from start on, the newer ones from the beginning, each part is ordered
+            older = self._embedded[start:start + available]
+            newer = self._embedded[:max(start + available - self._capacity, 0)]
+            not_newer = (np.searchsorted(older, bound, side="right")
+                         + np.searchsorted(newer, bound, side="right"))
+            return self._last(available - int(not_newer))
+
+    def _last(self, n: int) -> np.ndarray:
+        end = self._written % self._capacity
+        start = (self._written - n) % self._capacity
+        if n == 0:
+            return self._buffer[:0].copy()
+        if start < end:
+            samples = self._buffer[start:end].copy()
+            embedded = self._embedded[start:end]
+        else:
+            samples = np.concatenate((self._buffer[start:], self._buffer[:end]))
+            embedded = np.concatenate((self._embedded[start:], self._embedded[:end]))
+        # the same fit the bound of since is converted with
+        samples["time"] = self._clock.host_at(embedded)
+        return samples
+
+
+class TelemetryBuffer(SampleBuffer):
+    def __init__(self, clock: ClockSync, capacity: int = CAPACITY) -> None:
+        super().__init__(TELEMETRY_DTYPE, clock, capacity)
+
+
+class LineSensorBuffer(SampleBuffer):
+    def __init__(self, clock: ClockSync, capacity: int = CAPACITY) -> None:
+        super().__init__(LINE_SENSOR_DTYPE, clock, capacity)
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from .clock import EMBEDDED_CLOCK_HZ, EMBEDDED_CLOCK_WRAP, ClockSync
+from .telemetry import TelemetryBuffer
+
+
+class EmbeddedClock:
+    def __init__(self, start: float, drift: float = 0.0) -> None:
+        """start - the embedded time at the host time 0, s"""
+        self.start = start
+        self.drift = drift
+
+    def time(self, host: float) -> float:
+        return self.start + (1 + self.drift) * host
+
+    def raw(self, host: float) -> int:
+        return round(self.time(host) * EMBEDDED_CLOCK_HZ) % EMBEDDED_CLOCK_WRAP
+
+
+def exchange(sync: ClockSync, clock: EmbeddedClock, sent: float,
+             uplink: float = 0.001, downlink: float = 0.001, processing: float = 0.0002) -> None:
+    received = sent + uplink
+    replied = received + processing
+    sync.add_sample(sent, clock.raw(received), clock.raw(replied), replied + downlink)
+
+
+def test_clock_sync_offset():
+    clock = EmbeddedClock(start=12.5)
+    sync = ClockSync()
+    assert not sync.synchronized
+
+    for i in range(4):
+        exchange(sync, clock, i * 0.5)
+    assert sync.synchronized
+    assert sync.delay == pytest.approx(0.002, abs=2e-6)
+    assert sync.to_embedded(3.0) == pytest.approx(clock.time(3.0), abs=2e-6)
+    assert sync.to_host(clock.raw(3.0)) == pytest.approx(3.0, abs=2e-6)
+
+
+def test_clock_sync_ignores_asymmetric_delays():
+    clock = EmbeddedClock(start=100.0)
+    sync = ClockSync(window=32, best=4)
+    for i in range(4):
+        exchange(sync, clock, i * 0.5)
+    # a slow downlink alone would shift the offset by half of its excess, 15 ms here
+    for i in range(4, 24):
+        exchange(sync, clock, i * 0.5, downlink=0.031)
+
+    assert sync.delay == pytest.approx(0.002, abs=2e-6)
+    assert sync.to_embedded(10.0) - 10.0 == pytest.approx(100.0, abs=1e-5)
+    assert sync.to_host(clock.raw(10.0)) == pytest.approx(10.0, abs=1e-5)
+
+
+def test_clock_sync_drift():
+    clock = EmbeddedClock(start=5.0, drift=50e-6)
+    sync = ClockSync()
+    for i in range(20):
+        exchange(sync, clock, i * 0.5)
+
+    assert sync.drift == pytest.approx(50e-6, rel=0.02)
+    # an hour ahead the drift alone is 180 ms
+    assert sync.to_embedded(3600.0) == pytest.approx(clock.time(3600.0), abs=1e-3)
+    assert sync.to_host(clock.raw(20.0)) == pytest.approx(20.0, abs=1e-5)
+
+
+def test_clock_sync_timestamp_wrap():
+    wrap = EMBEDDED_CLOCK_WRAP / EMBEDDED_CLOCK_HZ  # ~4295 s
+    clock = EmbeddedClock(start=wrap - 2.0)
+    sync = ClockSync()
+    for i in range(8):
+        exchange(sync, clock, i * 0.5)
+    assert clock.raw(3.5) < clock.raw(0.0)  # wrapped in between
+
+    for host in (1.0, 1.999, 2.001, 3.0, 5.0):
+        assert sync.to_host(clock.raw(host)) == pytest.approx(host, abs=1e-5)
+    # a stamp from before the wrap, read after a later one
+    assert sync.to_host(clock.raw(1.5)) == pytest.approx(1.5, abs=1e-5)
+
+
+def test_sample_buffer_since_survives_refit():
+    clock = EmbeddedClock(start=20.0)
+    sync = ClockSync(window=4, best=4)
+    for i in range(4):
+        exchange(sync, clock, i * 0.5)
+    buffer = TelemetryBuffer(sync, capacity=8)
+    times = [2.0 + i * 0.005 for i in range(12)]
+    for t in times[:6]:
+        buffer.append(clock.raw(t), 0.0, 0.0, 0.0, 0.0)
+    # a slow uplink moves the fit 10 ms back, the next samples would go before the previous ones
+    for i in range(4, 8):
+        exchange(sync, clock, i * 0.5, uplink=0.021)
+    for t in times[6:]:  # wrapped around
+        buffer.append(clock.raw(t), 0.0, 0.0, 0.0, 0.0)
+
+    samples = buffer.since(sync.to_host(clock.raw(times[7])))
+    assert list(samples["embedded_time"]) == [clock.raw(t) for t in times[8:]]
+    everything = buffer.since(-np.inf)
+    assert list(everything["embedded_time"]) == [clock.raw(t) for t in times[4:]]
+    assert np.all(np.diff(everything["time"]) > 0)
+    assert len(buffer.since(np.inf)) == 0
@@ -5,6 +5,7 @@ use pyo3::exceptions::PyException;
 use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
 use derive_more::Display;
+use interfacing::commands::{CommandBatch, Step, MAX_BATCH_STEPS};
 
 #[pyclass(subclass)]
 pub struct Interfacing(interfacing::Interfacing);
@@ -22,7 +23,9 @@ pub enum Command {
     OpenGripper,
     CloseGripper,
     LiftGripper,
-    LowerGripper
+    LowerGripper,
+    /// The parameters are a list of PyCommand
+    Batch
 }
 
 #[pyclass]
@@ -64,7 +67,19 @@ impl TryFrom<PyCommand> for interfacing::commands::Command {
                 Command::OpenGripper => iCommand::OpenGripper,
                 Command::CloseGripper => iCommand::CloseGripper,
                 Command::LiftGripper => iCommand::LiftGripper,
-                Command::LowerGripper => iCommand::LowerGripper
+                Command::LowerGripper => iCommand::LowerGripper,
+                Command::Batch => {
+                    let commands: Vec<PyCommand> = cmd.1.ok_or(PyValueError::new_err("Expected the steps of the batch"))?.extract(py)?;
+                    let steps = commands.into_iter()
+                        .map(|c| {
+                            let c: iCommand = c.try_into()?;
+                            Step::try_from(c).map_err(|_| PyValueError::new_err("A batch cannot contain a batch"))
+                        })
+                        .collect::<PyResult<Vec<Step>>>()?;
+                    let batch = CommandBatch::new(&steps)
+                        .ok_or(PyValueError::new_err(format!("A batch holds up to {} steps", MAX_BATCH_STEPS)))?;
+                    iCommand::Batch(batch)
+                }
             })
         })
     }
@@ -79,6 +94,10 @@ impl CommandId {
     pub fn __str__(&self) -> String {
         self.0.to_string()
     }
+
+    pub fn __int__(&self) -> u32 {
+        *self.0
+    }
 }
 
 #[pyclass]
@@ -156,6 +175,19 @@ impl From<UpdateErorr> for PyErr {
     }
 }
 
+#[pyclass]
+#[derive(Debug, Display)]
+#[display(fmt = "Cannot send a message: {:?}", "self.0")]
+pub struct SendErorr(interfacing::SendErorr);
+
+impl std::error::Error for SendErorr {}
+
+impl From<SendErorr> for PyErr {
+    fn from(err: SendErorr) -> PyErr {
+        PyException::new_err(err.to_string())
+    }
+}
+
 #[pymethods]
 impl Interfacing {
     #[new]
@@ -165,10 +197,22 @@ impl Interfacing {
 
     pub fn execute(&mut self, command: PyCommand) -> PyResult<CommandId> {
         let result = self.0.execute(command.try_into()?, Some(get_time()))
-            .map_err(|e| MessageSerializeErorr(e))?;
+            .map_err(|e| SendErorr(e))?;
         Ok(CommandId(result))
     }
 
+    /// Returns (id, message, dropped ids): the message has to be written to the port right away
+    pub fn emergency_stop(&mut self) -> Result<(CommandId, MessageBuffer, Vec<CommandId>), MessageSerializeErorr> {
+        self.0.emergency_stop(Some(get_time()))
+            .map(|(id, m, dropped)| (CommandId(id), MessageBuffer(m),
+                                     dropped.into_iter().map(CommandId).collect()))
+            .map_err(|e| MessageSerializeErorr(e))
+    }
+
+    pub fn set_compact(&mut self, compact: bool) {
+        self.0.set_compact(compact)
+    }
+
     pub fn retry_timed_out(&mut self) -> Result<(), MessageSerializeErorr> {
         self.0.retry_timed_out(get_time())
             .map_err(|e| MessageSerializeErorr(e))
@@ -183,6 +227,42 @@ impl Interfacing {
         self.0.is_finished(id.0)
     }
 
+    pub fn is_rejected(&self, id: CommandId) -> bool {
+        self.0.is_rejected(id.0)
+    }
+
+    pub fn get_start_time(&self, id: CommandId) -> Option<u32> {
+        self.0.get_start_time(id.0)
+    }
+
+    pub fn get_progress(&self, id: CommandId) -> u8 {
+        self.0.get_progress(id.0)
+    }
+
+    pub fn time_sync_request(&mut self) -> Result<(u32, MessageBuffer), MessageSerializeErorr> {
+        self.0.time_sync_request()
+            .map(|(id, m)| (id, MessageBuffer(m)))
+            .map_err(|e| MessageSerializeErorr(e))
+    }
+
+    /// Returns (id, receive_time, transmit_time) of a time sync reply, if there is any
+    pub fn get_time_sync_reply(&mut self) -> Option<(u32, u32, u32)> {
+        self.0.get_time_sync_reply()
+            .map(|r| (r.id, r.receive_time, r.transmit_time))
+    }
+
+    /// Returns (time, left_position, right_position, left_speed, right_speed) of a telemetry sample, if there is any
+    pub fn get_telemetry(&mut self) -> Option<(u32, f32, f32, f32, f32)> {
+        self.0.get_telemetry()
+            .map(|t| (t.time, t.left_position, t.right_position, t.left_speed, t.right_speed))
+    }
+
+    /// Returns (time, values) of a line sensor reading, if there is any
+    pub fn get_line_sensor(&mut self) -> Option<(u32, Vec<u16>)> {
+        self.0.get_line_sensor()
+            .map(|r| (r.time, r.values.to_vec()))
+    }
+
     pub fn get_message_to_send(&mut self) -> Option<MessageBuffer> {
         self.0.get_message_to_send().map(|m| MessageBuffer(m))
     }
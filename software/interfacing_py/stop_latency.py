@@ -0,0 +1,67 @@
+"""
+Measures how long it takes the robot to stop while speed updates are being sent.
+
+Every trial queues a burst of SetSpeed commands, the same way the control loop does,
+and then stops. The latency is from the stop call to the moment the embedded side has
+started executing it, in the host clock. Needs the robot connected.
+"""
+import argparse
+import asyncio
+import statistics
+from typing import Optional
+
+from interfacing_py import *
+
+SPEED = 300
+BURST = 3  # the registry holds 4 commands, one is left for the stop
+
+
+async def wait_for_sync(m: InterfacingManager):
+    while not m.clock.synchronized:
+        await asyncio.sleep(0.05)
+
+
+async def trial(m: InterfacingManager, priority: bool) -> Optional[float]:
+    pending = [m.execute(PyCommand(Command.SetSpeed, SetSpeedParams(SPEED, SPEED)))
+               for _ in range(BURST)]
+
+    called = host_time()
+    if priority:
+        _, stop = m.emergency_stop()
+    else:
+        stop = m.execute(PyCommand(Command.Stop))
+    started = await stop
+    latency = started - called if started is not None else None
+
+    # the dropped ones are cancelled, the rest has to finish before the next trial
+    await asyncio.gather(*pending, return_exceptions=True)
+    return latency
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", default="/dev/ttyACM0")
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--baseline", action="store_true",
+                        help="stop through the send queue, as before the emergency stop")
+    args = parser.parse_args()
+
+    m = InterfacingManager(args.port, asyncio.get_event_loop())
+    await wait_for_sync(m)
+
+    latencies = []
+    for _ in range(args.trials):
+        latencies.append(await trial(m, not args.baseline))
+        await asyncio.sleep(0.05)
+    m.stop()
+
+    # None if the clocks have lost the sync meanwhile
+    ms = sorted(x * 1000 for x in latencies if x is not None)
+    p95 = ms[min(int(len(ms) * 0.95), len(ms) - 1)]
+    print(f"stop latency over {len(ms)} trials: mean {statistics.mean(ms):.2f} ms, "
+          f"p95 {p95:.2f} ms, max {ms[-1]:.2f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
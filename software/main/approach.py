@@ -0,0 +1,68 @@
+from enum import Enum
+from typing import Optional, Tuple
+
+from simple_pid import PID
+
+from vision.ball import BallInfo
+
+from .following import clamp_speed
+from .settings import *
+
+
+class ApproachPhase(Enum):
+    SEARCHING = 0,
+    APPROACHING = 1,
+    GRABBING = 2
+
+
+class BallApproach:
+    """
+    Steers towards the tracked ball until it is in reach of the gripper.
+    Speeds are in the same convention as LineFollower's.
+    """
+
+    def __init__(self, speed: int = APPROACH_SPEED,
+                 gains: Tuple[float, float, float] = APPROACH_GAINS) -> None:
+        self.speed = speed
+        self.phase = ApproachPhase.SEARCHING
+
+        kp, ki, kd = gains
+        self._pid = PID(Kp=kp, Ki=ki, Kd=kd, setpoint=0.0,
+                        sample_time=None,
+                        output_limits=(-speed / 2, speed / 2))
+        self._last_speeds = (speed, speed)
+
+    def reset(self) -> None:
+        """Has to be called when the ball is grabbed or the tracker loses it"""
+        self.phase = ApproachPhase.SEARCHING
+        self._pid.reset()
+
+    def update(self, info: BallInfo, frame_shape: Tuple[int, ...]) -> Optional[Tuple[int, int]]:
+        """Returns the speeds to set, None once the ball can be grabbed"""
+        if self.phase == ApproachPhase.GRABBING:
+            return None
+
+        ball = info.ball
+        if ball is None:
+            if self.phase == ApproachPhase.APPROACHING:
+                # a missed frame, the tracker has not given up on the ball yet
+                return self._last_speeds
+            return (SEARCH_SPEED, -SEARCH_SPEED)
+
+        self.phase = ApproachPhase.APPROACHING
+
+        frame_height, frame_width = frame_shape[:2]
+        half_width = frame_width / 2
+        error = (ball.x - half_width) / half_width
+
+        in_reach = ball.y + ball.radius >= frame_height * GRAB_BOTTOM_RATIO
+        if in_reach and abs(error) <= GRAB_MAX_ERROR:
+            self.phase = ApproachPhase.GRABBING
+            return None
+
+        correction = self._pid(error) or 0
+        # turn in place when the ball is in reach but off to the side
+        speed = 0 if in_reach else self.speed
+        self._last_speeds = (clamp_speed(speed + correction),
+                             clamp_speed(speed - correction))
+        return self._last_speeds
@@ -0,0 +1,180 @@
+"""
+Binary log of the control loop's events.
+
+Records have a fixed layout, so that logging one is a single assignment into
+a preallocated ring buffer; a background thread appends the new records to the file.
+Run as a module to convert a log to CSV or NumPy.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+from enum import IntEnum
+from typing import BinaryIO, Optional
+
+import numpy as np
+
+MAGIC = b"EVLOG1\n"
+FLUSH_INTERVAL = 0.5  # s
+CAPACITY = 4096  # records, about 400 s of frames at 10 Hz
+
+NAN = float("nan")
+
+
+class EventKind(IntEnum):
+    FRAME = 0  # a line following step
+    COMMAND = 1  # a command is queued
+    COMMAND_STARTED = 2  # the embedded side has acknowledged it
+    DROPPED = 3  # records lost because the buffer overflowed, count is in seq
+
+
+EVENT_DTYPE = np.dtype([
+    ("kind", np.uint8),
+    ("timestamp", np.float64),  # host_time
+    ("seq", np.int64),  # frame seq
+    ("x_offset", np.int32),
+    ("angle", np.float32),
+    ("error", np.float32),
+    ("correction", np.float32),
+    ("left", np.int32),  # speeds
+    ("right", np.int32),
+    ("command_id", np.int64),
+    ("command", np.int32),
+    ("latency", np.float32),  # s
+    ("black_threshold", np.float32),  # the adapted upper L of black
+    ])
+
+
+class EventLog:
+    def __init__(self, path: str, capacity: int = CAPACITY,
+                 flush_interval: float = FLUSH_INTERVAL) -> None:
+        self._buffer = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self._capacity = capacity
+        self._written = 0
+        self._flushed = 0
+        self._lock = threading.Lock()
+
+        self._file = open(path, "wb")
+        write_header(self._file)
+
+        self._flush_interval = flush_interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+        self._thread.start()
+
+    def frame(self, timestamp: float, seq: int, x_offset: int, angle: Optional[float],
+              error: float, correction: float, left: int, right: int,
+              latency: Optional[float], black_threshold: Optional[float] = None) -> None:
+        self._record((EventKind.FRAME, timestamp, seq, x_offset,
+                      NAN if angle is None else angle, error, correction,
+                      left, right, -1, -1, NAN if latency is None else latency,
+                      NAN if black_threshold is None else black_threshold))
+
+    def command(self, timestamp: float, command_id: int, command: int,
+                left: int = 0, right: int = 0) -> None:
+        self._record((EventKind.COMMAND, timestamp, -1, 0, NAN, NAN, NAN,
+                      left, right, command_id, command, NAN, NAN))
+
+    def command_started(self, queued: float, command_id: int,
+                        start_time: Optional[float]) -> None:
+        """start_time is None until the clocks are synchronized"""
+        if start_time is None:
+            start_time = latency = NAN
+        else:
+            latency = start_time - queued
+        self._record((EventKind.COMMAND_STARTED, start_time, -1, 0, NAN, NAN, NAN,
+                      0, 0, command_id, -1, latency, NAN))
+
+    def _record(self, record: tuple) -> None:
+        with self._lock:
+            self._buffer[self._written % self._capacity] = record
+            self._written += 1
+
+    def flush(self) -> None:
+        with self._lock:
+            start, end = self._flushed, self._written
+            dropped = max(end - start - self._capacity, 0)
+            start += dropped
+            first, last = start % self._capacity, end % self._capacity
+            if end - start == 0:
+                chunks = []
+            elif first < last:
+                chunks = [self._buffer[first:last].copy()]
+            else:
+                chunks = [self._buffer[first:].copy(), self._buffer[:last].copy()]
+            self._flushed = end
+
+        if dropped > 0:
+            lost = np.zeros(1, dtype=EVENT_DTYPE)
+            lost["kind"] = EventKind.DROPPED
+            lost["seq"] = dropped
+            chunks.insert(0, lost)
+        for chunk in chunks:
+            self._file.write(chunk.tobytes())
+        self._file.flush()
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+    def _run(self):
+        while not self._stop_event.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Cannot flush the event log")
+
+
+def write_header(f: BinaryIO) -> None:
+    descr = json.dumps(EVENT_DTYPE.descr).encode()
+    f.write(MAGIC)
+    f.write(descr + b"\n")
+
+
+def read_log(path: str) -> np.ndarray:
+    with open(path, "rb") as f:
+        if f.readline() != MAGIC:
+            raise ValueError(f"{path} is not an event log")
+        descr = json.loads(f.readline())
+        dtype = np.dtype([tuple(field) for field in descr])
+        data = f.read()
+    # the last record may be partially written if the process was killed
+    usable = len(data) - len(data) % dtype.itemsize
+    return np.frombuffer(data[:usable], dtype=dtype)
+
+
+def to_csv(events: np.ndarray, path: str) -> None:
+    names = events.dtype.names
+    with open(path, "w") as f:
+        f.write(",".join(names) + "\n")
+        for event in events:
+            row = [EventKind(event["kind"]).name] + [str(event[n]) for n in names[1:]]
+            f.write(",".join(row) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log")
+    parser.add_argument("--csv", help="output CSV path")
+    parser.add_argument("--npy", help="output .npy path")
+    args = parser.parse_args()
+
+    events = read_log(args.log)
+    if args.csv is None and args.npy is None:
+        args.csv = os.path.splitext(args.log)[0] + ".csv"
+    if args.csv is not None:
+        to_csv(events, args.csv)
+    if args.npy is not None:
+        np.save(args.npy, events)
+
+    kinds, counts = np.unique(events["kind"], return_counts=True)
+    summary = ", ".join(f"{EventKind(k).name}: {c}" for k, c in zip(kinds, counts))
+    print(f"{len(events)} events ({summary})")
+
+
+if __name__ == "__main__":
+    main()
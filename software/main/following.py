@@ -0,0 +1,246 @@
+import math
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Iterator, Optional, Tuple
+
+from simple_pid import PID
+
+from vision import line
+from vision.line import LineInfo, WindowPair
+from vision.window import win2px
+
+from .settings import *
+
+
+def clamp_speed(val):
+    return int(min(MAX_SPEED, max(-MAX_SPEED, val)))
+
+
+def line_band(img):
+    """The bottom part of the frame which the line windows are searched in"""
+    line_win_max_y = win2px(line.LINE_WINDOW_FIRST_MAX_OFFSET + 1 \
+                            + line.LINE_WINDOWS_DISTANCE_RANGE[1] + 1)
+    return img[img.shape[0] - line_win_max_y:, :]
+
+
+class LinePredictor:
+    """
+    Predicts where the line is at a given moment from the last observation
+    and the speeds since the frame was captured: the measured ones as far as
+    the wheel telemetry reaches, the commanded ones after that.
+
+    Speeds are in the controller's convention: (FOLLOWING_SPEED + correction,
+    FOLLOWING_SPEED - correction), so a positive correction turns the robot
+    in the direction which increases the error.
+    """
+
+    def __init__(self, history: int = 8, measurements: int = 64) -> None:
+        self._observations: Deque[Tuple[float, LineInfo]] = deque(maxlen=history)
+        self._commands: Deque[Tuple[float, int, int]] = deque(maxlen=history)
+        # the telemetry comes at 50 Hz, enough for MAX_PREDICTION_HORIZON
+        self._measurements: Deque[Tuple[float, float, float]] = deque(maxlen=measurements)
+
+    def add_observation(self, time: float, line_info: LineInfo) -> None:
+        self._observations.append((time, line_info))
+
+    def add_command(self, time: float, left: int, right: int) -> None:
+        self._commands.append((time, left, right))
+
+    def add_measurement(self, time: float, left: float, right: float) -> None:
+        self._measurements.append((time, left, right))
+
+    def predict(self, time: float) -> LineInfo:
+        if len(self._observations) == 0:
+            raise ValueError("Nothing observed yet")
+
+        capture_time, observed = self._observations[-1]
+        end = capture_time + max(0.0, min(time - capture_time, MAX_PREDICTION_HORIZON))
+
+        x = float(observed.x_offset)
+        angle = observed.angle if observed.angle is not None else self._recent_angle()
+        for start, stop, left, right in self._speed_segments(capture_time, end):
+            dt = stop - start
+            speed = (left + right) / 2
+            rotation = (left - right) / TRACK_WIDTH
+            x += PX_PER_STEP * (speed * math.tan(angle) + CAMERA_LOOKAHEAD * rotation) * dt
+            angle += rotation * dt
+
+        return LineInfo(round(x), angle if observed.angle is not None else None)
+
+    def _recent_angle(self) -> float:
+        for _, info in reversed(self._observations):
+            if info.angle is not None:
+                return info.angle
+        return 0.0
+
+    def _speed_segments(self, start: float,
+                        end: float) -> Iterator[Tuple[float, float, float, float]]:
+        """Splits [start, end] into intervals of constant speeds"""
+        measured_until = start
+        # a gap before the first measurement would leave the robot standing still
+        if self._measurements and self._measurements[0][0] <= start:
+            measured_until = min(max(start, self._measurements[-1][0]), end)
+            yield from _constant_segments(self._measurements, start, measured_until)
+        yield from _constant_segments(self._commands, measured_until, end)
+
+
+def _constant_segments(speeds, start: float,
+                       end: float) -> Iterator[Tuple[float, float, float, float]]:
+    """Splits [start, end] into intervals of constant speeds from (time, left, right) changes"""
+    if end <= start:
+        return
+
+    in_effect: Optional[Tuple[float, float]] = None
+    changes = []
+    for time, left, right in speeds:
+        if time <= start:
+            in_effect = (left, right)
+        elif time < end:
+            changes.append((time, (left, right)))
+
+    segment_start = start
+    for time, changed in changes:
+        if in_effect is not None:
+            yield (segment_start, time, *in_effect)
+        segment_start, in_effect = time, changed
+    if in_effect is not None:
+        yield (segment_start, end, *in_effect)
+
+
+class SensorFusion:
+    """
+    The error between the camera frames: the last frame's error plus how far the line
+    has moved under the reflectance sensors since the frame was captured.
+    The camera sees where the line goes, the sensors only how the robot drifts off it,
+    but many times a frame.
+    """
+
+    def __init__(self, history: int = 64, max_age: float = MAX_PREDICTION_HORIZON) -> None:
+        # the frame's error is not extrapolated any further
+        self.max_age = max_age
+        # (time, offset in steps), None offsets where the sensors have not seen the line
+        self._offsets: Deque[Tuple[float, Optional[float]]] = deque(maxlen=history)
+        # (capture time, error, error per step of the offset)
+        self._camera: Optional[Tuple[float, float, float]] = None
+
+    def add_sensor(self, time: float, offset: Optional[float]) -> None:
+        self._offsets.append((time, offset))
+
+    def add_camera(self, capture_time: float, error: float, scale: float) -> None:
+        self._camera = (capture_time, error, scale)
+
+    def error(self) -> Optional[Tuple[float, float]]:
+        """(time, error) of the latest sensor reading, None if there is nothing new to fuse"""
+        if self._camera is None or len(self._offsets) == 0:
+            return None
+        capture_time, camera_error, scale = self._camera
+
+        latest_time, latest = self._offsets[-1]
+        if not capture_time < latest_time <= capture_time + self.max_age or latest is None:
+            return None
+        base = None
+        for time, offset in self._offsets:
+            if time > capture_time:
+                break
+            base = offset
+        if base is None:
+            return None
+
+        return latest_time, camera_error + scale * (latest - base)
+
+
+@dataclass
+class FollowStep:
+    wins: WindowPair
+    line_info: LineInfo
+    left: int
+    right: int
+    error: float
+    correction: float
+
+
+class LineFollower:
+    """Line following logic without any hardware, so that it can be reused"""
+
+    def __init__(self, speed: int = FOLLOWING_SPEED,
+                 gains: Tuple[float, float, float] = PID_GAINS) -> None:
+        self.speed = speed
+
+        # the time base comes from the frame timestamps, not from the PID's clock
+        kp, ki, kd = gains
+        self._pid = PID(Kp=kp, Ki=ki, Kd=kd, setpoint=0.0,
+                        sample_time=None,
+                        output_limits=(-speed / 2, speed / 2))
+        self.predictor = LinePredictor()
+        self.fusion = SensorFusion()
+
+        # of the last observation the PID has been updated with
+        self._last_update: Optional[float] = None
+
+    def follow(self, line_info: LineInfo, frame_width: int,
+               capture_time: float, target_time: float) -> Tuple[int, int, float, float]:
+        """
+        Returns (left, right, error, correction) for the line observed at capture_time,
+        compensated for the robot's motion until target_time
+        """
+        self.predictor.add_observation(capture_time, line_info)
+        predicted = self.predictor.predict(target_time)
+
+        frame_half_width = frame_width // 2
+        x_offset_normalized = predicted.x_offset / frame_half_width
+        error = x_offset_normalized + (predicted.angle or 0)
+
+        observed_error = line_info.x_offset / frame_half_width + (line_info.angle or 0)
+        self.fusion.add_camera(capture_time, observed_error, PX_PER_STEP / frame_half_width)
+
+        return self._update(error, capture_time)
+
+    def follow_sensor(self) -> Optional[Tuple[int, int, float, float]]:
+        """
+        Same as follow, from the line sensor readings since the last camera frame,
+        None if there are none
+        """
+        fused = self.fusion.error()
+        if fused is None:
+            return None
+        time, error = fused
+        if self._last_update is not None and time <= self._last_update:
+            return None  # already used
+        return self._update(error, time)
+
+    def sensor_measured(self, time: float, offset: Optional[float]) -> None:
+        self.fusion.add_sensor(time, offset)
+
+    def _update(self, error: float, time: float) -> Tuple[int, int, float, float]:
+        # a frame is older than the sensor readings before it, then the PID's own clock is used
+        dt = None
+        if self._last_update is not None and time > self._last_update:
+            dt = time - self._last_update
+        self._last_update = time if self._last_update is None else max(time, self._last_update)
+
+        correction = self._pid(error, dt=dt) or 0
+
+        return (clamp_speed(self.speed + correction),
+                clamp_speed(self.speed - correction),
+                error, correction)
+
+    def command_started(self, time: float, left: int, right: int) -> None:
+        self.predictor.add_command(time, left, right)
+
+    def speeds_measured(self, time: float, left: float, right: float) -> None:
+        self.predictor.add_measurement(time, left, right)
+
+    def follow_mask(self, black, capture_time: float,
+                    target_time: float) -> Optional[FollowStep]:
+        """Locates the line in the mask of the line band and follows it, None if there is no line"""
+        wins = line.find_line_window_pair(black)
+        if wins == WindowPair.empty():
+            return None
+        try:
+            line_info = line.locate_line(wins)
+        except ValueError:
+            return None
+
+        left, right, error, correction = self.follow(line_info, black.shape[1],
+                                                     capture_time, target_time)
+        return FollowStep(wins, line_info, left, right, error, correction)
@@ -0,0 +1,32 @@
+"""
+Where the line is under the reflectance sensors of embedded/main/src/line_sensor.rs.
+
+The firmware equalizes the sensors, so the line is where the readings drop
+below the brightest one. Offsets are in steps from the robot's center,
+positive to the right, like LineInfo's x_offset.
+"""
+import numpy as np
+
+from .settings import LINE_SENSOR_CONTRAST, LINE_SENSOR_SPACING
+
+NUM_SENSORS = 6
+
+# the leftmost sensor first
+SENSOR_OFFSETS = (np.arange(NUM_SENSORS) - (NUM_SENSORS - 1) / 2) * LINE_SENSOR_SPACING
+
+
+def line_offsets(values: np.ndarray) -> np.ndarray:
+    """
+    values are (n, NUM_SENSORS) readings, returns n offsets, NaN where there is no line.
+    The offset is the centroid of the readings' drop below the brightest sensor.
+    """
+    values = np.atleast_2d(values).astype(np.float32)
+    darkness = values.max(axis=1, keepdims=True) - values
+    # only the part above the noise, so that the white sensors do not pull the centroid
+    weights = np.clip(darkness - LINE_SENSOR_CONTRAST / 2, 0, None)
+
+    total = weights.sum(axis=1)
+    offsets = np.full(len(values), np.nan, dtype=np.float32)
+    found = darkness.max(axis=1) >= LINE_SENSOR_CONTRAST
+    offsets[found] = (weights[found] @ SENSOR_OFFSETS) / total[found]
+    return offsets
@@ -1,22 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+import math
+import threading
 import time
 import logging
-from typing import Optional
+from typing import Optional, Tuple
 import coloredlogs
 import functools
 
 import cv2 as cv
 import numpy as np
 
-from simple_pid import PID
-import RPi.GPIO as GPIO
+from interfacing_py import Command, CommandRejected, host_time
 
 from vision import colors, line
-from vision.camera import BufferlessCapture
-from vision.window import win2px
-
+from vision.ball import BallInfo, BallTracker
+from vision.camera import CAPTURE_RESOLUTION, BufferlessCapture, Frame
+from vision.intersection import IntersectionDetector, IntersectionInfo, IntersectionType
+from vision.rectify import Rectifier, load_calibration
+from vision.scheduler import Scheduler
+from vision.segmentation import SegmentationContext
+from vision.silver import SilverDetector, SilverInfo
+from vision.threshold import AdaptiveThreshold
+
+from .approach import ApproachPhase, BallApproach
+from .eventlog import EventLog
+from .following import FollowStep, LineFollower, line_band
+from .line_sensor import line_offsets
+from .odometry import Odometry
+from .profiling import LoopProfiler
 from .robot import Robot
 from .settings import *
+from .startup import StartupTimer, warm_up_vision
 
 field_styles = coloredlogs.DEFAULT_FIELD_STYLES
 field_styles["levelname"] = {"color": "white", "bold": True}
@@ -25,21 +40,11 @@ coloredlogs.install(fmt="%(asctime)s - %(threadName)s - %(levelname)s - %(module
                     level=logging.DEBUG)
 
 
-def clamp_speed(val):
-    return int(min(MAX_SPEED, max(-MAX_SPEED, val)))
-
-
-class IntersectionType(Enum):
-    LEFT_TURN = 0,
-    RIGHT_TURN = 1,
-    T_JUNCTION = 2
-    CROSS = 3,
-
-
 class State(Enum):
     IDLE = 0,
     FOLLOWING_LINE = 1,
-    COLLECTING = 2
+    COLLECTING = 2,
+    AVOIDING_OBSTACLE = 3
 
 
 def maybe_no_move(fn):
@@ -59,20 +64,123 @@ def filled_frac(region):
     return np.count_nonzero(region) / area
 
 
-class RobotController:
-    def __init__(self) -> None:
-        self._robot = Robot()
-        self._cap = BufferlessCapture(0)
+class FrameData:
+    """A captured frame and the masks of it, computed once by whichever detector needs them first"""
+
+    def __init__(self, captured: Frame, profile: colors.ColorProfile,
+                 segmentation: SegmentationContext,
+                 rectifier: Optional[Rectifier] = None,
+                 threshold: Optional[AdaptiveThreshold] = None) -> None:
+        self.captured = captured
+        self.profile = profile
+        # the masks live in its buffers, so they are only valid during this frame
+        self.segmentation = segmentation
+        self.rectifier = rectifier
+        # updated with every frame whose black mask is needed
+        self.threshold = threshold
+
+    @property
+    def image(self) -> cv.Mat:
+        return self.captured.image
+
+    @functools.cached_property
+    def band(self) -> cv.Mat:
+        band = line_band(self.image)
+        if self.rectifier is not None:
+            band = self.rectifier(band)
+        return band
+
+    @functools.cached_property
+    def lab(self) -> np.ndarray:
+        return self.segmentation.convert(self.band)
 
-        self._pid = PID(Kp=1.0, Ki=0.0, Kd=0.0, setpoint=0.0,
-                        output_limits=(-FOLLOWING_SPEED / 2,
-                                       FOLLOWING_SPEED / 2))
+    @functools.cached_property
+    def black(self) -> cv.Mat:
+        profile = self.profile
+        if self.threshold is not None:
+            self.threshold.update(self.lab)
+            profile = self.threshold.apply(profile)
+        return self.segmentation.find(self.lab, "black", profile=profile)
+
+    @functools.cached_property
+    def green(self) -> cv.Mat:
+        return self.segmentation.find(self.lab, "green", profile=self.profile)
+
+    @functools.cached_property
+    def obstacle(self) -> cv.Mat:
+        return self.segmentation.find(self.lab, "obstacle", profile=self.profile)
+
+
+def line_band_shape() -> Tuple[int, int]:
+    return line_band(np.empty(CAPTURE_RESOLUTION[::-1], dtype=np.uint8)).shape
+
+
+class RobotController:
+    def __init__(self, robot: Robot, cap: BufferlessCapture,
+                 startup: Optional[StartupTimer] = None,
+                 events: Optional[EventLog] = None,
+                 segmentation: Optional[SegmentationContext] = None) -> None:
+        self._robot = robot
+        self._cap = cap
+        self._events = events
+        # reported once the first command is sent
+        self._startup = startup
+
+        self._follower = LineFollower()
+        self._odometry = Odometry()
+        # the follower is updated from the camera frames and from the line sensor's thread,
+        # it is not held while a command is on its way, a lost ack must not stall the other one
+        self._follow_lock = threading.Lock()
+        self._sensor_read_until = -math.inf
+        band_shape = line_band_shape()
+        if segmentation is None:
+            segmentation = SegmentationContext(band_shape)
+        self._segmentation = segmentation
+        self._threshold = AdaptiveThreshold() if ADAPTIVE_BLACK else None
+        self._rectifier = None
+        if RECTIFY_CALIBRATION:
+            logging.info(f"Rectifying the line band with {RECTIFY_CALIBRATION}")
+            self._rectifier = Rectifier(load_calibration(RECTIFY_CALIBRATION), band_shape,
+                                        CAPTURE_RESOLUTION[1] - band_shape[0])
 
         self._state = State.FOLLOWING_LINE
         self._intersection_type: Optional[IntersectionType] = None
+        self._intersection_detector = IntersectionDetector()
+        self._silver_detector = SilverDetector()
+        self._obstacle_seen = 0
+
+        self._scheduler = Scheduler(VISION_BUDGET)
+        # line following has to see every frame, so it is the only every-frame task
+        self._scheduler.register("line", self._follow_line)
+        self._scheduler.register("intersection", self._detect_intersection,
+                                 rate=INTERSECTION_RATE, priority=2)
+        self._scheduler.register("silver", self._detect_silver,
+                                 rate=SILVER_RATE, priority=1)
+        self._scheduler.register("obstacle", self._detect_obstacle,
+                                 rate=OBSTACLE_RATE, priority=1)
+
+        self._ball_tracker = BallTracker()
+        self._approach = BallApproach()
+
+        self._collecting_scheduler = Scheduler(VISION_BUDGET)
+        self._collecting_scheduler.register("ball", self._collect_ball)
 
         self._can_go = False
 
+        # has to be created in the main thread, it installs a signal handler
+        self._profiler = LoopProfiler()
+
+        self._stop_event = threading.Event()
+        self._sensor_thread = None
+        if LINE_SENSOR_FUSION:
+            self._sensor_thread = threading.Thread(target=self._sensor_loop, name="line-sensor",
+                                                   daemon=True)
+            self._sensor_thread.start()
+
+        # imported here, so that the controller can be used without the Pi's GPIO too
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+
         GPIO.setmode(GPIO.BOARD)
         GPIO.setup(37, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.add_event_detect(37, GPIO.RISING,
@@ -81,36 +189,21 @@ class RobotController:
 
     def loop(self):
         while True:
+            self._profiler.iteration()
             start = time.time()
 
-            frame = self._cap.read()
-            line_win_max_y = win2px(line.LINE_WINDOW_FIRST_MAX_OFFSET + 1 \
-                                    + line.LINE_WINDOWS_DISTANCE_RANGE[1] + 1)
-            frame_line = frame[frame.shape[0] - line_win_max_y:, :]
+            captured = self._cap.read_frame()
+            # the same profile for the whole frame even if it is swapped meanwhile
+            data = FrameData(captured, colors.get_profile(), self._segmentation,
+                             self._rectifier, self._threshold)
 
-            black = colors.find_black(frame_line)
-            wins = line.find_line_window_pair(black)
-            if wins == line.WindowPair.empty():
-                pass  # TODO
-            else:
-                line_info = line.locate_line(wins)
-
-                frame_half_width = frame.shape[1] // 2
-                x_offset_normalized = line_info.x_offset / frame_half_width
-                error = x_offset_normalized + (line_info.angle or 0)
-                correction = self._pid(error) or 0
-
-                new_speed = (-clamp_speed(FOLLOWING_SPEED + correction),
-                             -clamp_speed(FOLLOWING_SPEED - correction))
-                self._robot.set_speed(*new_speed)
-
-                logging.debug(f"{line_info=} ; {error=} ; {correction=} ; {new_speed=}")
-
-                wins.draw(frame)
-                line_info.draw(frame)
+            if self._state == State.FOLLOWING_LINE:
+                self._scheduler.run(captured.seq, captured.timestamp, data)
+                cv.imshow("black", data.black)
+            elif self._state == State.COLLECTING:
+                self._collecting_scheduler.run(captured.seq, captured.timestamp, data)
 
-            cv.imshow("frame", frame)
-            cv.imshow("black", black)
+            cv.imshow("frame", data.image)
 
             dt = time.time() - start
             delay = LOOP_INTERVAL - dt
@@ -120,33 +213,218 @@ class RobotController:
             else:
                 logging.debug(f"loop delay: {delay}")
 
+    def _follow_line(self, data: FrameData) -> Optional[FollowStep]:
+        capture_time = data.captured.timestamp - CAMERA_LATENCY
+        with self._follow_lock:
+            if MEASURED_SPEEDS:
+                self._update_odometry()
+            # the moment the new speeds are going to be applied
+            target_time = host_time() + self._robot.link_latency
+            step = self._follower.follow_mask(data.black, capture_time, target_time)
+            if step is None:
+                return None  # TODO
+
+        left, right = step.left, step.right
+        new_speed = (-left, -right)
+        sent = host_time()
+        started = self._robot.set_speed(*new_speed)
+        self._report_startup(sent)
+        with self._follow_lock:
+            self._follower.command_started(started or target_time, left, right)
+
+        if self._events is not None:
+            latency = started - capture_time if started is not None else None
+            self._events.frame(data.captured.timestamp, data.captured.seq,
+                               step.line_info.x_offset, step.line_info.angle,
+                               step.error, step.correction, left, right, latency,
+                               self._threshold.threshold if self._threshold is not None else None)
+
+        step.wins.draw(data.image)
+        step.line_info.draw(data.image)
+        return step
+
+    def _update_odometry(self):
+        since = self._odometry.time if self._odometry.time is not None else -math.inf
+        samples = self._robot.telemetry_since(since)
+        self._odometry.update(samples)
+        for t, left, right in zip(samples["time"], samples["left_speed"], samples["right_speed"]):
+            self._follower.speeds_measured(float(t), float(left), float(right))
+
+    def _sensor_loop(self):
+        """PID updates from the line sensor between the camera frames"""
+        while not self._stop_event.wait(LINE_SENSOR_INTERVAL):
+            if self._state != State.FOLLOWING_LINE:
+                continue
+            try:
+                self._follow_sensor()
+            except Exception:
+                logging.exception("Cannot follow the line sensor")
+
+    def _follow_sensor(self):
+        readings = self._robot.line_sensor_since(self._sensor_read_until)
+        if len(readings) == 0:
+            return
+        self._sensor_read_until = float(readings["time"][-1])
+
+        with self._follow_lock:
+            for t, offset in zip(readings["time"], line_offsets(readings["values"])):
+                self._follower.sensor_measured(float(t), None if np.isnan(offset) else float(offset))
+            speeds = self._follower.follow_sensor()
+            if speeds is None:
+                return
+
+        left, right, _, _ = speeds
+        target_time = host_time() + self._robot.link_latency
+        started = self._robot.set_speed(-left, -right)
+        with self._follow_lock:
+            self._follower.command_started(started or target_time, left, right)
+
+    def _detect_intersection(self, data: FrameData) -> IntersectionInfo:
+        intersection = self._intersection_detector(data.black, data.green)
+        if intersection.type is not None:
+            self._intersection_type = intersection.type
+            logging.debug(f"{intersection=}")
+        return intersection
+
+    def _detect_silver(self, data: FrameData) -> SilverInfo:
+        silver = self._silver_detector(data.image, data.profile)
+        if self._silver_detector.triggered:
+            logging.info(f"Evacuation zone entrance found: {silver=}")
+            self._enter_collecting()
+        return silver
+
+    def _detect_obstacle(self, data: FrameData) -> bool:
+        found = filled_frac(data.obstacle) > OBSTACLE_MIN_FILLED
+        self._obstacle_seen = self._obstacle_seen + 1 if found else 0
+        if self._obstacle_seen >= OBSTACLE_CONFIRM:
+            logging.info("Obstacle ahead, going around it")
+            self._obstacle_seen = 0
+            self._avoid_obstacle()
+        return found
+
+    def _avoid_obstacle(self):
+        """Blocks until the robot is past the obstacle, the line sensor's thread holds off meanwhile"""
+        self._state = State.AVOIDING_OBSTACLE
+        self._robot.stop()
+        self._robot.set_speed(-OBSTACLE_TURN_SPEED, OBSTACLE_TURN_SPEED)
+        time.sleep(OBSTACLE_TURN_TIME)
+        inner, outer = OBSTACLE_ARC_SPEEDS
+        self._robot.set_speed(-inner, -outer)
+        time.sleep(OBSTACLE_ARC_TIME)
+        self._robot.stop()
+
+        with self._follow_lock:
+            # neither the PID's state nor the predicted line survive the detour
+            self._follower = LineFollower()
+        self._state = State.FOLLOWING_LINE
+
+    def _collect_ball(self, data: FrameData) -> BallInfo:
+        info = self._ball_tracker(data.image)
+        if not self._ball_tracker.locked:
+            self._approach.reset()
+
+        speeds = self._approach.update(info, data.image.shape)
+        if self._approach.phase == ApproachPhase.GRABBING:
+            logging.info(f"Grabbing the ball: {info=}")
+            if self._grab_ball():
+                # the gripper carries one ball, another grab would drop it
+                logging.info("Holding the ball, done collecting")
+                self._state = State.IDLE
+            self._approach.reset()
+            self._ball_tracker.reset()
+        elif speeds is not None:
+            left, right = speeds
+            self._robot.set_speed(-left, -right)
+
+        if info.ball is not None:
+            info.ball.draw(data.image)
+        return info
+
+    def _grab_ball(self) -> bool:
+        """
+        Blocks until the ball is lifted, the gripper commands resolve when done.
+        Returns whether the ball is held
+        """
+        self._robot.stop()
+        try:
+            self._robot.execute_batch([Command.LowerGripper, Command.OpenGripper],
+                                      timeout=2 * GRIPPER_TIMEOUT)
+        except CommandRejected:
+            logging.error("The firmware has no gripper, the ball is left")
+            return False
+        self._robot.set_speed(-GRAB_SPEED, -GRAB_SPEED)
+        time.sleep(GRAB_DRIVE_TIME)
+        self._robot.stop()
+        self._robot.execute_batch([Command.CloseGripper, Command.LiftGripper],
+                                  timeout=2 * GRIPPER_TIMEOUT)
+        return True
+
+    def _report_startup(self, sent: float):
+        if self._startup is None:
+            return
+        # set_speed returns after the round trip, the mark is when the command went out
+        self._startup.mark("first SetSpeed", at=sent)
+        logging.info(self._startup.report())
+        self._startup = None
+
+    def _enter_collecting(self):
+        self._state = State.COLLECTING
+        self._silver_detector.reset()
+        self._ball_tracker.reset()
+        self._approach.reset()
+        self._robot.stop()
+
     def _button_handler(self, _):
         self._can_go = not self._can_go
-        time.sleep(0.2)
         self._robot.stop()
 
     def shutdown(self):
+        self._stop_event.set()
+        if self._sensor_thread is not None:
+            self._sensor_thread.join()
         self._robot.shutdown()
-        GPIO.cleanup()
+        self._gpio.cleanup()
+        if self._events is not None:
+            self._events.close()
 
 
 def main():
+    startup = StartupTimer()
+    startup.mark("imported")
+
     script_dir = os.path.dirname(os.path.realpath(__file__))
     color_ranges_path = os.path.abspath(os.path.join(script_dir, "../colors.csv"))
     logging.info(f"Loading color ranges from {color_ranges_path}")
     try:
-        colors.load_color_ranges(color_ranges_path)
-        colors.save_color_ranges(color_ranges_path)
+        colors.set_profile(colors.load_profile(color_ranges_path))
     except Exception as e:
         logging.error(f"Could not load color ranges: {e}")
-
-    robot = RobotController()
+    colors.ProfileWatcher(color_ranges_path).start()
+
+    events = None
+    if EVENT_LOG_DIR:
+        os.makedirs(EVENT_LOG_DIR, exist_ok=True)
+        events_path = os.path.join(EVENT_LOG_DIR, time.strftime("events-%Y%m%d-%H%M%S.bin"))
+        logging.info(f"Logging events to {events_path}")
+        events = EventLog(events_path)
+
+    # warmed up, and then used by the controller
+    segmentation = SegmentationContext(line_band_shape())
+    # none of these depends on the others, and each of them mostly waits
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        cap = pool.submit(startup.call, "camera", BufferlessCapture, 0)
+        robot = pool.submit(startup.call, "serial", Robot, events)
+        warm_up = pool.submit(startup.call, "vision warm-up",
+                              warm_up_vision, CAPTURE_RESOLUTION[::-1], segmentation)
+        warm_up.result()
+        controller = RobotController(robot.result(), cap.result(), startup, events, segmentation)
+    startup.mark("controller ready")
 
     try:
-        robot.loop()
+        controller.loop()
     except KeyboardInterrupt:
         logging.info("Shutting down...")
-        robot.shutdown()
+        controller.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+"""
+Dead reckoning from the wheel telemetry.
+
+The conventions are DifferentialDrive's: the heading is counter-clockwise,
+positions and speeds are in the controller's convention and the units of SetSpeedParams.
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .settings import TRACK_WIDTH
+
+
+class Odometry:
+    def __init__(self, track_width: float = TRACK_WIDTH) -> None:
+        self.track_width = track_width
+
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0  # rad
+        # of the latest sample, None before the first one
+        self.time: Optional[float] = None
+        self.speeds: Tuple[float, float] = (0.0, 0.0)
+
+        self._positions: Optional[Tuple[float, float]] = None
+
+    def update(self, samples: np.ndarray) -> None:
+        """samples are records of interfacing_py's TELEMETRY_DTYPE, the oldest first"""
+        if len(samples) == 0:
+            return
+
+        left = samples["left_position"].astype(np.float64)
+        right = samples["right_position"].astype(np.float64)
+        if self._positions is None:
+            self._positions = (left[0], right[0])
+
+        left_delta = np.diff(left, prepend=self._positions[0])
+        right_delta = np.diff(right, prepend=self._positions[1])
+        distance = (left_delta + right_delta) / 2
+        rotation = (right_delta - left_delta) / self.track_width
+
+        headings = self.heading + np.cumsum(rotation)
+        midpoints = headings - rotation / 2
+        self.x += float(np.sum(distance * np.cos(midpoints)))
+        self.y += float(np.sum(distance * np.sin(midpoints)))
+        self.heading = float(headings[-1])
+
+        self._positions = (left[-1], right[-1])
+        last = samples[-1]
+        self.time = float(last["time"])
+        self.speeds = (float(last["left_speed"]), float(last["right_speed"]))
+
+    def reset(self, x: float = 0.0, y: float = 0.0, heading: float = 0.0) -> None:
+        """Moves the origin, the wheels' positions are kept"""
+        self.x, self.y, self.heading = x, y, heading
@@ -0,0 +1,163 @@
+"""
+Sampling profiler of the whole process, for finding where an overrunning loop spends its time.
+
+A thread takes the stacks of all the other threads from sys._current_frames()
+every few milliseconds, so the capture thread and the interfacing loop show up
+next to the control loop, and nothing is traced in between. When it is off, the
+loop only checks a counter per iteration.
+
+It writes collapsed stacks, one "thread;outer;...;inner count" line per stack,
+for flamegraph.pl or speedscope, and a summary of the samples per function.
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from .settings import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_ITERATIONS
+
+Stack = Tuple[str, ...]  # thread name first, the innermost frame last
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL, max_depth: int = 64) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._labels: Dict[object, str] = {}  # by code object
+        self._thread_names: Dict[int, str] = {}
+
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[self._stack(ident, frame)] += 1
+            self.samples += 1
+
+    def _stack(self, ident: int, frame) -> Stack:
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                self._labels[code] = label
+            labels.append(label)
+            frame = frame.f_back
+        return (self._thread_name(ident), *reversed(labels))
+
+    def _thread_name(self, ident: int) -> str:
+        name = self._thread_names.get(ident)
+        if name is None:
+            self._thread_names = {t.ident: t.name for t in threading.enumerate()}
+            name = self._thread_names.get(ident, str(ident))
+        return name
+
+    def collapsed(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n"
+                       for stack, count in self.stacks.most_common())
+
+    def summary(self, limit: int = 40) -> str:
+        """Functions by the samples they are on the stack in, and the ones they are running in"""
+        total: Counter = Counter()
+        own: Counter = Counter()
+        threads: Counter = Counter()
+        for (thread, *frames), count in self.stacks.items():
+            threads[thread] += count
+            for label in set(frames):
+                total[label] += count
+            if frames:
+                own[frames[-1]] += count
+
+        ms_per_sample = self.interval * 1000
+        lines = [f"{self.samples} samples every {ms_per_sample:.1f} ms", "",
+                 f"{'thread':<40} {'samples':>8}"]
+        lines += [f"{thread:<40} {count:>8}" for thread, count in threads.most_common()]
+        lines += ["", f"{'total':>8} {'own':>8} {'total %':>8}  function"]
+        for label, count in total.most_common(limit):
+            lines.append(f"{count:>8} {own[label]:>8} {100 * count / max(self.samples, 1):>7.1f}%  {label}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, prefix: str) -> Tuple[str, str]:
+        """Writes prefix.collapsed and prefix.txt"""
+        collapsed_path, summary_path = f"{prefix}.collapsed", f"{prefix}.txt"
+        with open(collapsed_path, "w") as f:
+            f.write(self.collapsed())
+        with open(summary_path, "w") as f:
+            f.write(self.summary())
+        return collapsed_path, summary_path
+
+
+class LoopProfiler:
+    """
+    Profiles the next iterations of a loop, on request or on a signal.
+    iteration() has to be called at the start of every iteration.
+    """
+
+    def __init__(self, out_dir: str = PROFILE_DIR, iterations: int = PROFILE_ITERATIONS,
+                 signum: Optional[int] = signal.SIGUSR1) -> None:
+        """iterations - profiled right from the start if positive, and after every signal"""
+        self.out_dir = out_dir
+        self.iterations = max(iterations, 0) or 100
+        self._requested = max(iterations, 0)
+        self._remaining = 0
+        self._profiler: Optional[SamplingProfiler] = None
+
+        if signum is not None:
+            # only the main thread can install it, the handler just sets the counter
+            signal.signal(signum, lambda *_: self.request())
+
+    def request(self, iterations: Optional[int] = None) -> None:
+        self._requested = iterations or self.iterations
+
+    def iteration(self) -> None:
+        if self._requested == 0 and self._profiler is None:
+            return
+
+        if self._profiler is None:
+            self._remaining, self._requested = self._requested, 0
+            logging.info(f"Profiling {self._remaining} iterations")
+            self._profiler = SamplingProfiler()
+            self._profiler.start()
+            return
+
+        self._remaining -= 1
+        if self._remaining <= 0:
+            profiler, self._profiler = self._profiler, None
+            # written from another thread, so that the loop does not wait for the disk
+            threading.Thread(target=self._finish, args=(profiler,),
+                             name="profiler-writer", daemon=True).start()
+
+    def _finish(self, profiler: SamplingProfiler) -> None:
+        profiler.stop()
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            prefix = os.path.join(self.out_dir, time.strftime("profile-%Y%m%d-%H%M%S"))
+            collapsed, summary = profiler.write(prefix)
+            logging.info(f"Profile of {profiler.samples} samples written to {collapsed} and {summary}")
+        except OSError:
+            logging.exception("Cannot write the profile")
@@ -2,23 +2,27 @@ import asyncio
 import threading
 import concurrent.futures
 import time
-from typing import Optional
+from typing import Optional, Sequence, Tuple
 import logging
 
-from interfacing_py import InterfacingManager, PyCommand, Command, SetSpeedParams
+import numpy as np
 
+from interfacing_py import InterfacingManager, PyCommand, Command, SetSpeedParams, ClockSync, host_time
+
+from .eventlog import EventLog
 from .settings import *
 
 
 class Robot:
-    def __init__(self) -> None:
+    def __init__(self, events: Optional[EventLog] = None) -> None:
         self.steps_per_rev = STEPS_PER_REV
+        self._events = events
 
         self._loop = asyncio.new_event_loop()
         interfacing_future = concurrent.futures.Future()
         self._loop_th = threading.Thread(target=Robot._background_loop,
                                          args=(self._loop, interfacing_future),
-                                         daemon=True)
+                                         name="interfacing", daemon=True)
         self._loop_th.start()
 
         self._interfacing = interfacing_future.result(timeout=1)
@@ -38,28 +42,113 @@ class Robot:
     def _background_loop(loop: asyncio.AbstractEventLoop,
                          interfacing: concurrent.futures.Future) -> None:
         asyncio.set_event_loop(loop)
-        interfacing.set_result(InterfacingManager(SERIAL_PORT, loop))
+        interfacing.set_result(InterfacingManager(SERIAL_PORT, loop, compact=COMPACT_FRAMING))
         loop.run_forever()
 
-    def set_speed(self, left: int, right: int, timeout: Optional[float] = None):
+    @property
+    def clock(self) -> ClockSync:
+        return self._interfacing.clock
+
+    @property
+    def link_latency(self) -> float:
+        """Estimated time for a command to get to the embedded side"""
+        delay = self.clock.delay
+        if delay is None:
+            return LINK_LATENCY
+        return delay / 2
+
+    def telemetry_since(self, time: float) -> np.ndarray:
+        """
+        The wheels' samples newer than time, the oldest first, in the convention of set_speed.
+        Empty until the clocks are synchronized.
+        """
+        samples = self._interfacing.telemetry.since(time)
+        for field in ("left_position", "right_position", "left_speed", "right_speed"):
+            samples[field] *= -1
+        return samples
+
+    def line_sensor_since(self, time: float) -> np.ndarray:
+        """The line sensor readings newer than time, the oldest first. Empty until the clocks are synchronized"""
+        return self._interfacing.line_sensor.since(time)
+
+    def set_speed(self, left: int, right: int,
+                  timeout: Optional[float] = None) -> Optional[float]:
         if NO_MOVEMENT:
-            return
+            return None
+
+        return self._execute_command(Command.SetSpeed,
+                                     SetSpeedParams(-left, -right),
+                                     timeout, speeds=(left, right))
+
+    def stop(self, timeout: Optional[float] = None) -> Optional[float]:
+        """Goes ahead of the queued speed updates and cancels them"""
+        return self._execute_command(Command.Stop, timeout=timeout, priority=True)
+
+    def open_gripper(self, timeout: Optional[float] = None) -> Optional[float]:
+        return self._execute_gripper_command(Command.OpenGripper, timeout)
+
+    def close_gripper(self, timeout: Optional[float] = None) -> Optional[float]:
+        return self._execute_gripper_command(Command.CloseGripper, timeout)
 
-        self._execute_command(PyCommand(Command.SetSpeed,
-                              SetSpeedParams(-left, -right)),
-                              timeout)
+    def lift_gripper(self, timeout: Optional[float] = None) -> Optional[float]:
+        return self._execute_gripper_command(Command.LiftGripper, timeout)
 
-    def stop(self, timeout: Optional[float] = None):
-        self._execute_command(PyCommand(Command.Stop), timeout)
+    def lower_gripper(self, timeout: Optional[float] = None) -> Optional[float]:
+        return self._execute_gripper_command(Command.LowerGripper, timeout)
 
-    def _execute_command(self, cmd: PyCommand, timeout: Optional[float] = None):
+    def execute_batch(self, commands: Sequence[Command],
+                      timeout: Optional[float] = None) -> Optional[float]:
+        """
+        Runs the commands one after another on the embedded side with a single round trip,
+        blocks until the last one is done. Only the commands without parameters.
+        """
+        if NO_MOVEMENT:
+            return None
+
+        return self._execute_command(Command.Batch, [PyCommand(c) for c in commands],
+                                     timeout=timeout)
+
+    def _execute_gripper_command(self, cmd: Command,
+                                 timeout: Optional[float] = None) -> Optional[float]:
+        if NO_MOVEMENT:
+            return None
+
+        return self._execute_command(cmd, timeout=timeout)
+
+    def _execute_command(self, command: Command, params=None,
+                         timeout: Optional[float] = None,
+                         speeds: Tuple[int, int] = (0, 0),
+                         priority: bool = False) -> Optional[float]:
+        """
+        Returns the host time at which the command has started executing, if it is known.
+        A motion command preempted by a stop returns None.
+        """
         fut = asyncio.run_coroutine_threadsafe(
-                        self._command_future_wrapper(cmd),
+                        self._command_future_wrapper(command, params, speeds, priority),
                         self._loop)
-        fut.result(timeout=timeout)
+        return fut.result(timeout=timeout)
 
-    async def _command_future_wrapper(self, cmd: PyCommand):
-        await self._interfacing.execute(cmd)
+    async def _command_future_wrapper(self, command: Command, params,
+                                      speeds: Tuple[int, int],
+                                      priority: bool) -> Optional[float]:
+        queued = host_time()
+        if priority:
+            id_, future = self._interfacing.emergency_stop()
+        else:
+            id_, future = self._interfacing.execute_with_id(PyCommand(command, params))
+        if self._events is not None:
+            self._events.command(queued, id_, int(command), *speeds)
+
+        try:
+            started = await future
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            logging.debug(f"Command {id_} was dropped by a stop")
+            return None
+        if self._events is not None:
+            self._events.command_started(queued, id_, started)
+        return started
 
     def _to_steps(self, speed: float) -> int:
         return int(speed * self.steps_per_rev)
@@ -4,10 +4,72 @@ NO_MOVEMENT = bool(int(os.getenv("NO_MOVE", default=0)))
 
 LOOP_INTERVAL = 1 / 10
 
+# vision scheduling, the budget is per frame, the rates are in Hz
+VISION_BUDGET = LOOP_INTERVAL / 2
+INTERSECTION_RATE = 10
+SILVER_RATE = 5
+OBSTACLE_RATE = 5
+
+OBSTACLE_MIN_FILLED = 0.3
+OBSTACLE_CONFIRM = 2  # detections in a row, a single one may be noise
+# going around an obstacle on its right, timed; to be tuned on the robot
+OBSTACLE_TURN_SPEED = 200  # sps, turning away in place
+OBSTACLE_TURN_TIME = 0.8  # s, about a quarter turn
+OBSTACLE_ARC_SPEEDS = (150, 300)  # sps of the left (inner) and the right wheel
+OBSTACLE_ARC_TIME = 3.0  # s, until the line is ahead again
+
+# ball collection
+APPROACH_SPEED = 200  # sps
+APPROACH_GAINS = (200.0, 0.0, 0.0)  # Kp, Ki, Kd of the steering, the error is in frame half widths
+SEARCH_SPEED = 100  # sps, turning in place while there is no ball in sight
+GRAB_SPEED = 150  # sps, driving onto the ball with the gripper lowered
+GRAB_DRIVE_TIME = 0.5  # s
+GRAB_BOTTOM_RATIO = 0.9  # of the frame height, the ball's bottom edge is this low when it is in reach
+GRAB_MAX_ERROR = 0.15  # of the frame half width
+GRIPPER_TIMEOUT = 3.0  # s
+
 FOLLOWING_SPEED = 300  # sps
 MAX_SPEED = 500
 LINE_TARGET_X = 175 - 52
+PID_GAINS = (1.0, 0.0, 0.0)  # Kp, Ki, Kd of the line following, correction is in sps
 
 SERIAL_PORT =  "/dev/ttyACM0"
+# speed updates and their acks in the short framing of interfacing::compact, needs the new firmware
+COMPACT_FRAMING = bool(int(os.getenv("COMPACT_FRAMING", default=1)))
+# the line prediction uses the wheels' telemetry instead of the commanded speeds, needs the new firmware
+MEASURED_SPEEDS = bool(int(os.getenv("MEASURED_SPEEDS", default=1)))
+# the PID is updated from the reflectance line sensor between the camera frames, needs the firmware
+# built with the line-stream feature; off until LINE_SENSOR_SPACING and the sensors' order are checked on the robot
+LINE_SENSOR_FUSION = bool(int(os.getenv("LINE_SENSOR_FUSION", default=0)))
+
+# binary event log of the control loop, see main.eventlog; empty to disable
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", default=os.path.join(os.path.dirname(__file__), "../logs"))
+
+# sampling profiler of the loop, see main.profiling: PROFILE=n profiles the first n iterations,
+# SIGUSR1 the next n (100 if not set)
+PROFILE_ITERATIONS = int(os.getenv("PROFILE", default=0))
+PROFILE_INTERVAL = 0.002  # s
+PROFILE_DIR = os.getenv("PROFILE_DIR", default=os.path.join(os.path.dirname(__file__), "../logs"))
 
 STEPS_PER_REV = 16 * 200
+
+# latency compensation
+CAMERA_LATENCY = 0.03  # s, exposure and transfer, not visible in the capture timestamps
+LINK_LATENCY = 0.005  # s, used until the clocks are synchronized
+MAX_PREDICTION_HORIZON = 0.5  # s
+# rough geometry, all distances are in motor steps
+TRACK_WIDTH = 2900  # between the wheels
+CAMERA_LOOKAHEAD = 1800  # from the wheel axis to the line band
+PX_PER_STEP = 0.05  # at the line band
+
+# the upper L of black follows the lighting, see vision.threshold
+ADAPTIVE_BLACK = bool(int(os.getenv("ADAPTIVE_BLACK", default=0)))
+
+# bird's-eye rectification of the line band, a calibration file of vision.rectify; empty to disable.
+# The geometry above is measured in the camera's view, it has to be adjusted when this is on
+RECTIFY_CALIBRATION = os.getenv("RECTIFY_CALIBRATION", default="")
+
+# reflectance line sensor
+LINE_SENSOR_INTERVAL = 0.02  # s, between the PID updates from it
+LINE_SENSOR_SPACING = 150  # steps between the neighbouring sensors
+LINE_SENSOR_CONTRAST = 110  # the line's drop below the brightest sensor, EDGE_THRESHOLD of the firmware
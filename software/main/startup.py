@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from interfacing_py import host_time
+
+if TYPE_CHECKING:
+    from vision.segmentation import SegmentationContext
+
+
+def process_start_time() -> float:
+    """When the process was started, in host_time, the interpreter startup included"""
+    try:
+        with open("/proc/self/stat") as f:
+            stat = f.read()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except OSError:
+        return host_time()
+
+    # the name of the executable can contain spaces, the fields after it can not
+    fields = stat[stat.rindex(")") + 2:].split()
+    start_ticks = int(fields[19])  # starttime, the 22nd field
+    running_for = uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    return host_time() - max(running_for, 0.0)
+
+
+class StartupTimer:
+    """
+    Collects the phases of startup, which may run in parallel,
+    and the moments of interest, relative to the process start.
+    """
+
+    def __init__(self) -> None:
+        self.start = process_start_time()
+        self._lock = threading.Lock()
+        # (name, start, end), the marks have start == end
+        self._phases: List[Tuple[str, float, float]] = []
+
+    def mark(self, name: str, at: Optional[float] = None) -> None:
+        """at - the host_time of the moment, now by default"""
+        if at is None:
+            at = host_time()
+        with self._lock:
+            self._phases.append((name, at, at))
+
+    def call(self, name: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        start = host_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            end = host_time()
+            with self._lock:
+                self._phases.append((name, start, end))
+
+    def report(self) -> str:
+        with self._lock:
+            phases = sorted(self._phases, key=lambda p: p[1])
+        lines = ["startup (since the process start, ms):"]
+        for name, start, end in phases:
+            begin_ms = (start - self.start) * 1000
+            if end == start:
+                lines.append(f"  {name:<20} at {begin_ms:7.1f}")
+            else:
+                end_ms = (end - self.start) * 1000
+                lines.append(f"  {name:<20} {begin_ms:7.1f} - {end_ms:7.1f} ({end_ms - begin_ms:.1f})")
+        return "\n".join(lines)
+
+
+def warm_up_vision(shape: Tuple[int, int], segmentation: SegmentationContext) -> None:
+    """
+    Runs the vision pipeline once on a dummy frame, so that the lazily imported
+    modules are imported and OpenCV's first-call costs are paid before the run.
+    The masks are found with the segmentation the controller is going to use, into its buffers.
+    """
+    from vision import ball, intersection, line, silver
+
+    from .following import line_band
+
+    img = np.full((*shape, 3), 255, dtype=np.uint8)
+
+    band = line_band(img)
+    lab = segmentation.convert(band)
+    segmentation.find(lab, "black")
+    segmentation.find(lab, "obstacle")
+    green = segmentation.find(lab, "green")
+    # whether the dummy line is black depends on the profile, the mask is drawn instead
+    mask = np.zeros(band.shape[:2], dtype=np.uint8)
+    mask[:, shape[1] // 2 - 5:shape[1] // 2 + 5] = 255
+    wins = line.find_line_window_pair(mask)
+    if wins != line.WindowPair.empty():
+        line.locate_line(wins)
+    intersection.detect_intersection(mask, green)
+    silver.detect_silver(img)
+    ball.find_balls(img, ball.search_scale(img, ball.BALL_SEARCH_WIDTH))
+
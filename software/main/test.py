@@ -0,0 +1,259 @@
+import math
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from simulation.kinematics import DifferentialDrive
+from simulation.track import Pose
+from vision.ball import Ball, BallInfo
+from vision.line import LineInfo
+
+from .approach import ApproachPhase, BallApproach
+from .eventlog import EventKind, EventLog, read_log, to_csv
+from .following import LineFollower, LinePredictor, SensorFusion
+from .line_sensor import line_offsets
+from .odometry import Odometry
+from .profiling import LoopProfiler, SamplingProfiler
+from .settings import *
+
+FRAME_SHAPE = (240, 320, 3)
+
+
+def ball_info(x: float, y: float, radius: float = 20) -> BallInfo:
+    return BallInfo(Ball(x, y, radius), tracked=True, elapsed=0.0)
+
+
+def no_ball() -> BallInfo:
+    return BallInfo(None, tracked=False, elapsed=0.0)
+
+
+def test_approach_searches_without_ball():
+    approach = BallApproach()
+    assert approach.update(no_ball(), FRAME_SHAPE) == (SEARCH_SPEED, -SEARCH_SPEED)
+    assert approach.phase == ApproachPhase.SEARCHING
+
+
+def test_approach_drives_straight_at_centered_ball():
+    approach = BallApproach()
+    assert approach.update(ball_info(160, 60), FRAME_SHAPE) == (APPROACH_SPEED, APPROACH_SPEED)
+    assert approach.phase == ApproachPhase.APPROACHING
+
+
+def test_approach_steers_symmetrically():
+    left_speeds = BallApproach().update(ball_info(80, 60), FRAME_SHAPE)
+    right_speeds = BallApproach().update(ball_info(240, 60), FRAME_SHAPE)
+    # by a good part of the speed, not a rounding error
+    assert abs(left_speeds[0] - left_speeds[1]) > APPROACH_SPEED / 2
+    assert left_speeds == right_speeds[::-1]
+
+
+def test_approach_keeps_speeds_over_missed_frame():
+    approach = BallApproach()
+    speeds = approach.update(ball_info(200, 60), FRAME_SHAPE)
+    assert approach.update(no_ball(), FRAME_SHAPE) == speeds
+    assert approach.phase == ApproachPhase.APPROACHING
+
+
+def test_approach_turns_in_place_to_ball_in_reach():
+    approach = BallApproach()
+    left, right = approach.update(ball_info(280, 220), FRAME_SHAPE)
+    assert left == -right != 0
+    assert approach.phase == ApproachPhase.APPROACHING
+
+
+def test_approach_grabs_centered_ball_in_reach_until_reset():
+    approach = BallApproach()
+    assert approach.update(ball_info(165, 220), FRAME_SHAPE) is None
+    assert approach.phase == ApproachPhase.GRABBING
+    # whatever is seen meanwhile, until the grab is over
+    assert approach.update(no_ball(), FRAME_SHAPE) is None
+
+    approach.reset()
+    assert approach.phase == ApproachPhase.SEARCHING
+    assert approach.update(no_ball(), FRAME_SHAPE) == (SEARCH_SPEED, -SEARCH_SPEED)
+
+
+def test_event_log_overflow_records_dropped(tmp_path):
+    path = tmp_path / "events.bin"
+    log = EventLog(str(path), capacity=4, flush_interval=60)
+    for seq in range(10):
+        log.frame(seq * 0.1, seq, seq, None, 0.0, 0.0, 100, 100, None)
+    log.flush()
+    log.frame(1.0, 10, 10, None, 0.0, 0.0, 100, 100, None)
+    log.close()
+
+    events = read_log(str(path))
+    assert list(events["kind"]) == [EventKind.DROPPED] + [EventKind.FRAME] * 5
+    assert events["seq"][0] == 6
+    assert list(events["seq"][1:]) == [6, 7, 8, 9, 10]
+
+
+def test_event_log_round_trip(tmp_path):
+    path = tmp_path / "events.bin"
+    log = EventLog(str(path), flush_interval=60)
+    log.frame(1.0, 3, -12, 0.25, 1.5, -2.5, 280, 320, 0.04, black_threshold=75)
+    log.command(1.01, 7, 1, 280, 320)
+    log.command_started(1.01, 7, 1.03)
+    log.command_started(1.02, 8, None)
+    log.close()
+    # a record cut short by a killed process is left out
+    with open(path, "ab") as f:
+        f.write(b"\0" * 5)
+
+    events = read_log(str(path))
+    assert list(events["kind"]) == [EventKind.FRAME, EventKind.COMMAND,
+                                    EventKind.COMMAND_STARTED, EventKind.COMMAND_STARTED]
+    frame, command, started, unsynced = events
+    assert (frame["seq"], frame["x_offset"], frame["left"], frame["right"]) == (3, -12, 280, 320)
+    assert frame["angle"] == pytest.approx(0.25)
+    assert frame["black_threshold"] == 75
+    assert (command["command_id"], command["command"]) == (7, 1)
+    assert started["latency"] == pytest.approx(0.02)
+    assert np.isnan(unsynced["timestamp"]) and np.isnan(unsynced["latency"])
+
+    csv_path = tmp_path / "events.csv"
+    to_csv(events, str(csv_path))
+    header, *rows = [text.split(",") for text in csv_path.read_text().splitlines()]
+    assert header == list(events.dtype.names)
+    assert [row[0] for row in rows] == ["FRAME", "COMMAND", "COMMAND_STARTED", "COMMAND_STARTED"]
+    columns = {name: i for i, name in enumerate(header)}
+    for row, event in zip(rows, events):
+        for name in ("timestamp", "seq", "x_offset", "angle", "left", "command_id", "latency"):
+            value = float(row[columns[name]])
+            assert value == pytest.approx(float(event[name]), nan_ok=True)
+
+
+def telemetry_samples(times, left_positions, right_positions, left_speeds, right_speeds):
+    samples = np.zeros(len(times), dtype=[("time", np.float64), ("left_position", np.float32),
+                                          ("right_position", np.float32), ("left_speed", np.float32),
+                                          ("right_speed", np.float32)])
+    samples["time"] = times
+    samples["left_position"], samples["right_position"] = left_positions, right_positions
+    samples["left_speed"], samples["right_speed"] = left_speeds, right_speeds
+    return samples
+
+
+def test_odometry_tracks_drive():
+    drive = DifferentialDrive(Pose(0.0, 0.0, 0.0))
+    odometry = Odometry()
+    for t, left, right in [(0.0, 300, 300), (1.0, 400, 200), (2.0, 150, 350)]:
+        drive.command(t, left, right)
+
+    # the first sample is the origin
+    dt = 0.02
+    times = np.arange(151) * dt
+    left = np.zeros(len(times))
+    right = np.zeros(len(times))
+    for i in range(1, len(times)):
+        drive.advance(times[i])
+        left[i] = left[i - 1] + drive.speeds[0] * dt
+        right[i] = right[i - 1] + drive.speeds[1] * dt
+    samples = telemetry_samples(times, left, right, 0, 0)
+
+    # in chunks, as the controller reads them
+    for chunk in np.array_split(samples, 7):
+        odometry.update(chunk)
+
+    assert odometry.x == pytest.approx(drive.pose.x, abs=5)
+    assert odometry.y == pytest.approx(drive.pose.y, abs=5)
+    assert odometry.heading == pytest.approx(drive.pose.heading, abs=0.01)
+    assert odometry.time == pytest.approx(times[-1])
+
+
+def test_prediction_prefers_measured_speeds():
+    commanded = LinePredictor()
+    commanded.add_observation(0.0, LineInfo(0, 0.1))
+    commanded.add_command(0.0, 400, 200)
+
+    measured = LinePredictor()
+    measured.add_observation(0.0, LineInfo(0, 0.1))
+    measured.add_command(0.0, 300, 300)
+    for t in np.arange(0.0, 0.21, 0.02):
+        measured.add_measurement(t, 400, 200)
+
+    assert measured.predict(0.2).x_offset == commanded.predict(0.2).x_offset
+    assert measured.predict(0.2).angle == pytest.approx(commanded.predict(0.2).angle)
+    # the commanded speeds are used after the last measurement
+    assert measured.predict(0.4).x_offset != commanded.predict(0.4).x_offset
+
+
+def test_line_sensor_offsets():
+    readings = np.array([
+        [900, 900, 400, 400, 900, 900],  # centered
+        [900, 900, 900, 900, 400, 900],  # right
+        [900, 890, 900, 880, 900, 900],  # noise only
+        ])
+    offsets = line_offsets(readings)
+    assert offsets[0] == pytest.approx(0)
+    assert offsets[1] > 0
+    assert math.isnan(offsets[2])
+
+
+def test_sensor_fusion_adds_drift_since_frame():
+    fusion = SensorFusion()
+    fusion.add_sensor(0.9, 10.0)
+    fusion.add_camera(1.0, 0.2, 0.01)
+    assert fusion.error() is None  # nothing newer than the frame
+
+    fusion.add_sensor(1.05, 30.0)
+    assert fusion.error() == (1.05, pytest.approx(0.2 + 0.01 * 20))
+
+    fusion.add_sensor(1.1, None)
+    assert fusion.error() is None
+    fusion.add_sensor(1.0 + fusion.max_age + 0.1, 30.0)
+    assert fusion.error() is None
+
+
+def test_follower_uses_sensor_reading_once():
+    follower = LineFollower(gains=(100.0, 0.0, 0.0))
+    follower.sensor_measured(0.0, 0.0)
+    follower.follow(LineInfo(0, 0.0), 100, 0.05, 0.05)
+    follower.sensor_measured(0.1, 50.0)
+
+    left, right, error, _ = follower.follow_sensor()
+    # the same way as to a line on the right in the frame
+    camera = LineFollower(gains=(100.0, 0.0, 0.0))
+    camera_left, camera_right, _, _ = camera.follow(LineInfo(25, 0.0), 100, 0.05, 0.05)
+    assert error > 0
+    assert (left < right) == (camera_left < camera_right)
+    assert follower.follow_sensor() is None
+
+
+def busy_wait(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler_sees_other_threads():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_wait, args=(stop,), name="busy")
+    worker.start()
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.1)
+    profiler.stop()
+    stop.set()
+    worker.join()
+
+    assert profiler.samples > 10
+    busy = [line for line in profiler.collapsed().splitlines() if line.startswith("busy;")]
+    assert any("busy_wait (test.py:" in line for line in busy)
+    assert "busy_wait (test.py:" in profiler.summary()
+
+
+def test_loop_profiler_writes_after_iterations(tmp_path):
+    profiler = LoopProfiler(str(tmp_path), iterations=0, signum=None)
+    profiler.iteration()
+    assert not list(tmp_path.iterdir())
+
+    profiler.request(3)
+    for _ in range(4):
+        profiler.iteration()
+        time.sleep(0.01)
+    for _ in range(100):
+        if len(list(tmp_path.iterdir())) == 2:
+            break
+        time.sleep(0.01)
+    assert sorted(p.suffix for p in tmp_path.iterdir()) == [".collapsed", ".txt"]
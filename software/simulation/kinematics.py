@@ -0,0 +1,51 @@
+import math
+from collections import deque
+from typing import Deque, Tuple
+
+from main.settings import TRACK_WIDTH
+
+from .track import Pose
+
+
+class DifferentialDrive:
+    """
+    Kinematics of the robot driven by SetSpeedParams' (left, right), in steps per second.
+    Commands take effect after a delay, as they do on the robot.
+
+    The conventions are LinePredictor's: left > right turns the robot clockwise,
+    which moves the line to the right in the frame.
+    """
+
+    def __init__(self, pose: Pose, track_width: float = TRACK_WIDTH) -> None:
+        self.pose = pose
+        self.track_width = track_width
+        self.time = 0.0
+        self.speeds: Tuple[float, float] = (0.0, 0.0)
+        self._pending: Deque[Tuple[float, float, float]] = deque()
+
+    def command(self, time: float, left: float, right: float) -> None:
+        """The speeds are going to be applied at the given time"""
+        self._pending.append((time, left, right))
+
+    def advance(self, until: float, max_step: float = 0.005) -> None:
+        while self.time < until:
+            if self._pending and self._pending[0][0] <= self.time:
+                _, left, right = self._pending.popleft()
+                self.speeds = (left, right)
+
+            step = min(max_step, until - self.time)
+            if self._pending:
+                step = min(step, max(self._pending[0][0] - self.time, 1e-6))
+            self._integrate(step)
+            self.time += step
+
+    def _integrate(self, dt: float) -> None:
+        left, right = self.speeds
+        speed = (left + right) / 2
+        rotation = (right - left) / self.track_width  # counter-clockwise
+
+        pose = self.pose
+        heading = pose.heading + rotation * dt / 2  # midpoint
+        pose.x += speed * math.cos(heading) * dt
+        pose.y += speed * math.sin(heading) * dt
+        pose.heading += rotation * dt
@@ -0,0 +1,192 @@
+"""
+Closed loop line following on a synthetic track.
+
+Frames are rendered from the robot's pose and go through the same vision and
+PID code as on the robot; the speeds drive a kinematic model with the latencies
+of main.settings. Simulated time does not depend on how long the computation takes,
+so it runs as fast as the vision does.
+"""
+import argparse
+import math
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from main.following import LineFollower, line_band
+from main.settings import CAMERA_LATENCY, CAMERA_LOOKAHEAD, FOLLOWING_SPEED, \
+                          LINK_LATENCY, LOOP_INTERVAL, PID_GAINS, PX_PER_STEP
+from vision import colors
+from vision.camera import CAPTURE_RESOLUTION
+
+from .kinematics import DifferentialDrive
+from .track import FIELD_COLOR, Pose, Track, default_track
+
+# the rendered line is dark gray whatever the calibrated ranges are
+SIM_PROFILE = colors.DEFAULT_PROFILE.replace("black", ((0, 0, 0), (60, 255, 255)))
+# settings.PID_GAINS are placeholders until the robot is tuned, these complete default_track
+SIM_GAINS = (600.0, 0.0, 0.0)
+OFF_TRACK_DISTANCE = 3000  # steps from the centerline, the run is failed
+FINISH_MARGIN = 1500  # steps before the end of the track
+
+
+class Camera:
+    """
+    Top-down camera with the line band centered CAMERA_LOOKAHEAD ahead of the wheel axis.
+    The frame's x grows to the robot's left, which is the orientation the controller's
+    signs assume, see LinePredictor.
+    """
+
+    def __init__(self, track: Track, resolution=CAPTURE_RESOLUTION) -> None:
+        self.track = track
+        self.width, self.height = resolution
+        band_height = line_band(np.empty((self.height, self.width), dtype=np.uint8)).shape[0]
+        # distance from the wheel axis to the frame's bottom row
+        self.near = CAMERA_LOOKAHEAD - band_height / 2 / PX_PER_STEP
+
+    def frame_to_world(self, pose: Pose, u: float, v: float) -> np.ndarray:
+        forward = self.near + (self.height - 1 - v) / PX_PER_STEP
+        left = (u - self.width / 2) / PX_PER_STEP
+        cos, sin = math.cos(pose.heading), math.sin(pose.heading)
+        return np.array([pose.x + forward * cos - left * sin,
+                         pose.y + forward * sin + left * cos])
+
+    def render(self, pose: Pose) -> np.ndarray:
+        corners = [(0, 0), (self.width, 0), (0, self.height)]
+        src = np.float32([self.track.to_map(self.frame_to_world(pose, u, v)) for u, v in corners])
+        dst = np.float32(corners)
+        transform = cv.getAffineTransform(dst, src)
+        return cv.warpAffine(self.track.map, transform, (self.width, self.height),
+                             flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP,
+                             borderMode=cv.BORDER_CONSTANT, borderValue=FIELD_COLOR)
+
+
+@dataclass
+class RunResult:
+    speed: int
+    completed: bool
+    frames: int
+    sim_time: float  # s
+    wall_time: float  # s
+    rms_error: float  # steps from the centerline
+    max_error: float
+    lost_frames: int  # without a line found
+    compute_mean: float  # s per frame, scaled
+    compute_max: float
+    errors: List[float] = field(default_factory=list, repr=False)
+
+    @property
+    def headroom(self) -> float:
+        """Share of the frame interval left after the slowest frame"""
+        return 1 - self.compute_max / LOOP_INTERVAL
+
+    @property
+    def speedup(self) -> float:
+        return self.sim_time / self.wall_time if self.wall_time > 0 else math.inf
+
+
+class Simulation:
+    def __init__(self, track: Optional[Track] = None, speed: int = FOLLOWING_SPEED,
+                 gains: Tuple[float, float, float] = SIM_GAINS,
+                 compute_scale: float = 1.0, show: bool = False) -> None:
+        """compute_scale - how many times the robot's computer is slower than this one"""
+        self.track = track or default_track()
+        self.camera = Camera(self.track)
+        self.drive = DifferentialDrive(self.track.start)
+        self.follower = LineFollower(speed, gains)
+        self.speed = speed
+        self.compute_scale = compute_scale
+        self.show = show
+
+        # the first call imports what is imported lazily, it is not a part of the run
+        black = colors.find_black(line_band(self.camera.render(self.drive.pose)), profile=SIM_PROFILE)
+        LineFollower(speed, gains).follow_mask(black, 0.0, 0.0)
+
+    def run(self, max_time: float = 300.0) -> RunResult:
+        errors = []
+        computes = []
+        lost = 0
+        completed = False
+        wall_start = time.perf_counter()
+
+        frame_time = 0.0
+        while frame_time < max_time:
+            self.drive.advance(frame_time)
+            pose = self.drive.pose
+            error, progress = self.track.distance(pose.x, pose.y)
+            errors.append(error)
+            if error > OFF_TRACK_DISTANCE:
+                break
+            if progress >= self.track.length - FINISH_MARGIN:
+                completed = True
+                break
+
+            frame = self.camera.render(pose)
+
+            start = time.perf_counter()
+            black = colors.find_black(line_band(frame), profile=SIM_PROFILE)
+            vision_time = (time.perf_counter() - start) * self.compute_scale
+            # the same estimate of when the speeds are applied as on the robot
+            target_time = frame_time + CAMERA_LATENCY + vision_time + LINK_LATENCY
+            step = self.follower.follow_mask(black, frame_time, target_time)
+            compute = (time.perf_counter() - start) * self.compute_scale
+            computes.append(compute)
+
+            if step is None:
+                lost += 1
+            else:
+                applied = frame_time + CAMERA_LATENCY + compute + LINK_LATENCY
+                self.drive.command(applied, step.left, step.right)
+                self.follower.command_started(applied, step.left, step.right)
+
+            if self.show:
+                if step is not None:
+                    step.wins.draw(frame)
+                    step.line_info.draw(frame)
+                cv.imshow("frame", frame)
+                cv.waitKey(1)
+
+            frame_time += max(LOOP_INTERVAL, compute)
+
+        errors_arr = np.array(errors)
+        return RunResult(
+                speed=self.speed,
+                completed=completed,
+                frames=len(computes),
+                sim_time=frame_time,
+                wall_time=time.perf_counter() - wall_start,
+                rms_error=float(np.sqrt(np.mean(errors_arr ** 2))),
+                max_error=float(errors_arr.max()),
+                lost_frames=lost,
+                compute_mean=float(np.mean(computes)) if computes else 0.0,
+                compute_max=float(np.max(computes)) if computes else 0.0,
+                errors=errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--speeds", type=int, nargs="+", default=[FOLLOWING_SPEED])
+    parser.add_argument("--gains", type=float, nargs=3, default=SIM_GAINS,
+                        metavar=("KP", "KI", "KD"),
+                        help=f"tuned for the simulation by default, main.settings has {PID_GAINS}")
+    parser.add_argument("--compute-scale", type=float, default=1.0,
+                        help="how many times the robot's computer is slower than this one")
+    parser.add_argument("--max-time", type=float, default=300.0, help="simulated seconds")
+    parser.add_argument("--show", action="store_true")
+    args = parser.parse_args()
+
+    print("speed completed sim_s wall_s speedup rms_err max_err lost compute_ms headroom")
+    for speed in args.speeds:
+        res = Simulation(speed=speed, gains=tuple(args.gains),
+                         compute_scale=args.compute_scale,
+                         show=args.show).run(args.max_time)
+        print(f"{res.speed} {res.completed} {res.sim_time:.1f} {res.wall_time:.2f} "
+              f"{res.speedup:.0f}x {res.rms_error:.0f} {res.max_error:.0f} {res.lost_frames} "
+              f"{res.compute_mean * 1000:.2f}/{res.compute_max * 1000:.2f} {res.headroom:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Parameter sweep over the line detection constants and the PID gains.
+
+Every configuration is evaluated in a process pool: locate_line's accuracy and
+latency over a labeled image set and, with --sim, the tracking error of a
+closed loop run on the simulated track. The configurations on the accuracy/latency
+Pareto front are marked with *.
+
+By default the image set is rendered by the simulator's camera from random poses
+along a straight line, so that the ground truth is exact. Real images can be added
+with --images: a `<image>.line.json` next to each of them holds
+{"bottom_x": px, "angle": rad} of the line in the full frame.
+"""
+import argparse
+import glob
+import itertools
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from main import settings
+from main.following import line_band
+from vision import colors, line, window
+
+from .sim import SIM_GAINS, SIM_PROFILE, Camera, Simulation
+from .track import Pose, Straight, Track
+
+# values of every parameter, a grid search takes all the combinations
+SPACE: Dict[str, List[Any]] = {
+    "LINE_WINDOW_STEP": [0.25, 0.5, 1.0],
+    "LINE_WINDOW_FIRST_MAX_OFFSET": [15.0, 25.0, 35.0],
+    "LINE_WINDOWS_DISTANCE_RANGE": [(2.0, 6.0), (2.0, 10.0), (4.0, 14.0)],
+    "MAX_REGIONS_DISTANCE": [20, 30, 45],
+    "WINDOW_HEIGHT": [3, 5, 8],
+    "PID_GAINS": [(300.0, 0.0, 0.0), (600.0, 0.0, 0.0), (600.0, 0.0, 30.0)],
+    }
+# only the closed loop depends on them, without --sim they would only repeat the configurations
+SIM_PARAMETERS = ("PID_GAINS",)
+
+DATASET_SIZE = 200
+MAX_LATERAL_OFFSET = 1500  # steps, of the generated poses
+MAX_HEADING = math.radians(30)
+MISS_PENALTY = 1.0  # of the frame half width, added to the error when no line is found
+# the one main loads, next to the robot's code
+COLORS_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../colors.csv"))
+
+Config = Dict[str, Any]
+
+
+@dataclass
+class Sample:
+    mask: np.ndarray  # of the black color, full frame
+    bottom_x: float  # px, where the line crosses the frame's bottom row
+    angle: float  # rad, as locate_line measures it
+
+    def true_x(self, row: float) -> float:
+        """The line's x at a row of the full frame"""
+        rise = self.mask.shape[0] - 1 - row
+        return self.bottom_x + rise * math.tan(self.angle)
+
+
+@dataclass
+class Evaluation:
+    config: Config
+    x_error: float  # px, mean, the misses are penalized
+    angle_error: float  # deg, mean over the frames where the angle is known
+    miss_rate: float
+    latency: float  # s per frame, mean
+    latency_p95: float
+    tracking_error: Optional[float] = None  # steps, rms of the closed loop run
+    completed: Optional[bool] = None
+
+
+def synthetic_samples(n: int = DATASET_SIZE, seed: int = 0) -> List[Sample]:
+    """Frames of a straight line along the x axis from random poses"""
+    rng = random.Random(seed)
+    track = Track([Straight(40000)])
+    camera = Camera(track)
+
+    samples = []
+    for _ in range(n):
+        heading = rng.uniform(-MAX_HEADING, MAX_HEADING)
+        pose = Pose(rng.uniform(5000, 30000),
+                    rng.uniform(-MAX_LATERAL_OFFSET, MAX_LATERAL_OFFSET), heading)
+        frame = camera.render(pose)
+
+        # the line y = 0 in the robot's frame: left = -(y + forward * sin) / cos
+        forward = camera.near
+        left = -(pose.y + forward * math.sin(heading)) / math.cos(heading)
+        bottom_x = camera.width / 2 + left * settings.PX_PER_STEP
+        samples.append(Sample(colors.find_black(frame, profile=SIM_PROFILE),
+                              bottom_x, -heading))
+    return samples
+
+
+def labeled_samples(paths: Iterable[str], profile: colors.ColorProfile) -> List[Sample]:
+    """profile - the calibrated one, which the robot segments the real images with"""
+    samples = []
+    for path in paths:
+        label_path = os.path.splitext(path)[0] + ".line.json"
+        if not os.path.exists(label_path):
+            continue
+        with open(label_path) as f:
+            label = json.load(f)
+        img = cv.imread(path)
+        samples.append(Sample(colors.find_black(img, profile=profile), label["bottom_x"], label["angle"]))
+    return samples
+
+
+# the workers are reused, so whatever a config does not set is reset to these
+DEFAULTS: Config = {
+    "LINE_WINDOW_STEP": line.LINE_WINDOW_STEP,
+    "LINE_WINDOW_FIRST_MAX_OFFSET": line.LINE_WINDOW_FIRST_MAX_OFFSET,
+    "LINE_WINDOWS_DISTANCE_RANGE": line.LINE_WINDOWS_DISTANCE_RANGE,
+    "MAX_REGIONS_DISTANCE": line.MAX_REGIONS_DISTANCE,
+    "WINDOW_HEIGHT": window.WINDOW_HEIGHT,
+    }
+
+
+def apply_config(config: Config) -> None:
+    """Sets the module globals, the ones imported by value are set everywhere they are"""
+    for name, value in {**DEFAULTS, **config}.items():
+        if name == "WINDOW_HEIGHT":
+            window.WINDOW_HEIGHT = value
+            line.WINDOW_HEIGHT = value
+        elif name == "PID_GAINS":
+            continue  # passed to the simulation explicitly
+        else:
+            setattr(line, name, value)
+
+
+def evaluate_samples(samples: Sequence[Sample]) -> Tuple[float, float, float, np.ndarray]:
+    x_errors, angle_errors, latencies = [], [], []
+    misses = 0
+    for sample in samples:
+        band = line_band(sample.mask)
+        band_top = sample.mask.shape[0] - band.shape[0]
+        half_width = sample.mask.shape[1] / 2
+
+        start = time.perf_counter()
+        wins = line.find_line_window_pair(band)
+        info = None
+        if wins != line.WindowPair.empty():
+            try:
+                info = line.locate_line(wins)
+            except ValueError:
+                pass
+        latencies.append(time.perf_counter() - start)
+
+        if info is None:
+            misses += 1
+            x_errors.append(half_width * MISS_PENALTY)
+            continue
+
+        row = band_top + (wins.lower.start + wins.lower.end) / 2
+        x_errors.append(abs(half_width + info.x_offset - sample.true_x(row)))
+        if info.angle is not None:
+            angle_errors.append(abs(math.degrees(info.angle - sample.angle)))
+
+    angle_error = float(np.mean(angle_errors)) if angle_errors else math.nan
+    return float(np.mean(x_errors)), angle_error, misses / len(samples), np.array(latencies)
+
+
+_samples: List[Sample] = []
+
+
+def _init_worker(samples: List[Sample]) -> None:
+    global _samples
+    _samples = samples
+    # the first calls import skimage, that is not a part of any config's latency
+    apply_config({})
+    evaluate_samples(samples[:2])
+
+
+def evaluate(config: Config, simulate: bool = False,
+             speed: int = settings.FOLLOWING_SPEED) -> Evaluation:
+    apply_config(config)
+    x_error, angle_error, miss_rate, latencies = evaluate_samples(_samples)
+    res = Evaluation(config, x_error, angle_error, miss_rate,
+                     float(np.mean(latencies)), float(np.percentile(latencies, 95)))
+
+    if simulate:
+        gains = config.get("PID_GAINS", SIM_GAINS)
+        run = Simulation(speed=speed, gains=gains).run()
+        res.tracking_error = run.rms_error
+        res.completed = run.completed
+    return res
+
+
+def search_space(simulate: bool) -> Dict[str, List[Any]]:
+    return {name: values for name, values in SPACE.items()
+            if simulate or name not in SIM_PARAMETERS}
+
+
+def grid(space: Dict[str, List[Any]]) -> List[Config]:
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*space.values())]
+
+
+def random_configs(space: Dict[str, List[Any]], n: int, seed: int = 0) -> List[Config]:
+    rng = random.Random(seed)
+    configs = {json.dumps(c, sort_keys=True): c
+               for c in ({name: rng.choice(values) for name, values in space.items()}
+                         for _ in range(n * 4))}
+    return list(configs.values())[:n]
+
+
+def pareto_front(points: Sequence[Tuple[float, float]]) -> List[int]:
+    """Indices of the points which no other point beats in both coordinates, lower is better"""
+    front = []
+    for i, (a, b) in enumerate(points):
+        dominated = any((c <= a and d <= b) and (c < a or d < b)
+                        for j, (c, d) in enumerate(points) if j != i)
+        if not dominated:
+            front.append(i)
+    return front
+
+
+def sweep(configs: List[Config], samples: List[Sample], simulate: bool = False,
+          speed: int = settings.FOLLOWING_SPEED,
+          workers: Optional[int] = None) -> List[Evaluation]:
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(samples,)) as pool:
+        futures = [pool.submit(evaluate, config, simulate, speed) for config in configs]
+        return [f.result() for f in futures]
+
+
+def format_config(config: Config, space: Dict[str, List[Any]]) -> str:
+    # only what is swept, the rest is the same everywhere
+    return " ".join(f"{name}={value}" for name, value in config.items()
+                    if len(space.get(name, [])) > 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--random", type=int, metavar="N",
+                        help="N random configurations instead of the whole grid")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--samples", type=int, default=DATASET_SIZE,
+                        help="synthetic images, 0 to use only --images")
+    parser.add_argument("--images", nargs="*", default=[], help="labeled images or directories")
+    parser.add_argument("--colors", default=COLORS_PATH,
+                        help="the calibrated color ranges, the --images are segmented with them")
+    parser.add_argument("--sim", action="store_true", help="run the closed loop for every config")
+    parser.add_argument("--speed", type=int, default=settings.FOLLOWING_SPEED)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--out", help="CSV with all the results")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            paths += sorted(glob.glob(os.path.join(path, "*.jpg")) + glob.glob(os.path.join(path, "*.png")))
+        else:
+            paths.append(path)
+    if paths:
+        colors.set_profile(colors.load_profile(args.colors))
+    samples = synthetic_samples(args.samples, args.seed) + labeled_samples(paths, colors.get_profile())
+    if len(samples) == 0:
+        parser.error("No labeled images")
+
+    space = search_space(args.sim)
+    configs = grid(space) if args.random is None else random_configs(space, args.random, args.seed)
+    print(f"{len(configs)} configurations, {len(samples)} images")
+
+    start = time.perf_counter()
+    results = sweep(configs, samples, args.sim, args.speed, args.workers)
+    print(f"done in {time.perf_counter() - start:.1f} s")
+
+    front = set(pareto_front([(r.x_error, r.latency) for r in results]))
+    print("pareto x_err_px angle_err_deg miss latency_ms p95_ms tracking_err completed config")
+    for i in sorted(range(len(results)), key=lambda i: results[i].x_error):
+        r = results[i]
+        tracking = f"{r.tracking_error:.0f} {r.completed}" if r.tracking_error is not None else "- -"
+        print(f"{'*' if i in front else ' '} {r.x_error:.2f} {r.angle_error:.2f} {r.miss_rate:.2f} "
+              f"{r.latency * 1000:.2f} {r.latency_p95 * 1000:.2f} {tracking} "
+              f"{format_config(r.config, space)}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            f.write("pareto,x_error,angle_error,miss_rate,latency,latency_p95,"
+                    "tracking_error,completed,config\n")
+            for i, r in enumerate(results):
+                f.write(f"{int(i in front)},{r.x_error},{r.angle_error},{r.miss_rate},"
+                        f"{r.latency},{r.latency_p95},{r.tracking_error},{r.completed},"
+                        f"\"{json.dumps(r.config)}\"\n")
+
+
+if __name__ == "__main__":
+    main()
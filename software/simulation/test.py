@@ -0,0 +1,101 @@
+import json
+import math
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from .kinematics import DifferentialDrive
+from vision import colors, line, window
+
+from .sim import Camera, Simulation
+from .sweep import (DEFAULTS, SPACE, _init_worker, apply_config, evaluate, grid, labeled_samples,
+                    pareto_front, search_space, synthetic_samples)
+from .track import Arc, Gap, Pose, Straight, Track
+
+
+def test_drive_straight():
+    drive = DifferentialDrive(Pose(0.0, 0.0, 0.0))
+    drive.command(0.0, 100, 100)
+    drive.advance(2.0)
+    assert drive.pose.x == pytest.approx(200)
+    assert drive.pose.y == pytest.approx(0)
+
+
+def test_drive_turns_clockwise_when_left_is_faster():
+    drive = DifferentialDrive(Pose(0.0, 0.0, 0.0), track_width=1000)
+    drive.command(0.0, 100, -100)
+    drive.advance(math.pi * 5 / 2)  # rad / (200 / 1000 rad/s)
+    assert drive.pose.heading == pytest.approx(-math.pi / 2)
+    assert drive.pose.x == pytest.approx(0, abs=1e-6)
+
+
+def test_drive_applies_commands_at_their_time():
+    drive = DifferentialDrive(Pose(0.0, 0.0, 0.0))
+    drive.command(1.0, 100, 100)
+    drive.advance(2.0)
+    assert drive.pose.x == pytest.approx(100)
+
+
+def test_camera_sees_line_ahead():
+    track = Track([Straight(6000)])
+    frame = Camera(track).render(Pose(0.0, 0.0, 0.0))
+    middle = frame.shape[1] // 2
+    assert frame[-1, middle].max() < 100
+    assert frame[-1, 0].min() > 200
+
+
+def test_closed_loop_follows_track():
+    track = Track([Straight(3000), Arc(4000, math.pi / 2), Gap(800), Straight(3000)])
+    result = Simulation(track, speed=300, gains=(600.0, 0.0, 0.0)).run(max_time=60.0)
+    assert result.completed
+    assert result.max_error < 500
+
+
+def test_default_simulation_completes_default_track():
+    result = Simulation().run()
+    assert result.completed
+    assert result.lost_frames == 0
+
+
+def test_pareto_front():
+    points = [(1.0, 5.0), (2.0, 2.0), (3.0, 3.0), (5.0, 1.0), (1.0, 6.0)]
+    assert pareto_front(points) == [0, 1, 3]
+
+
+def test_sweep_drops_gains_without_sim():
+    assert "PID_GAINS" not in search_space(simulate=False)
+    assert search_space(simulate=True) == SPACE
+    assert len(grid(search_space(simulate=False))) * len(SPACE["PID_GAINS"]) == len(grid(SPACE))
+
+
+def test_sweep_defaults_locate_synthetic_line():
+    _init_worker(synthetic_samples(20))
+    res = evaluate({})
+    assert res.miss_rate == 0
+    assert res.x_error < 3
+    assert res.angle_error < 3
+
+
+def test_apply_config_resets_unset_parameters():
+    apply_config({"WINDOW_HEIGHT": 3, "MAX_REGIONS_DISTANCE": 10})
+    assert window.WINDOW_HEIGHT == line.WINDOW_HEIGHT == 3
+    apply_config({})
+    assert window.WINDOW_HEIGHT == DEFAULTS["WINDOW_HEIGHT"]
+    assert line.MAX_REGIONS_DISTANCE == DEFAULTS["MAX_REGIONS_DISTANCE"]
+
+
+def test_labeled_samples_use_given_profile(tmp_path):
+    img = np.full((240, 320, 3), 255, dtype=np.uint8)
+    img[:, 150:170] = 0
+    path = str(tmp_path / "line.png")
+    cv.imwrite(path, img)
+    with open(tmp_path / "line.line.json", "w") as f:
+        json.dump({"bottom_x": 160, "angle": 0.0}, f)
+
+    all_black = colors.DEFAULT_PROFILE.replace("black", ((0, 0, 0), (255, 255, 255)))
+    nothing_black = colors.DEFAULT_PROFILE.replace("black", ((0, 0, 0), (0, 0, 0)))
+    [sample] = labeled_samples([path], all_black)
+    assert np.count_nonzero(sample.mask) > 0
+    [sample] = labeled_samples([path], nothing_black)
+    assert np.count_nonzero(sample.mask) == 0
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+# all the distances are in motor steps, same as in main.settings
+LINE_WIDTH = 400
+MAP_STEPS_PER_PX = 10
+MAP_MARGIN = 6000
+SAMPLE_STEP = 50  # between the points of the track's centerline
+ARM_LENGTH = 3000  # of the intersections' side lines
+
+LINE_COLOR = (20, 20, 20)
+FIELD_COLOR = (235, 235, 235)
+
+Point = Tuple[float, float]
+
+
+@dataclass
+class Pose:
+    x: float
+    y: float
+    heading: float  # rad, counter-clockwise from the x axis
+
+
+@dataclass
+class Straight:
+    length: float
+
+
+@dataclass
+class Arc:
+    radius: float
+    angle: float  # rad, positive - to the left
+
+
+@dataclass
+class Gap:
+    length: float
+
+
+@dataclass
+class Cross:
+    """A straight piece with a perpendicular line through its middle"""
+    length: float
+
+
+Segment = object
+
+
+class Track:
+    """
+    A line built from segments, starting at the origin heading along the x axis.
+    The world is rendered into a top-down map once, frames are cut out of it.
+    """
+
+    def __init__(self, segments: List[Segment]) -> None:
+        self.segments = segments
+        # pieces of the drawn line, the gaps split it
+        self.pieces: List[List[Point]] = [[]]
+        self.arms: List[Tuple[Point, Point]] = []
+        self.centerline: List[Point] = []
+        self._build()
+
+        points = np.array(self.centerline + [p for arm in self.arms for p in arm])
+        self.origin = points.min(axis=0) - MAP_MARGIN
+        size = (points.max(axis=0) + MAP_MARGIN - self.origin) / MAP_STEPS_PER_PX
+        self.map = np.full((int(size[1]) + 1, int(size[0]) + 1, 3), FIELD_COLOR, dtype=np.uint8)
+        self._draw()
+
+        self._centerline = np.array(self.centerline)
+
+    @property
+    def start(self) -> Pose:
+        return Pose(0.0, 0.0, 0.0)
+
+    @property
+    def length(self) -> float:
+        return (len(self.centerline) - 1) * SAMPLE_STEP
+
+    def _build(self) -> None:
+        x, y, heading = 0.0, 0.0, 0.0
+        self._add_point((x, y))
+
+        for segment in self.segments:
+            if isinstance(segment, Arc):
+                length = abs(segment.angle) * segment.radius
+            else:
+                length = segment.length
+            steps = max(int(length / SAMPLE_STEP), 1)
+
+            if isinstance(segment, Gap):
+                self.pieces.append([])
+
+            for i in range(steps):
+                if isinstance(segment, Arc):
+                    heading += segment.angle / steps
+                x += math.cos(heading) * length / steps
+                y += math.sin(heading) * length / steps
+                if isinstance(segment, Cross) and i == steps // 2:
+                    dx, dy = -math.sin(heading) * ARM_LENGTH, math.cos(heading) * ARM_LENGTH
+                    self.arms.append(((x - dx, y - dy), (x + dx, y + dy)))
+                self._add_point((x, y), drawn=not isinstance(segment, Gap))
+
+            if isinstance(segment, Gap):
+                self.pieces.append([])
+
+    def _add_point(self, point: Point, drawn: bool = True) -> None:
+        self.centerline.append(point)
+        if drawn:
+            self.pieces[-1].append(point)
+
+    def to_map(self, points: np.ndarray) -> np.ndarray:
+        """World coordinates to the map's pixels, y goes up in the world and down in the map"""
+        px = (np.asarray(points, dtype=np.float64) - self.origin) / MAP_STEPS_PER_PX
+        px[..., 1] = self.map.shape[0] - 1 - px[..., 1]
+        return px
+
+    def _draw(self) -> None:
+        thickness = max(int(round(LINE_WIDTH / MAP_STEPS_PER_PX)), 1)
+        lines = [p for p in self.pieces if len(p) > 1] + [list(arm) for arm in self.arms]
+        for points in lines:
+            px = np.round(self.to_map(points)).astype(np.int32)
+            cv.polylines(self.map, [px], False, LINE_COLOR, thickness, cv.LINE_AA)
+
+    def distance(self, x: float, y: float) -> Tuple[float, float]:
+        """Distance to the centerline and how far along it the closest point is"""
+        d = np.hypot(self._centerline[:, 0] - x, self._centerline[:, 1] - y)
+        i = int(np.argmin(d))
+        return float(d[i]), i * SAMPLE_STEP
+
+
+def default_track() -> Track:
+    return Track([
+        Straight(4000),
+        Arc(5000, math.pi / 2),
+        Straight(2000),
+        Gap(1200),
+        Straight(2000),
+        Arc(4000, -math.pi / 2),
+        Cross(4000),
+        Arc(3500, -math.pi / 3),
+        Arc(3500, math.pi / 3),
+        Straight(3000),
+        Arc(3000, math.pi),
+        Straight(4000),
+        ])
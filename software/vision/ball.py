@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import math
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+BALL_SEARCH_WIDTH = 320  # px, the whole frame is downscaled to about this width
+BALL_MIN_RADIUS_RATIO = 1 / 40  # of the image width
+BALL_MAX_RADIUS_RATIO = 1 / 6
+BALL_EDGE_THRESHOLD = 100  # Canny's upper threshold
+BALL_ACCUMULATOR_THRESHOLD = 15  # in the downscaled image, lower - more false circles
+BALL_TRACK_THRESHOLD = 10  # the ball is known to be in the ROI, the closest circle is taken
+BALL_ROI_MARGIN = 2.0  # of the radius, around the last known ball
+BALL_ROI_SIZE = 96  # px, the ROI is downscaled to about this size
+BALL_MAX_MISSES = 3  # frames, before the tracker searches the whole frame again
+
+
+@dataclass
+class Ball:
+    x: float  # px, in the full frame
+    y: float
+    radius: float
+
+    def distance_to(self, other: Ball) -> float:
+        return math.hypot(self.x - other.x, self.y - other.y)
+
+    def draw(self, img: cv.Mat, color: Tuple[int, int, int] = (0, 0, 255)) -> None:
+        cv.circle(img, (int(self.x), int(self.y)), int(self.radius), color, 2)
+
+
+@dataclass
+class BallInfo:
+    ball: Optional[Ball]
+    tracked: bool  # found in the ROI of the previous ball
+    elapsed: float  # s
+
+
+def search_scale(img: cv.Mat, size: int) -> float:
+    return max(max(img.shape[:2]) / size, 1.0)
+
+
+def find_balls(img: cv.Mat, scale: float = 1.0,
+               min_radius: Optional[float] = None,
+               max_radius: Optional[float] = None,
+               threshold: int = BALL_ACCUMULATOR_THRESHOLD) -> List[Ball]:
+    """Circles in the image, the radii are in px of the image"""
+    width = img.shape[1]
+    if min_radius is None:
+        min_radius = width * BALL_MIN_RADIUS_RATIO
+    if max_radius is None:
+        max_radius = width * BALL_MAX_RADIUS_RATIO
+
+    size = (max(int(img.shape[1] / scale), 1), max(int(img.shape[0] / scale), 1))
+    small = cv.resize(img, size, interpolation=cv.INTER_AREA) if scale != 1 else img
+    if small.ndim == 3:
+        small = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+    small = cv.medianBlur(small, 3)
+
+    circles = cv.HoughCircles(small, cv.HOUGH_GRADIENT, dp=1,
+                              minDist=max(small.shape[1] / 8, 1),
+                              param1=BALL_EDGE_THRESHOLD,
+                              param2=threshold,
+                              minRadius=max(int(min_radius / scale), 2),
+                              maxRadius=max(int(math.ceil(max_radius / scale)), 3))
+    if circles is None:
+        return []
+    return [Ball(float(x) * scale, float(y) * scale, float(r) * scale)
+            for x, y, r in circles[0]]
+
+
+def ball_roi(ball: Ball, shape: Tuple[int, ...]) -> Tuple[int, int, int, int]:
+    """(x1, y1, x2, y2) around the ball, clipped to the image"""
+    half = ball.radius * (1 + BALL_ROI_MARGIN)
+    x1 = int(max(ball.x - half, 0))
+    y1 = int(max(ball.y - half, 0))
+    x2 = int(min(ball.x + half, shape[1]))
+    y2 = int(min(ball.y + half, shape[0]))
+    return x1, y1, x2, y2
+
+
+class BallTracker:
+    """
+    Searches the whole downscaled frame until a ball is found, then only
+    a window around it, so the cost does not depend on the frame size once locked.
+    """
+
+    def __init__(self, search_width: int = BALL_SEARCH_WIDTH,
+                 max_misses: int = BALL_MAX_MISSES) -> None:
+        self.search_width = search_width
+        self.max_misses = max_misses
+        self.ball: Optional[Ball] = None
+        self._misses = 0
+
+    @property
+    def locked(self) -> bool:
+        return self.ball is not None
+
+    def reset(self) -> None:
+        self.ball = None
+        self._misses = 0
+
+    def __call__(self, img: cv.Mat) -> BallInfo:
+        start = time.perf_counter()
+
+        tracked = self.ball is not None
+        found = self._track(img) if tracked else self._search(img)
+
+        if found is not None:
+            self.ball = found
+            self._misses = 0
+        elif self.ball is not None:
+            self._misses += 1
+            if self._misses > self.max_misses:
+                self.reset()
+
+        return BallInfo(found, tracked and found is not None,
+                        time.perf_counter() - start)
+
+    def _search(self, img: cv.Mat) -> Optional[Ball]:
+        balls = find_balls(img, search_scale(img, self.search_width))
+        if len(balls) == 0:
+            return None
+        # the closest one is the lowest in the frame
+        return max(balls, key=lambda b: b.y + b.radius)
+
+    def _track(self, img: cv.Mat) -> Optional[Ball]:
+        x1, y1, x2, y2 = ball_roi(self.ball, img.shape)
+        roi = img[y1:y2, x1:x2]
+        if roi.size == 0:
+            return None
+
+        scale = search_scale(roi, BALL_ROI_SIZE)
+        # the ball can get closer or further away between the frames
+        balls = find_balls(roi, scale,
+                           min_radius=self.ball.radius / 2,
+                           max_radius=self.ball.radius * 2,
+                           threshold=BALL_TRACK_THRESHOLD)
+        if len(balls) == 0:
+            return None
+
+        for ball in balls:
+            ball.x += x1
+            ball.y += y1
+        return min(balls, key=lambda b: b.distance_to(self.ball))
+
+
+def main():
+    import glob
+
+    tracker = BallTracker()
+    for path in sorted(glob.glob("./vision/images/*.jpg")):
+        img = cv.imread(path)
+        tracker.reset()
+        for _ in range(3):
+            info = tracker(img)
+            print(path, info)
+
+
+if __name__ == "__main__":
+    main()
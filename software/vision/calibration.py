@@ -0,0 +1,221 @@
+"""
+Offline color range calibration from labeled images.
+
+Labels are masks next to the images: for `field.jpg` the pixels of the class
+`black` are the white pixels of `field.black.png`. The `background` label marks
+pixels which belong to none of the classes. Every labeled pixel of the other
+classes counts as a negative example for a class, so the labeling does not need
+to be complete.
+"""
+import argparse
+import glob
+import itertools
+import os
+from typing import Dict, List, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from . import colors
+from .common import flatten
+
+BIN_BITS = 3  # 256 / 2 ** 3 = 32 bins per channel
+BINS = 256 >> BIN_BITS
+BACKGROUND_LABEL = "background"
+LOWER_QUANTILES = (0.0, 0.005, 0.01, 0.02, 0.05, 0.1)
+UPPER_QUANTILES = (0.9, 0.95, 0.98, 0.99, 0.995, 1.0)
+FALSE_POSITIVE_WEIGHT = 1.0
+
+RangeT = Tuple[Tuple[int, int, int], Tuple[int, int, int]]
+
+
+def lab_bins(img: cv.Mat) -> np.ndarray:
+    """Flat histogram bin index of every pixel"""
+    lab = cv.cvtColor(img, cv.COLOR_BGR2LAB) >> BIN_BITS
+    lab = lab.astype(np.int32)
+    return (lab[..., 0] * BINS + lab[..., 1]) * BINS + lab[..., 2]
+
+
+def label_path(image_path: str, label: str) -> str:
+    return f"{os.path.splitext(image_path)[0]}.{label}.png"
+
+
+def load_labels(image_path: str, labels: Tuple[str, ...]) -> Dict[str, np.ndarray]:
+    res = {}
+    for label in labels:
+        path = label_path(image_path, label)
+        if os.path.exists(path):
+            res[label] = cv.imread(path, cv.IMREAD_GRAYSCALE) > 0
+    return res
+
+
+def build_histograms(samples: List[Tuple[cv.Mat, Dict[str, np.ndarray]]],
+                     labels: Tuple[str, ...]) -> Dict[str, np.ndarray]:
+    """3D LAB histogram of the pixels of each label, over all the images"""
+    hists = {label: np.zeros(BINS ** 3, dtype=np.int64) for label in labels}
+    for img, masks in samples:
+        bins = lab_bins(img)
+        for label, mask in masks.items():
+            hists[label] += np.bincount(bins[mask], minlength=BINS ** 3)
+    return {label: h.reshape((BINS,) * 3) for label, h in hists.items()}
+
+
+def summed_volume(hist: np.ndarray) -> np.ndarray:
+    """Zero padded 3D cumulative sum, so that any box sums up in 8 lookups"""
+    res = np.zeros(tuple(s + 1 for s in hist.shape), dtype=np.int64)
+    res[1:, 1:, 1:] = hist.cumsum(0).cumsum(1).cumsum(2)
+    return res
+
+
+def box_sums(volume: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """Sums of the boxes [lower, upper] (inclusive, in bins), lower and upper are (N, 3)"""
+    res = np.zeros(len(lower), dtype=np.int64)
+    for corner in itertools.product((0, 1), repeat=3):
+        idx = [np.where(c, upper[:, i] + 1, lower[:, i]) for i, c in enumerate(corner)]
+        sign = 1 if (3 - sum(corner)) % 2 == 0 else -1
+        res += sign * volume[idx[0], idx[1], idx[2]]
+    return res
+
+
+def quantile_bins(hist: np.ndarray, axis: int, quantiles: Tuple[float, ...]) -> np.ndarray:
+    marginal = hist.sum(axis=tuple(a for a in range(3) if a != axis))
+    cdf = np.cumsum(marginal) / max(marginal.sum(), 1)
+    return np.unique(np.clip(np.searchsorted(cdf, quantiles, side="left"), 0, BINS - 1))
+
+
+def candidate_boxes(hist: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """All combinations of per channel bounds around the bulk of the class"""
+    per_channel = []
+    for axis in range(3):
+        lows = quantile_bins(hist, axis, LOWER_QUANTILES)
+        highs = quantile_bins(hist, axis, UPPER_QUANTILES)
+        pairs = np.array([(lo, hi) for lo in lows for hi in highs if lo <= hi])
+        per_channel.append(pairs)
+
+    grid = np.array(list(itertools.product(*(range(len(p)) for p in per_channel))))
+    bounds = [per_channel[axis][grid[:, axis]] for axis in range(3)]
+    lower = np.stack([b[:, 0] for b in bounds], axis=1)
+    upper = np.stack([b[:, 1] for b in bounds], axis=1)
+    return lower, upper
+
+
+def bins_to_range(lower: np.ndarray, upper: np.ndarray) -> RangeT:
+    return (tuple(int(x) << BIN_BITS for x in lower),
+            tuple((int(x) << BIN_BITS) + (1 << BIN_BITS) - 1 for x in upper))
+
+
+def best_range(hists: Dict[str, np.ndarray], label: str,
+               false_positive_weight: float = FALSE_POSITIVE_WEIGHT
+               ) -> Optional[Tuple[RangeT, float, float]]:
+    """Returns the range with the best TPR - weight * FPR and its TPR and FPR"""
+    positive = hists[label]
+    negative = sum(h for l, h in hists.items() if l != label)
+    if positive.sum() == 0 or np.sum(negative) == 0:
+        return None
+
+    lower, upper = candidate_boxes(positive)
+    tpr = box_sums(summed_volume(positive), lower, upper) / positive.sum()
+    fpr = box_sums(summed_volume(negative), lower, upper) / np.sum(negative)
+
+    best = int(np.argmax(tpr - false_positive_weight * fpr))
+    return bins_to_range(lower[best], upper[best]), float(tpr[best]), float(fpr[best])
+
+
+def calibrate(image_paths: List[str],
+              false_positive_weight: float = FALSE_POSITIVE_WEIGHT
+              ) -> Dict[str, Tuple[RangeT, float, float]]:
+    labels = colors.RANGE_NAMES + (BACKGROUND_LABEL,)
+
+    samples = []
+    for path in image_paths:
+        masks = load_labels(path, labels)
+        if len(masks) > 0:
+            samples.append((cv.imread(path), masks))
+    hists = build_histograms(samples, labels)
+
+    res = {}
+    for name in colors.RANGE_NAMES:
+        found = best_range(hists, name, false_positive_weight)
+        if found is not None:
+            res[name] = found
+    return res
+
+
+def annotate(image_path: str, radius: int = 10) -> None:
+    """Click to mark the pixels of the current class, n - next class, s - save, esc - quit"""
+    img = cv.imread(image_path)
+    labels = colors.RANGE_NAMES + (BACKGROUND_LABEL,)
+    masks = {label: np.zeros(img.shape[:2], dtype=np.uint8) for label in labels}
+    for label, mask in load_labels(image_path, labels).items():
+        masks[label][mask] = 255
+
+    current = 0
+    name = "annotate"
+    cv.namedWindow(name)
+
+    def on_mouse(event, x, y, flags, _):
+        if event == cv.EVENT_LBUTTONDOWN or (event == cv.EVENT_MOUSEMOVE
+                                             and flags & cv.EVENT_FLAG_LBUTTON):
+            cv.circle(masks[labels[current]], (x, y), radius, (255,), -1)
+
+    cv.setMouseCallback(name, on_mouse)
+    while True:
+        shown = img.copy()
+        shown[masks[labels[current]] > 0] //= 2
+        cv.putText(shown, labels[current], org=(30, 50),
+                   fontFace=cv.FONT_HERSHEY_COMPLEX, fontScale=2.0,
+                   color=(255, 0, 0), thickness=2)
+        cv.imshow(name, shown)
+
+        key = cv.waitKey(20)
+        if key == 27:  # esc
+            return
+        elif key == ord("n"):
+            current = (current + 1) % len(labels)
+        elif key == ord("s"):
+            for label, mask in masks.items():
+                if mask.any():
+                    cv.imwrite(label_path(image_path, label), mask)
+
+
+def main():
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    default_out = os.path.abspath(os.path.join(script_dir, "../colors.csv"))
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+", help="images or directories with them")
+    parser.add_argument("--out", default=default_out)
+    parser.add_argument("--annotate", action="store_true",
+                        help="label the images by clicking instead of calibrating")
+    parser.add_argument("--fp-weight", type=float, default=FALSE_POSITIVE_WEIGHT)
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            paths += sorted(p for p in glob.glob(os.path.join(path, "*"))
+                            if p.lower().endswith((".jpg", ".jpeg", ".png"))
+                            and len(os.path.basename(p).split(".")) == 2)
+        else:
+            paths.append(path)
+
+    if args.annotate:
+        for path in paths:
+            annotate(path)
+        return
+
+    profile = colors.DEFAULT_PROFILE
+    if os.path.exists(args.out):
+        profile = colors.load_profile(args.out)
+
+    found = calibrate(paths, args.fp_weight)
+    for name, (range_, tpr, fpr) in found.items():
+        print(f"{name}: {flatten(range_)} TPR={tpr:.3f} FPR={fpr:.4f}")
+        profile = profile.replace(name, range_)
+
+    colors.save_profile(profile, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
 import logging
 import threading
-from queue import Queue
+import time
+from dataclasses import dataclass
+from queue import Empty, Queue
 
-from cv2 import cv2 as cv
+import cv2 as cv
 
 CAPTURE_RESOLUTION = (320, 240)
 
 
+@dataclass
+class Frame:
+    image: cv.Mat
+    # time.monotonic() right after the frame was grabbed, same clock as interfacing_py.host_time
+    timestamp: float
+    seq: int
+
+
 class BufferlessCapture(threading.Thread):
     def __init__(self, name):
-        super().__init__(daemon=True)
+        super().__init__(name="capture", daemon=True)
 
         self._cap = cv.VideoCapture(name)
         self._frame_buff = Queue(maxsize=2)
@@ -22,11 +32,24 @@ class BufferlessCapture(threading.Thread):
         self.start()
 
     def run(self):
+        seq = 0
         while True:
             ret, frame = self._cap.read()
+            timestamp = time.monotonic()
             if not ret:
                 logging.error("Failed to grab a frame")
-            self._frame_buff.put(frame)
+
+            # drop the oldest frame instead of waiting for the reader
+            if self._frame_buff.full():
+                try:
+                    self._frame_buff.get_nowait()
+                except Empty:
+                    pass
+            self._frame_buff.put(Frame(frame, timestamp, seq))
+            seq += 1
 
     def read(self):
+        return self.read_frame().image
+
+    def read_frame(self) -> Frame:
         return self._frame_buff.get(block=True, timeout=1)
@@ -1,91 +1,189 @@
+from __future__ import annotations
+
+import logging
 import os
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from typing import IO, Callable, Optional, Tuple
 
 import cv2 as cv
 import numpy as np
 
 from .common import clean_mask, flatten, group
 
-BLACK_COLOR_RANGE = (
-        (0, 0, 0),
-        (60, 60, 60)
-        )
-GREEN_COLOR_RANGE = (
-        (140, 225, 100),
-        (200, 255, 180)
-        )
-SILVER_COLOR_RANGE = (
-        (55, 70, 90),
-        (90, 90, 115)
-        )
-OBSTACLE_COLOR_RANGE = (
-        (80, 60, 55),
-        (110, 70, 65)
-        )
-ALL_RANGES = [
-              BLACK_COLOR_RANGE,
-              GREEN_COLOR_RANGE,
-              SILVER_COLOR_RANGE,
-              OBSTACLE_COLOR_RANGE
-              ]
+ColorRange = Tuple[Tuple[int, int, int], Tuple[int, int, int]]
+
 RANGE_NAMES = ("black", "green", "silver", "obstacle")
+CACHE_EXTENSION = ".bin"
+
+
+@dataclass(frozen=True)
+class ColorProfile:
+    """
+    LAB ranges of all the colors in RANGE_NAMES order.
+    Never modified, so it can be swapped while the vision pipeline is using the old one.
+    """
+    ranges: Tuple[ColorRange, ...]
+    # inRange would convert the tuples on every call otherwise
+    bounds: Tuple[Tuple[np.ndarray, np.ndarray], ...] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if len(self.ranges) != len(RANGE_NAMES):
+            raise ValueError(f"Expected {len(RANGE_NAMES)} ranges, got {len(self.ranges)}")
+        ranges = tuple((tuple(map(int, lower)), tuple(map(int, upper)))
+                       for lower, upper in self.ranges)
+        object.__setattr__(self, "ranges", ranges)
+
+        bounds = []
+        for range_ in ranges:
+            lower, upper = (np.array(x, dtype=np.uint8) for x in range_)
+            lower.setflags(write=False)
+            upper.setflags(write=False)
+            bounds.append((lower, upper))
+        object.__setattr__(self, "bounds", tuple(bounds))
+
+    def __getitem__(self, name: str) -> ColorRange:
+        return self.ranges[RANGE_NAMES.index(name)]
+
+    def bounds_of(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        return self.bounds[RANGE_NAMES.index(name)]
+
+    def replace(self, name: str, range_: ColorRange) -> ColorProfile:
+        ranges = list(self.ranges)
+        ranges[RANGE_NAMES.index(name)] = range_
+        return ColorProfile(tuple(ranges))
+
+    def to_array(self) -> np.ndarray:
+        return np.array(self.ranges, dtype=np.uint8).reshape(-1, 3)
+
+    @staticmethod
+    def from_array(data: np.ndarray) -> ColorProfile:
+        return ColorProfile(tuple(group([tuple(row) for row in data.reshape(-1, 3)], 2)))
+
+
+DEFAULT_PROFILE = ColorProfile((
+        ((0, 0, 0), (60, 60, 60)),  # black
+        ((140, 225, 100), (200, 255, 180)),  # green
+        ((55, 70, 90), (90, 90, 115)),  # silver
+        ((80, 60, 55), (110, 70, 65)),  # obstacle
+        ))
+
+_profile = DEFAULT_PROFILE
+
+
+def get_profile() -> ColorProfile:
+    return _profile
+
 
+def set_profile(profile: ColorProfile) -> None:
+    # rebinding a reference is atomic, readers get either the old or the new profile
+    global _profile
+    _profile = profile
 
-def _copy_all_ranges():
-    # who needs references when you can just do this shit
 
-    global BLACK_COLOR_RANGE, GREEN_COLOR_RANGE
-    global SILVER_COLOR_RANGE, OBSTACLE_COLOR_RANGE
+def _cache_path(path: str) -> str:
+    return os.path.splitext(path)[0] + CACHE_EXTENSION
 
-    (BLACK_COLOR_RANGE,
-     GREEN_COLOR_RANGE,
-     SILVER_COLOR_RANGE,
-     OBSTACLE_COLOR_RANGE) = ALL_RANGES
 
-def load_color_ranges(path: str):
-    global ALL_RANGES
+def _replace_file(path: str, write: Callable[[IO[bytes]], None]) -> None:
+    # a unique temporary file, so that concurrent writers do not clobber each other
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".",
+                                     prefix=os.path.basename(path) + ".", delete=False) as f:
+        try:
+            write(f)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
 
-    data = np.loadtxt(path)
 
-    ALL_RANGES = group(data, 2)
-    _copy_all_ranges()
+def load_profile(path: str) -> ColorProfile:
+    """Reads the binary cache next to the CSV if it is up to date"""
+    cache = _cache_path(path)
+    try:
+        if os.path.getmtime(cache) >= os.path.getmtime(path):
+            data = np.fromfile(cache, dtype=np.uint8)
+            if data.size == len(RANGE_NAMES) * 2 * 3:
+                return ColorProfile.from_array(data)
+    except OSError:
+        pass
 
+    profile = ColorProfile.from_array(np.loadtxt(path))
+    try:
+        _replace_file(cache, lambda f: profile.to_array().tofile(f))
+    except OSError as e:
+        logging.warning(f"Could not write color profile cache: {e}")
+    return profile
 
-def save_color_ranges(path: str):
-    data = flatten(ALL_RANGES)
-    _copy_all_ranges()
-    np.savetxt(path, data, fmt="%i")
 
+def save_profile(profile: ColorProfile, path: str) -> None:
+    # files are replaced atomically so that a watcher never reads a half-written one
+    _replace_file(path, lambda f: np.savetxt(f, profile.to_array(), fmt="%i"))
+    _replace_file(_cache_path(path), lambda f: profile.to_array().tofile(f))
 
-def find_black(img) -> cv.Mat:
-    return find_color(img, BLACK_COLOR_RANGE)
 
+class ProfileWatcher(threading.Thread):
+    """Reloads the profile when the file changes, keeps the old one if it cannot be loaded"""
 
-def find_green(img) -> cv.Mat:
-    return find_color(img, GREEN_COLOR_RANGE)
+    def __init__(self, path: str, interval: float = 0.5) -> None:
+        super().__init__(daemon=True)
+        self._path = path
+        self._interval = interval
+        self._mtime = self._get_mtime()
+        self._stop_event = threading.Event()
 
+    def _get_mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self._path)
+        except OSError:
+            return None
 
-def find_silver(img) -> cv.Mat:
-    return find_color(img, SILVER_COLOR_RANGE)
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            mtime = self._get_mtime()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                set_profile(load_profile(self._path))
+                logging.info(f"Reloaded color profile from {self._path}")
+            except Exception as e:
+                logging.error(f"Could not reload color profile: {e}")
 
+    def stop(self):
+        self._stop_event.set()
 
-def find_obstacle(img) -> cv.Mat:
-    return find_color(img, OBSTACLE_COLOR_RANGE)
 
+def find_black(img, clean: bool = True, profile: Optional[ColorProfile] = None) -> cv.Mat:
+    return find_color(img, (profile or _profile).bounds_of("black"), clean)
 
-def find_color(img: cv.Mat, range_) -> cv.Mat:
+
+def find_green(img, clean: bool = True, profile: Optional[ColorProfile] = None) -> cv.Mat:
+    return find_color(img, (profile or _profile).bounds_of("green"), clean)
+
+
+def find_silver(img, clean: bool = True, profile: Optional[ColorProfile] = None) -> cv.Mat:
+    return find_color(img, (profile or _profile).bounds_of("silver"), clean)
+
+
+def find_obstacle(img, clean: bool = True, profile: Optional[ColorProfile] = None) -> cv.Mat:
+    return find_color(img, (profile or _profile).bounds_of("obstacle"), clean)
+
+
+def find_color(img: cv.Mat, range_, clean: bool = True) -> cv.Mat:
     img = cv.cvtColor(img, cv.COLOR_BGR2LAB)
     mask = cv.inRange(img, *range_)
-    return clean_mask(mask)
+    # the cleaning kernels are too big for downscaled images
+    return clean_mask(mask) if clean else mask
 
 
 def main():
-    global BLACK_COLOR_RANGE, GREEN_COLOR_RANGE
-    global SILVER_COLOR_RANGE, OBSTACLE_COLOR_RANGE
-
     script_dir = os.path.dirname(os.path.realpath(__file__))
     color_ranges_path = os.path.abspath(os.path.join(script_dir, "../colors.csv"))
 
-    load_color_ranges(color_ranges_path)
+    profile = load_profile(color_ranges_path)
 
     cap = cv.VideoCapture(0)
 
@@ -95,17 +193,16 @@ def main():
         cv.namedWindow(name)
 
         trackbars = [f"{n} {e}" for e in ("min", "max") for n in ("L", "A", "B")]
-        for v, t in zip(flatten(ALL_RANGES[current_range]), trackbars):
+        for v, t in zip(flatten(profile.ranges[current_range]), trackbars):
             cv.createTrackbar(t, name, int(v), 255, lambda _: None)
 
         while True:
             _, frame = cap.read()
 
             values = list(map(lambda t: cv.getTrackbarPos(t, name), trackbars))
-            ALL_RANGES[current_range] = group(values, 3)
-            _copy_all_ranges()
+            profile = profile.replace(RANGE_NAMES[current_range], tuple(group(values, 3)))
 
-            mask = find_color(frame, ALL_RANGES[current_range])
+            mask = find_color(frame, profile.bounds[current_range])
 
             both = cv.bitwise_and(frame, frame, mask=mask)
             cv.putText(frame,
@@ -122,10 +219,10 @@ def main():
 
             key = cv.waitKey(1)
             if key == 27:  # esc
-                save_color_ranges(color_ranges_path)
+                save_profile(profile, color_ranges_path)
                 return
             elif key == ord("n"):
-                current_range = (current_range + 1) % len(ALL_RANGES)
+                current_range = (current_range + 1) % len(RANGE_NAMES)
                 cv.destroyAllWindows()
                 break
 
@@ -1,20 +1,24 @@
 import math
-from typing import Iterable, List, Tuple
+from typing import Iterable, List, Optional, Tuple
 import numpy as np
 import cv2 as cv
 
 ColorT = Tuple[int, int, int]
 
 
-def clean_mask(mask: cv.Mat) -> cv.Mat:
-    kernel_erote = np.ones((3, 3), np.uint8)
-    erosion = cv.erode(mask, kernel_erote, iterations=1)
+ERODE_KERNEL = np.ones((3, 3), np.uint8)
+DILATE_KERNEL = np.ones((9, 9), np.uint8)
+CLOSE_KERNEL = np.ones((5, 5), np.uint8)
 
-    kernel_dilate = np.ones((9, 9), np.uint8)
-    dilation = cv.dilate(erosion, kernel_dilate, iterations=2)
 
-    kernel_close = np.ones((5,5),np.uint8)
-    closing = cv.morphologyEx(dilation, cv.MORPH_CLOSE, kernel_close)
+def clean_mask(mask: cv.Mat, dst: Optional[cv.Mat] = None, tmp: Optional[cv.Mat] = None) -> cv.Mat:
+    """
+    Removes the noise and fills the holes.
+    dst and tmp are the buffers to write into instead of allocating new ones, dst may be mask.
+    """
+    erosion = cv.erode(mask, ERODE_KERNEL, dst=dst, iterations=1)
+    dilation = cv.dilate(erosion, DILATE_KERNEL, dst=tmp, iterations=2)
+    closing = cv.morphologyEx(dilation, cv.MORPH_CLOSE, CLOSE_KERNEL, dst=erosion)
 
     return closing
 
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+import cv2 as cv
+import numpy as np
+
+INTERSECTION_SCALE = 4
+INTERSECTION_MAX_SCALE = 8
+INTERSECTION_BUDGET = 0.005  # s
+JUNCTION_WIDTH_RATIO = 2.5  # of the line width
+ARM_MIN_LENGTH_RATIO = 1.5  # of the line width, from the line's edge
+MARKER_MIN_AREA = 4  # px in the downscaled image
+
+
+class IntersectionType(Enum):
+    LEFT_TURN = 0,
+    RIGHT_TURN = 1,
+    T_JUNCTION = 2
+    CROSS = 3,
+
+
+class MarkerSide(Enum):
+    LEFT = 0,
+    RIGHT = 1,
+    BOTH = 2
+
+
+@dataclass
+class IntersectionInfo:
+    type: Optional[IntersectionType]
+    markers: Optional[MarkerSide]
+    elapsed: float  # s
+
+    @staticmethod
+    def empty(elapsed: float = 0.0) -> IntersectionInfo:
+        return IntersectionInfo(None, None, elapsed)
+
+
+def downscale_mask(mask: cv.Mat, scale: int) -> cv.Mat:
+    if scale == 1:
+        return mask
+    small = cv.resize(mask, (mask.shape[1] // scale, mask.shape[0] // scale),
+                      interpolation=cv.INTER_AREA)
+    _, small = cv.threshold(small, 127, 255, cv.THRESH_BINARY)
+    return small
+
+
+def find_line_component(labels: np.ndarray, stats: np.ndarray) -> Optional[int]:
+    """The biggest component which reaches the lower quarter of the image"""
+    if len(stats) < 2:
+        return None
+    height = labels.shape[0]
+    bottoms = stats[1:, cv.CC_STAT_TOP] + stats[1:, cv.CC_STAT_HEIGHT]
+    areas = stats[1:, cv.CC_STAT_AREA].copy()
+    near_bottom = bottoms >= height - height // 4
+    if near_bottom.any():
+        areas[~near_bottom] = 0
+    return int(np.argmax(areas)) + 1
+
+
+def classify_arms(left: bool, right: bool, up: bool) -> Optional[IntersectionType]:
+    if left and right:
+        return IntersectionType.CROSS if up else IntersectionType.T_JUNCTION
+    if left:
+        return IntersectionType.LEFT_TURN
+    if right:
+        return IntersectionType.RIGHT_TURN
+    return None
+
+
+def find_markers(green: cv.Mat, line_x: float,
+                 min_y: float = 0.0) -> Optional[MarkerSide]:
+    """Green squares below min_y, relative to the line"""
+    n, _, stats, centroids = cv.connectedComponentsWithStats(green, connectivity=8)
+    left = right = False
+    for i in range(1, n):
+        if stats[i, cv.CC_STAT_AREA] < MARKER_MIN_AREA:
+            continue
+        x, y = centroids[i]
+        if y < min_y:
+            continue
+        if x < line_x:
+            left = True
+        else:
+            right = True
+
+    if left and right:
+        return MarkerSide.BOTH
+    if left:
+        return MarkerSide.LEFT
+    if right:
+        return MarkerSide.RIGHT
+    return None
+
+
+def detect_intersection(black: cv.Mat, green: cv.Mat,
+                        scale: int = INTERSECTION_SCALE) -> IntersectionInfo:
+    """
+    Both masks have to be of the same frame region.
+    Markers are only looked for below the junction, i.e. before it.
+    """
+    start = time.perf_counter()
+
+    small_black = downscale_mask(black, scale)
+    small_green = downscale_mask(green, scale)
+
+    _, labels, stats, _ = cv.connectedComponentsWithStats(small_black, connectivity=8)
+    line_label = find_line_component(labels, stats)
+    if line_label is None:
+        return IntersectionInfo.empty(time.perf_counter() - start)
+    line = labels == line_label
+
+    row_widths = np.count_nonzero(line, axis=1)
+    line_width = float(np.median(row_widths[row_widths > 0]))
+    junction_rows = np.flatnonzero(row_widths > line_width * JUNCTION_WIDTH_RATIO)
+
+    if len(junction_rows) == 0:
+        line_x = float(np.mean(np.nonzero(line)[1]))
+        markers = find_markers(small_green, line_x)
+        return IntersectionInfo(None, markers, time.perf_counter() - start)
+
+    band_top, band_bottom = junction_rows[0], junction_rows[-1] + 1
+
+    # the line position is taken where it is not widened by the arms
+    line_rows = line[band_bottom:] if line[band_bottom:].any() else line[:band_top]
+    line_xs = np.nonzero(line_rows)[1]
+    line_x = float(np.mean(line_xs)) if len(line_xs) > 0 else line.shape[1] / 2
+
+    band_xs = np.flatnonzero(line[band_top:band_bottom].any(axis=0))
+    min_arm = line_width / 2 + line_width * ARM_MIN_LENGTH_RATIO
+    left = line_x - band_xs[0] > min_arm
+    right = band_xs[-1] - line_x > min_arm
+    # only the continuation of the line counts, not whatever the arms lead to
+    up_start = max(int(line_x - line_width * 2), 0)
+    up_end = int(line_x + line_width * 2) + 1
+    up = bool(line[:max(band_top - 1, 0), up_start:up_end].any())
+
+    markers = find_markers(small_green, line_x, min_y=(band_top + band_bottom) / 2)
+
+    return IntersectionInfo(classify_arms(left, right, up), markers,
+                            time.perf_counter() - start)
+
+
+class IntersectionDetector:
+    """Coarsens the downscaling when it does not fit into the budget"""
+
+    def __init__(self,
+                 budget: float = INTERSECTION_BUDGET,
+                 scale: int = INTERSECTION_SCALE) -> None:
+        self.budget = budget
+        self.scale = scale
+        self._min_scale = scale
+
+    def __call__(self, black: cv.Mat, green: cv.Mat) -> IntersectionInfo:
+        info = detect_intersection(black, green, self.scale)
+        if info.elapsed > self.budget and self.scale < INTERSECTION_MAX_SCALE:
+            self.scale += 1
+        elif info.elapsed < self.budget / 4 and self.scale > self._min_scale:
+            self.scale -= 1
+        return info
+
+
+def main():
+    import glob
+    from . import colors
+
+    for path in sorted(glob.glob("./vision/images/intersection/*.jpg")):
+        img = cv.imread(path)
+        img = cv.resize(img, (img.shape[1] // 4, img.shape[0] // 4))
+
+        black = colors.find_black(img)
+        green = colors.find_green(img)
+        print(path, detect_intersection(black, green))
+
+
+if __name__ == "__main__":
+    main()
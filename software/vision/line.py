@@ -1,20 +1,26 @@
 from __future__ import annotations
 
 import math
-from typing import Iterator, List, Optional, Tuple, Union
+import sys
+import time
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Tuple, Union
 from dataclasses import dataclass
 
 import cv2 as cv
 import numpy as np
 
 from .colors import find_black
-from .window import RegionProperties, Window, windows_in_image
+from .window import WINDOW_HEIGHT, Window, px2win, windows_in_image
 from .common import draw_angled_line, get_fill_frac, is_mat_empty, lower_row, upper_row
 
+if TYPE_CHECKING:
+    from skimage.measure._regionprops import RegionProperties
+
 LINE_WINDOW_STEP = 0.5
 LINE_WINDOW_FIRST_MAX_OFFSET = 25.0
 LINE_WINDOWS_DISTANCE_RANGE = (2.0, 10.0)
 MAX_REGIONS_DISTANCE = 30  # shortest distance
+PYRAMID_SCALE = 4
 
 
 def arange_offset(start: float, offset: float, step: float, include_end: bool = False) -> np.ndarray:
@@ -88,25 +94,30 @@ def find_window(img: cv.Mat,
     step = step or 1.0
 
     for pos in arange_offset(start, max_offset, step, include_end=True):
+        # the end is included, which can overshoot when max_offset is not a multiple of step
+        if pos < 0 or pos > windows_in_image(img):
+            continue
         win = Window(img, pos)
         if validate_window(win):
             return win
     return None
 
 
-def find_line_window_pair(img: cv.Mat) -> WindowPair:
+def find_line_window_pair(img: cv.Mat, scale: float = 1.0) -> WindowPair:
+    """scale is how many times img is smaller than the full resolution image"""
     res = WindowPair.empty()
 
     res.lower = find_window(img,
                             start=0.0,
-                            max_offset=LINE_WINDOW_FIRST_MAX_OFFSET,
+                            max_offset=LINE_WINDOW_FIRST_MAX_OFFSET / scale,
                             step=LINE_WINDOW_STEP)
     if res.lower is None:
         return res
 
-    max_distance = res.lower.pos + 1 + LINE_WINDOWS_DISTANCE_RANGE[1]
-    min_distance_offset = LINE_WINDOWS_DISTANCE_RANGE[1] \
-                            - LINE_WINDOWS_DISTANCE_RANGE[0]
+    distance_range = (LINE_WINDOWS_DISTANCE_RANGE[0] / scale,
+                      LINE_WINDOWS_DISTANCE_RANGE[1] / scale)
+    max_distance = res.lower.pos + 1 + distance_range[1]
+    min_distance_offset = distance_range[1] - distance_range[0]
     res.upper = find_window(img,
                             start=max_distance,
                             max_offset=min_distance_offset,
@@ -115,6 +126,54 @@ def find_line_window_pair(img: cv.Mat) -> WindowPair:
     return res
 
 
+def refine_window(mask: cv.Mat, start: int, end: int, downwards: bool) -> Optional[Window]:
+    """Finds a valid full resolution window within the rows [start, end) of the mask"""
+    height = mask.shape[0]
+    lowest = px2win(height - end)
+    highest = px2win(height - start - WINDOW_HEIGHT)
+    if highest < lowest:
+        return None
+    if downwards:
+        return find_window(mask, start=highest, max_offset=highest - lowest, step=-LINE_WINDOW_STEP)
+    return find_window(mask, start=lowest, max_offset=highest - lowest, step=LINE_WINDOW_STEP)
+
+
+def find_line_window_pair_pyramid(img: cv.Mat,
+                                  scale: int = PYRAMID_SCALE,
+                                  segment: Callable[[cv.Mat, bool], cv.Mat] = find_black
+                                  ) -> Tuple[WindowPair, cv.Mat]:
+    """
+    Coarse-to-fine version of find_line_window_pair, takes a color image.
+    The windows are searched for in a downscaled mask, then only their rows
+    are segmented at full resolution to place the windows precisely.
+
+    segment(img, clean) has the signature of colors.find_black.
+    Returns the full resolution windows and their mask, which is empty outside of them.
+    """
+    height, width = img.shape[:2]
+    small = cv.resize(img, (width // scale, height // scale), interpolation=cv.INTER_AREA)
+    coarse = find_line_window_pair(segment(small, False), scale)
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    res = WindowPair.empty()
+    if coarse.lower is None:
+        return res, mask
+
+    row_scale = height / small.shape[0]
+
+    def refine(win: Window, downwards: bool) -> Optional[Window]:
+        start = math.floor(win.start * row_scale)
+        end = min(math.ceil(win.end * row_scale), height)
+        mask[start:end] = segment(img[start:end], True)
+        return refine_window(mask, start, end, downwards)
+
+    res.lower = refine(coarse.lower, downwards=False)
+    if res.lower is not None and coarse.upper is not None:
+        res.upper = refine(coarse.upper, downwards=True)
+
+    return res, mask
+
+
 def get_best_region(regions: List[RegionProperties]) -> RegionProperties:
     # prefers bigger regions closer to left
     return max(regions,
@@ -194,12 +253,57 @@ def locate_line(wins: WindowPair) -> LineInfo:
     return LineInfo(x_offset, angle)
 
 
+def pyramid_report(scales: Tuple[int, ...] = (2, 4, 8), repeats: int = 10) -> None:
+    """Accuracy and latency of the pyramid mode relative to the full resolution one"""
+    import glob
+    from . import colors
+    colors.set_profile(colors.get_profile().replace("black", (
+            (0, 0, 0),
+            (100, 255, 255)
+            )))
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            res = fn()
+        return res, (time.perf_counter() - start) / repeats
+
+    def full(img):
+        wins = find_line_window_pair(find_black(img))
+        return locate_line(wins) if wins.lower is not None else None
+
+    def pyramid(img, scale):
+        wins, _ = find_line_window_pair_pyramid(img, scale)
+        return locate_line(wins) if wins.lower is not None else None
+
+    print("image scale time_ms dx_px dangle_deg")
+    for path in sorted(glob.glob("./vision/images/**/*.*", recursive=True)):
+        img = cv.imread(path)
+        img = cv.resize(img, (img.shape[1] // 4, img.shape[0] // 4))
+
+        reference, reference_time = timed(lambda: full(img))
+        if reference is None:
+            continue
+        print(f"{path} 1 {reference_time * 1000:.2f} 0 0")
+
+        for scale in scales:
+            line, elapsed = timed(lambda: pyramid(img, scale))
+            if line is None:
+                print(f"{path} {scale} {elapsed * 1000:.2f} - -")
+                continue
+            dx = line.x_offset - reference.x_offset
+            dangle = "-"
+            if line.angle is not None and reference.angle is not None:
+                dangle = f"{math.degrees(line.angle - reference.angle):.2f}"
+            print(f"{path} {scale} {elapsed * 1000:.2f} {dx} {dangle}")
+
+
 def main():
     from . import colors
-    colors.BLACK_COLOR_RANGE =  (
+    colors.set_profile(colors.get_profile().replace("black", (
             (0, 0, 0),
             (120, 120, 120)
-            )
+            )))
 
     img = cv.imread("./vision/images/intersection/4.jpg")
     img = cv.resize(img, (img.shape[1] // 4, img.shape[0] // 4))
@@ -223,4 +327,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if "--pyramid-report" in sys.argv:
+        pyramid_report()
+    else:
+        main()
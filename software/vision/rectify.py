@@ -0,0 +1,123 @@
+"""
+Bird's-eye rectification of the line band.
+
+The camera is tilted, so the farther a part of the band is, the fewer pixels a
+millimetre takes, and the angles locate_line measures depend on where the line is.
+A calibration maps four points of the full frame to their positions on the ground;
+the remap maps of the band are computed from it once and cached, then a frame costs
+one cv.remap. The rectified band keeps the band's shape and has the same scale in
+both directions, its bottom middle is where the bottom middle of the band looks.
+"""
+import argparse
+import functools
+import json
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from .camera import CAPTURE_RESOLUTION
+
+Points = Tuple[Tuple[float, float], ...]
+
+
+@dataclass(frozen=True)
+class Calibration:
+    image_points: Points  # px of the full frame
+    ground_points: Points  # mm, x to the right, y away from the robot
+
+    def homography(self) -> np.ndarray:
+        """From the full frame to the ground"""
+        return cv.getPerspectiveTransform(np.float32(self.image_points),
+                                          np.float32(self.ground_points))
+
+
+def load_calibration(path: str) -> Calibration:
+    with open(path) as f:
+        data = json.load(f)
+    image_points = tuple(tuple(map(float, p)) for p in data["image_points"])
+    ground_points = tuple(tuple(map(float, p)) for p in data["ground_points"])
+    if len(image_points) != 4 or len(ground_points) != 4:
+        raise ValueError(f"{path}: expected four image and four ground points")
+    return Calibration(image_points, ground_points)
+
+
+def save_calibration(calibration: Calibration, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump({"image_points": calibration.image_points,
+                   "ground_points": calibration.ground_points}, f, indent=4)
+
+
+@functools.lru_cache(maxsize=4)
+def rectification_maps(calibration: Calibration, band_shape: Tuple[int, int],
+                       band_top: int) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    cv.remap maps of a band of band_shape which starts at the row band_top of the frame,
+    and the rectified band's px per mm
+    """
+    height, width = band_shape[:2]
+    to_ground = calibration.homography()
+
+    corners = np.float32([[0, band_top], [width - 1, band_top],
+                          [0, band_top + height - 1], [width - 1, band_top + height - 1],
+                          [(width - 1) / 2, band_top + height - 1]])
+    ground = cv.perspectiveTransform(corners[None], to_ground)[0]
+    extent = ground[:4].max(axis=0) - ground[:4].min(axis=0)
+    scale = min((width - 1) / extent[0], (height - 1) / extent[1])
+    origin_x, near_y = ground[4]
+
+    # the ground point every pixel of the rectified band shows
+    u, v = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    ground_x = origin_x + (u - (width - 1) / 2) / scale
+    ground_y = near_y + (height - 1 - v) / scale
+    grid = np.dstack((ground_x, ground_y)).reshape(1, -1, 2)
+    source = cv.perspectiveTransform(grid, np.linalg.inv(to_ground)).reshape(height, width, 2)
+    source[..., 1] -= band_top
+
+    map1, map2 = cv.convertMaps(source, None, cv.CV_16SC2)
+    return map1, map2, float(scale)
+
+
+class Rectifier:
+    def __init__(self, calibration: Calibration, band_shape: Tuple[int, int],
+                 band_top: int) -> None:
+        self._map1, self._map2, self.px_per_mm = rectification_maps(
+            calibration, tuple(band_shape[:2]), band_top)
+        self._dst: Optional[np.ndarray] = None
+
+    def __call__(self, band: np.ndarray) -> np.ndarray:
+        """The rectified band, valid until the next call"""
+        if band.shape[:2] != self._map1.shape[:2]:
+            raise ValueError(f"Expected a band of {self._map1.shape[:2]}, got {band.shape[:2]}")
+        if self._dst is None or self._dst.shape != band.shape:
+            self._dst = np.empty_like(band)
+        # the parts out of the band are stretched from its edges, a constant could pass for the line
+        return cv.remap(band, self._map1, self._map2, cv.INTER_LINEAR,
+                        dst=self._dst, borderMode=cv.BORDER_REPLICATE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shows the rectified line band of an image")
+    parser.add_argument("calibration")
+    parser.add_argument("image")
+    parser.add_argument("--band-top", type=int, default=0, help="first row of the band")
+    args = parser.parse_args()
+
+    img = cv.resize(cv.imread(args.image), CAPTURE_RESOLUTION)
+    band = img[args.band_top:]
+    rectifier = Rectifier(load_calibration(args.calibration), band.shape, args.band_top)
+
+    start = time.perf_counter()
+    for _ in range(100):
+        rectified = rectifier(band)
+    print(f"{(time.perf_counter() - start) * 10:.3f} ms per band, {rectifier.px_per_mm:.3f} px/mm")
+
+    cv.imshow("band", band)
+    cv.imshow("rectified", rectified)
+    cv.waitKey(0)
+
+
+if __name__ == "__main__":
+    main()
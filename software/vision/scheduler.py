@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Generic, List, Optional, TypeVar
+
+COST_SMOOTHING = 0.2  # weight of the newest measurement
+DUE_TOLERANCE = 0.1  # of the period, frames never arrive exactly on time
+# a skipped task's cost is not measured again, so one slow run could keep it out for good
+MAX_LATENESS = 3.0  # periods, a task this late runs whatever the budget
+
+T = TypeVar("T")
+
+
+@dataclass
+class Result(Generic[T]):
+    value: T
+    seq: int  # of the frame it was computed on
+    timestamp: float  # of that frame
+    elapsed: float  # s
+
+
+@dataclass
+class Task:
+    name: str
+    fn: Callable[[Any], Any]
+    rate: Optional[float]  # Hz, None - every frame
+    priority: int
+    cost: Optional[float] = None  # s, smoothed
+    next_due: Optional[float] = None
+    result: Optional[Result] = field(default=None, repr=False)
+
+    @property
+    def every_frame(self) -> bool:
+        return self.rate is None
+
+    def lateness(self, now: float) -> float:
+        """How late the task is, in periods"""
+        if self.every_frame or self.next_due is None:
+            return 0.0
+        return (now - self.next_due) * self.rate
+
+    def record(self, result: Result) -> None:
+        self.result = result
+        if self.cost is None:
+            self.cost = result.elapsed
+        else:
+            self.cost += COST_SMOOTHING * (result.elapsed - self.cost)
+
+
+class Scheduler:
+    """
+    Runs detectors on frames, each at its own rate.
+
+    The every-frame tasks always run, in the order of registration.
+    The periodic ones which are due run by priority and lateness while their
+    expected cost fits into what is left of the frame budget; the rest wait for
+    the following frames, which spreads the slow detectors over several frames.
+    A task max_lateness periods overdue runs even over the budget.
+    """
+
+    def __init__(self, budget: float,
+                 clock: Callable[[], float] = time.perf_counter,
+                 max_lateness: float = MAX_LATENESS) -> None:
+        self.budget = budget
+        self.max_lateness = max_lateness
+        self._clock = clock
+        self._tasks: Dict[str, Task] = {}
+
+    def register(self, name: str, fn: Callable[[Any], Any],
+                 rate: Optional[float] = None, priority: int = 0) -> None:
+        if name in self._tasks:
+            raise ValueError(f"Task {name} is already registered")
+        if rate is not None and rate <= 0:
+            raise ValueError(f"Rate of {name} has to be positive")
+        self._tasks[name] = Task(name, fn, rate, priority)
+
+    def result(self, name: str) -> Optional[Result]:
+        return self._tasks[name].result
+
+    def costs(self) -> Dict[str, Optional[float]]:
+        return {name: task.cost for name, task in self._tasks.items()}
+
+    def run(self, seq: int, timestamp: float, data: Any) -> Dict[str, Result]:
+        """Returns the results computed on this frame"""
+        start = self._clock()
+        results = {}
+
+        for task in self._tasks.values():
+            if task.every_frame:
+                results[task.name] = self._run_task(task, seq, timestamp, data)
+
+        for task in self._due(timestamp):
+            remaining = self.budget - (self._clock() - start)
+            # a task which has never run is tried once to find out its cost
+            if task.cost is not None and task.cost > remaining \
+                    and task.lateness(timestamp) < self.max_lateness:
+                continue
+            results[task.name] = self._run_task(task, seq, timestamp, data)
+            # counted from the actual run, so that the deferred tasks stay spread
+            task.next_due = timestamp + 1 / task.rate
+
+        return results
+
+    def _due(self, now: float) -> List[Task]:
+        due = []
+        for task in self._tasks.values():
+            if task.every_frame:
+                continue
+            if task.next_due is None:
+                task.next_due = now
+            if task.next_due - now <= DUE_TOLERANCE / task.rate:
+                due.append(task)
+        return sorted(due, key=lambda t: (-t.priority, -t.lateness(now)))
+
+    def _run_task(self, task: Task, seq: int, timestamp: float, data: Any) -> Result:
+        start = self._clock()
+        value = task.fn(data)
+        result = Result(value, seq, timestamp, self._clock() - start)
+        task.record(result)
+        return result
@@ -0,0 +1,68 @@
+"""
+Color segmentation which does not allocate in steady state.
+
+find_color allocates the LAB image, the mask and every step of the cleaning
+on each call; the context owns all of them instead, sized once for the image,
+and OpenCV writes into them through dst=. The returned masks are overwritten
+by the next frame, copy whatever has to be kept longer.
+"""
+import time
+from typing import Dict, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from .camera import CAPTURE_RESOLUTION
+from .colors import RANGE_NAMES, ColorProfile, find_color, get_profile
+from .common import clean_mask
+
+
+class SegmentationContext:
+    def __init__(self, shape: Tuple[int, int]) -> None:
+        """shape - (height, width) of the images which are going to be segmented"""
+        self.shape = tuple(shape[:2])
+        height, width = self.shape
+        self._lab = np.empty((height, width, 3), dtype=np.uint8)
+        self._tmp = np.empty((height, width), dtype=np.uint8)
+        self._masks: Dict[str, np.ndarray] = {name: np.empty((height, width), dtype=np.uint8)
+                                              for name in RANGE_NAMES}
+
+    def convert(self, img: cv.Mat) -> np.ndarray:
+        """The image in LAB, valid until the next call"""
+        if img.shape[:2] != self.shape:
+            raise ValueError(f"Expected an image of {self.shape}, got {img.shape[:2]}")
+        return cv.cvtColor(img, cv.COLOR_BGR2LAB, dst=self._lab)
+
+    def find(self, lab: np.ndarray, name: str, clean: bool = True,
+             profile: Optional[ColorProfile] = None) -> np.ndarray:
+        """Mask of a color of the converted image, valid until the same color is found again"""
+        mask = self._masks[name]
+        cv.inRange(lab, *(profile or get_profile()).bounds_of(name), dst=mask)
+        if clean:
+            clean_mask(mask, dst=mask, tmp=self._tmp)
+        return mask
+
+
+def main():
+    img = np.random.randint(0, 256, (*CAPTURE_RESOLUTION[::-1], 3), dtype=np.uint8)
+    context = SegmentationContext(img.shape)
+
+    def allocating():
+        for name in RANGE_NAMES:
+            find_color(img, get_profile().bounds_of(name))
+
+    def preallocated():
+        lab = context.convert(img)
+        for name in RANGE_NAMES:
+            context.find(lab, name)
+
+    for fn in (allocating, preallocated):
+        fn()
+        start = time.perf_counter()
+        for _ in range(100):
+            fn()
+        print(f"{fn.__name__}: {(time.perf_counter() - start) * 10:.2f} ms per frame")
+
+
+if __name__ == "__main__":
+    main()
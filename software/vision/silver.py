@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import cv2 as cv
+import numpy as np
+
+from . import colors
+from .colors import ColorProfile
+
+SILVER_SCALE = 8
+SILVER_BAND_RATIO = 0.5  # of the image height, from the bottom
+SILVER_MIN_ROW_FILLED = 0.6  # the strip goes across the whole field
+SILVER_MIN_ROWS = 2  # in the downscaled image
+SILVER_CONFIRM_FRAMES = 3
+
+
+@dataclass
+class SilverInfo:
+    found: bool
+    filled: float  # of the widest row, 0..1
+    elapsed: float  # s
+
+
+def silver_band(img: cv.Mat, scale: int = SILVER_SCALE) -> cv.Mat:
+    """Downscaled bottom part of the image, the colors are averaged by INTER_AREA"""
+    band = img[img.shape[0] - int(img.shape[0] * SILVER_BAND_RATIO):, :]
+    size = (max(band.shape[1] // scale, 1), max(band.shape[0] // scale, 1))
+    return cv.resize(band, size, interpolation=cv.INTER_AREA)
+
+
+def detect_silver(img: cv.Mat, scale: int = SILVER_SCALE,
+                  profile: Optional[ColorProfile] = None) -> SilverInfo:
+    """
+    Looks for rows of the bottom band which are mostly silver.
+    The line and the markers are narrow, so they do not fill a row.
+    """
+    start = time.perf_counter()
+
+    small = silver_band(img, scale)
+    # no cleaning: the kernels are bigger than the strip at this scale
+    mask = colors.find_silver(small, clean=False, profile=profile)
+
+    row_filled = np.count_nonzero(mask, axis=1) / mask.shape[1]
+    found = np.count_nonzero(row_filled >= SILVER_MIN_ROW_FILLED) >= SILVER_MIN_ROWS
+
+    return SilverInfo(bool(found), float(row_filled.max(initial=0.0)),
+                      time.perf_counter() - start)
+
+
+class SilverDetector:
+    """Triggers only after the strip is seen in several consecutive frames"""
+
+    def __init__(self, confirm_frames: int = SILVER_CONFIRM_FRAMES,
+                 scale: int = SILVER_SCALE) -> None:
+        self.confirm_frames = confirm_frames
+        self.scale = scale
+        self._seen = 0
+
+    @property
+    def triggered(self) -> bool:
+        return self._seen >= self.confirm_frames
+
+    def reset(self) -> None:
+        self._seen = 0
+
+    def __call__(self, img: cv.Mat,
+                 profile: Optional[ColorProfile] = None) -> SilverInfo:
+        info = detect_silver(img, self.scale, profile)
+        self._seen = self._seen + 1 if info.found else 0
+        return info
+
+
+def main():
+    import glob
+
+    for path in sorted(glob.glob("./vision/images/*.jpg")):
+        img = cv.imread(path)
+        img = cv.resize(img, (img.shape[1] // 4, img.shape[0] // 4))
+        print(path, detect_silver(img))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,27 @@
 import math
+import os
+import time
+import tracemalloc
 from typing import Tuple
 import pytest
 
 import numpy as np
 import cv2 as cv
 
-from .common import draw_angled_line, left_half, lower_row, mid_row, upper_row
+from . import colors
+from .common import clean_mask, draw_angled_line, is_mat_empty, is_mat_filled, left_half, lower_row, mid_row, upper_row
 from .line import LINE_WINDOWS_DISTANCE_RANGE, MAX_REGIONS_DISTANCE, LineInfo, WindowPair, \
-                   arange_offset, bounds_distance, find_line_window_pair, \
+                   arange_offset, bounds_distance, find_line_window_pair, find_line_window_pair_pyramid, \
                    find_window, get_matching_regions, locate_line, validate_window
 from .window import Window, win2px, windows_in_image
+from .intersection import IntersectionType, MarkerSide, detect_intersection
+from .calibration import BACKGROUND_LABEL, best_range, box_sums, build_histograms, summed_volume
+from .silver import SilverDetector, detect_silver
+from .scheduler import Scheduler
+from .ball import Ball, BallTracker, find_balls
+from .rectify import Calibration, Rectifier, load_calibration, rectification_maps, save_calibration
+from .segmentation import SegmentationContext
+from .threshold import AdaptiveThreshold, otsu
 
 LINE_ANGLE = 15  # deg
 WINDOW_WIDTH = 100
@@ -338,3 +350,522 @@ def test_locate_line_correct_angle(line_win: Window):
     line = locate_line(wins)
     assert line.angle is not None
     assert math.degrees(line.angle) == approx(LINE_ANGLE)
+
+
+def intersection_img_impl(left: bool, right: bool, up: bool):
+    img = np.zeros(shape=(120, 160), dtype="uint8")
+    center, thickness, junction_y = 80, 12, 50
+
+    top = 0 if up else junction_y - thickness // 2
+    img[top:, center - thickness // 2:center + thickness // 2].fill(255)
+    if left:
+        img[junction_y - thickness // 2:junction_y + thickness // 2, :center].fill(255)
+    if right:
+        img[junction_y - thickness // 2:junction_y + thickness // 2, center:].fill(255)
+
+    return img
+
+
+@pytest.mark.parametrize("arms,expected",
+                         [((True, True, True), IntersectionType.CROSS),
+                          ((True, True, False), IntersectionType.T_JUNCTION),
+                          ((True, False, False), IntersectionType.LEFT_TURN),
+                          ((False, True, True), IntersectionType.RIGHT_TURN),
+                          ((False, False, True), None)])
+def test_detect_intersection_type(arms, expected):
+    black = intersection_img_impl(*arms)
+    green = np.zeros_like(black)
+
+    info = detect_intersection(black, green)
+    assert info.type == expected
+    assert info.markers is None
+    assert info.elapsed > 0
+
+
+def test_detect_intersection_markers():
+    black = intersection_img_impl(True, True, True)
+    green = np.zeros_like(black)
+    green[70:90, 40:60].fill(255)  # bellow the junction, on the left
+    assert detect_intersection(black, green).markers == MarkerSide.LEFT
+
+    green[70:90, 100:120].fill(255)
+    assert detect_intersection(black, green).markers == MarkerSide.BOTH
+
+
+def test_detect_intersection_ignores_markers_after_junction():
+    black = intersection_img_impl(True, True, True)
+    green = np.zeros_like(black)
+    green[10:30, 100:120].fill(255)
+    assert detect_intersection(black, green).markers is None
+
+
+def gray_segment(img: cv.Mat, clean: bool = True):
+    mask = cv.inRange(img, (127, 127, 127), (255, 255, 255))
+    return clean_mask(mask) if clean else mask
+
+
+@pytest.mark.parametrize("scale", [2, 4])
+def test_pyramid_matches_full_resolution(scale: int):
+    # the coarse search needs more rows than the synthetic windows image has
+    img = np.zeros(shape=(win2px(40), 320), dtype="uint8")
+    draw_angled_line(img,
+                     x1=img.shape[1] // 2 + 10,
+                     y1=img.shape[0],
+                     y2=0,
+                     angle=math.radians(LINE_ANGLE),
+                     color=(255,),
+                     thickness=3)
+    color = cv.cvtColor(img, cv.COLOR_GRAY2BGR)
+
+    reference = locate_line(find_line_window_pair(gray_segment(color)))
+    wins, mask = find_line_window_pair_pyramid(color, scale, segment=gray_segment)
+
+    assert wins.is_complete
+    assert mask.shape == img.shape
+    line = locate_line(wins)
+    assert line.x_offset == approx(reference.x_offset)
+    assert math.degrees(line.angle) == approx(math.degrees(reference.angle))
+
+
+def test_pyramid_no_false_positive():
+    color = np.zeros(shape=(win2px(40), 320, 3), dtype="uint8")
+    wins, mask = find_line_window_pair_pyramid(color, segment=gray_segment)
+
+    assert wins == WindowPair.empty()
+    assert is_mat_empty(mask)
+
+
+def test_box_sums_match_brute_force():
+    rng = np.random.default_rng(0)
+    hist = rng.integers(0, 10, size=(8, 8, 8))
+    lower = np.array([[0, 0, 0], [1, 2, 3], [4, 4, 4]])
+    upper = np.array([[7, 7, 7], [3, 5, 3], [4, 6, 5]])
+
+    sums = box_sums(summed_volume(hist), lower, upper)
+    for lo, hi, s in zip(lower, upper, sums):
+        assert s == hist[lo[0]:hi[0] + 1, lo[1]:hi[1] + 1, lo[2]:hi[2] + 1].sum()
+
+
+def test_calibration_separates_classes():
+    img = np.full((60, 90, 3), 230, dtype="uint8")  # light background
+    img[:, :30] = (20, 20, 20)  # black
+    img[:, 30:60] = (60, 160, 40)  # green
+    noise = np.random.default_rng(0).integers(-10, 10, size=img.shape)
+    img = np.clip(img.astype(int) + noise, 0, 255).astype("uint8")
+
+    masks = {"black": np.zeros(img.shape[:2], dtype=bool),
+             "green": np.zeros(img.shape[:2], dtype=bool),
+             BACKGROUND_LABEL: np.zeros(img.shape[:2], dtype=bool)}
+    masks["black"][:, :30] = True
+    masks["green"][:, 30:60] = True
+    masks[BACKGROUND_LABEL][:, 60:] = True
+
+    hists = build_histograms([(img, masks)], ("black", "green", BACKGROUND_LABEL))
+    for label in ("black", "green"):
+        range_, tpr, fpr = best_range(hists, label)
+        assert tpr > 0.95
+        assert fpr < 0.01
+
+        mask = cv.inRange(cv.cvtColor(img, cv.COLOR_BGR2LAB), *range_) > 0
+        assert np.count_nonzero(mask & masks[label]) / np.count_nonzero(masks[label]) > 0.95
+        assert np.count_nonzero(mask & ~masks[label]) < 0.01 * mask.size
+
+
+def test_color_profile_is_immutable():
+    profile = colors.DEFAULT_PROFILE
+    replaced = profile.replace("black", ((0, 0, 0), (100, 255, 255)))
+
+    assert replaced["black"] == ((0, 0, 0), (100, 255, 255))
+    assert profile["black"] != replaced["black"]
+    assert replaced["green"] == profile["green"]
+    with pytest.raises(ValueError):
+        profile.bounds_of("black")[0][0] = 1
+
+
+def test_color_profile_save_load(tmp_path):
+    path = str(tmp_path / "colors.csv")
+    profile = colors.DEFAULT_PROFILE.replace("green", ((1, 2, 3), (4, 5, 6)))
+    colors.save_profile(profile, path)
+
+    assert colors.load_profile(path) == profile
+    # the CSV is used when the cache is stale
+    other = profile.replace("green", ((7, 8, 9), (10, 11, 12)))
+    np.savetxt(path, other.to_array(), fmt="%i")
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert colors.load_profile(path) == other
+
+
+def test_color_profile_save_leaves_no_temporary_files(tmp_path):
+    path = str(tmp_path / "colors.csv")
+    colors.save_profile(colors.DEFAULT_PROFILE, path)
+    colors.save_profile(colors.DEFAULT_PROFILE, path)
+    assert sorted(os.listdir(tmp_path)) == ["colors.bin", "colors.csv"]
+
+    with pytest.raises(ValueError):
+        colors._replace_file(path, lambda f: np.savetxt(f, np.zeros((2, 2)), fmt="%q"))
+    assert sorted(os.listdir(tmp_path)) == ["colors.bin", "colors.csv"]
+    assert colors.load_profile(path) == colors.DEFAULT_PROFILE
+
+
+def test_find_color_uses_given_profile():
+    img = np.zeros((20, 20, 3), dtype="uint8")
+    everything = colors.DEFAULT_PROFILE.replace("black", ((0, 0, 0), (255, 255, 255)))
+    nothing = colors.DEFAULT_PROFILE.replace("black", ((255, 255, 255), (255, 255, 255)))
+
+    assert is_mat_filled(colors.find_black(img, clean=False, profile=everything))
+    assert is_mat_empty(colors.find_black(img, clean=False, profile=nothing))
+
+
+GRAY_SILVER_PROFILE = colors.DEFAULT_PROFILE.replace("silver", ((140, 120, 120), (180, 136, 136)))
+
+
+def silver_img(strip: bool = True):
+    img = np.full((240, 320, 3), 255, dtype="uint8")
+    cv.line(img, (160, 0), (160, 240), (0, 0, 0), 20)
+    if strip:
+        img[180:220, :] = (150, 150, 150)
+    return img
+
+
+def test_detect_silver():
+    assert detect_silver(silver_img(), profile=GRAY_SILVER_PROFILE).found
+    assert not detect_silver(silver_img(False), profile=GRAY_SILVER_PROFILE).found
+
+
+def test_detect_silver_ignores_narrow_regions():
+    img = silver_img(False)
+    # silver-ish line instead of the strip
+    cv.line(img, (80, 0), (80, 240), (150, 150, 150), 40)
+    assert not detect_silver(img, profile=GRAY_SILVER_PROFILE).found
+
+
+def test_silver_detector_debounces():
+    detector = SilverDetector(confirm_frames=3)
+    for strip in (True, True, False, True, True):
+        detector(silver_img(strip), GRAY_SILVER_PROFILE)
+        assert not detector.triggered
+    detector(silver_img(), GRAY_SILVER_PROFILE)
+    assert detector.triggered
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def task(self, cost: float, value=None):
+        def fn(_):
+            self.now += cost
+            return value
+        return fn
+
+
+def test_scheduler_runs_every_frame_tasks_always():
+    clock = FakeClock()
+    scheduler = Scheduler(budget=0.01, clock=clock)
+    scheduler.register("line", clock.task(0.05, "line"))
+    scheduler.register("slow", clock.task(0.02), rate=5)
+
+    for seq in range(10):
+        results = scheduler.run(seq, seq * 0.1, None)
+        assert results["line"].value == "line"
+        assert results["line"].seq == seq
+        # the line alone is over the budget, so the slow one only runs to measure itself
+        # and once it is MAX_LATENESS periods late
+        assert ("slow" in results) == (seq in (0, 8))
+
+
+def test_scheduler_respects_rates():
+    clock = FakeClock()
+    scheduler = Scheduler(budget=1.0, clock=clock)
+    scheduler.register("fast", clock.task(0.001), rate=10)
+    scheduler.register("slow", clock.task(0.001), rate=2.5)
+
+    runs = {"fast": 0, "slow": 0}
+    for seq in range(40):
+        for name in scheduler.run(seq, seq * 0.1, None):
+            runs[name] += 1
+
+    assert runs == {"fast": 40, "slow": 10}
+
+
+def test_scheduler_spreads_slow_tasks():
+    clock = FakeClock()
+    scheduler = Scheduler(budget=0.03, clock=clock)
+    scheduler.register("line", clock.task(0.01))
+    for name in ("a", "b", "c"):
+        scheduler.register(name, clock.task(0.015), rate=2)
+
+    runs = {name: [] for name in ("a", "b", "c")}
+    for seq in range(40):
+        start = clock.now
+        results = scheduler.run(seq, seq * 0.1, None)
+        if seq > 0:
+            assert clock.now - start <= 0.03 + 1e-9
+        for name, result in results.items():
+            if name in runs:
+                runs[name].append(result.seq)
+
+    for seqs in runs.values():
+        assert len(seqs) >= 7
+    # no two slow tasks on the same frame after the first one
+    all_seqs = [s for seqs in runs.values() for s in seqs if s > 0]
+    assert len(all_seqs) == len(set(all_seqs))
+
+
+def test_scheduler_does_not_starve_slow_tasks():
+    clock = FakeClock()
+    scheduler = Scheduler(budget=0.03, clock=clock, max_lateness=2)
+    scheduler.register("line", clock.task(0.01))
+    costs = iter([0.1] + [0.005] * 100)  # one slow frame first
+    scheduler.register("intersection", lambda _: clock.task(next(costs))(_), rate=5)
+
+    seqs = []
+    for seq in range(30):
+        if "intersection" in scheduler.run(seq, seq * 0.1, None):
+            seqs.append(seq)
+
+    # the smoothed cost stays over the budget for a while, but it runs once 2 periods late
+    assert seqs[:2] == [0, 6]
+    assert all(b - a <= 7 for a, b in zip(seqs, seqs[1:]))
+    assert seqs[-1] >= 29 - 7
+
+
+def test_scheduler_prefers_priority():
+    clock = FakeClock()
+    scheduler = Scheduler(budget=0.02, clock=clock)
+    scheduler.register("low", clock.task(0.015), rate=10, priority=0)
+    scheduler.register("high", clock.task(0.015), rate=10, priority=1)
+
+    scheduler.run(0, 0.0, None)  # measures the costs
+    results = scheduler.run(1, 0.1, None)
+    assert list(results) == ["high"]
+    # the deferred one is late now, but the priority still wins
+    results = scheduler.run(2, 0.2, None)
+    assert list(results) == ["high"]
+    assert scheduler.result("low").seq == 0
+
+
+def ball_img(x: int, y: int, radius: int = 20):
+    img = np.full((240, 320, 3), 220, dtype="uint8")
+    cv.circle(img, (x, y), radius, (90, 90, 90), -1)
+    return img
+
+
+def test_find_balls():
+    balls = find_balls(ball_img(100, 120), scale=2)
+    assert len(balls) > 0
+    assert balls[0].distance_to(Ball(100, 120, 20)) < 4
+    assert balls[0].radius == pytest.approx(20, abs=4)
+    assert find_balls(np.full((240, 320, 3), 220, dtype="uint8"), scale=2) == []
+
+
+def test_find_balls_real_image():
+    img = cv.imread("./vision/images/ball.jpg")
+    tracker = BallTracker()
+    info = tracker(img)
+    assert info.ball is not None and not info.tracked
+    assert info.ball.distance_to(Ball(945, 60, 60)) < 30
+
+
+def test_ball_tracker_follows_ball():
+    tracker = BallTracker(search_width=160)
+    assert not tracker(ball_img(100, 120)).tracked
+    assert tracker.locked
+
+    for x in range(110, 200, 10):
+        info = tracker(ball_img(x, 120))
+        assert info.tracked
+        assert info.ball.distance_to(Ball(x, 120, 20)) < 4
+
+
+def test_ball_tracker_gives_up():
+    tracker = BallTracker(max_misses=2)
+    tracker(ball_img(100, 120))
+    empty = np.full((240, 320, 3), 220, dtype="uint8")
+    for _ in range(2):
+        tracker(empty)
+        assert tracker.locked
+    tracker(empty)
+    assert not tracker.locked
+
+
+DARK_BLACK_PROFILE = colors.DEFAULT_PROFILE.replace("black", ((0, 0, 0), (60, 255, 255)))
+
+
+def segmentation_img():
+    img = np.full((120, 160, 3), 255, dtype=np.uint8)
+    cv.rectangle(img, (60, 0), (90, 119), (0, 0, 0), -1)
+    cv.circle(img, (20, 60), 3, (0, 0, 0), -1)  # noise
+    return img
+
+
+def test_segmentation_context_matches_find_color():
+    img = segmentation_img()
+    context = SegmentationContext(img.shape)
+    for clean in (True, False):
+        expected = colors.find_black(img, clean=clean, profile=DARK_BLACK_PROFILE)
+        mask = context.find(context.convert(img), "black", clean=clean, profile=DARK_BLACK_PROFILE)
+        assert np.array_equal(mask, expected)
+    assert not is_mat_empty(mask)
+
+
+def test_segmentation_context_rejects_other_shapes():
+    context = SegmentationContext((120, 160))
+    with pytest.raises(ValueError):
+        context.convert(np.zeros((100, 160, 3), dtype=np.uint8))
+
+
+def test_segmentation_context_does_not_allocate():
+    img = segmentation_img()
+    context = SegmentationContext(img.shape)
+
+    def segment():
+        lab = context.convert(img)
+        context.find(lab, "black", profile=DARK_BLACK_PROFILE)
+        context.find(lab, "green", profile=DARK_BLACK_PROFILE)
+
+    segment()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(10):
+            segment()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # numpy reports its buffers to tracemalloc, a single new mask would be bigger than this
+    assert peak - before < img.shape[0] * img.shape[1] // 4
+
+
+# the far edge of the frame sees a three times wider strip of the floor than the near one
+TILTED_CAMERA = Calibration(image_points=((0, 0), (159, 0), (0, 119), (159, 119)),
+                            ground_points=((-300, 600), (300, 600), (-100, 100), (100, 100)))
+
+
+def tilted_view(angle: float, band_top: int = 0) -> np.ndarray:
+    """What the tilted camera sees of a line through (0, 300) mm, angle is from the y axis"""
+    v, u = np.mgrid[band_top:120, 0:160].astype(np.float32)
+    ground = cv.perspectiveTransform(np.dstack((u, v)).reshape(1, -1, 2),
+                                     TILTED_CAMERA.homography()).reshape(120 - band_top, 160, 2)
+    direction = np.array([math.sin(angle), math.cos(angle)])
+    normal = np.array([direction[1], -direction[0]])
+    distance = np.abs((ground - (0, 300)) @ normal)
+    return np.where(distance < 20, 255, 0).astype(np.uint8)
+
+
+def mask_angle(mask: np.ndarray) -> float:
+    """From the vertical, positive when the line leans to the right"""
+    vy, vx = np.nonzero(mask)
+    slope = np.polyfit(vy, vx, 1)[0]
+    return math.atan(-slope)
+
+
+@pytest.mark.parametrize("band_top", [0, 40])
+def test_rectified_angle_is_metric(band_top: int):
+    angle = math.radians(20)
+    mask = tilted_view(angle, band_top)
+    rectified = Rectifier(TILTED_CAMERA, mask.shape, band_top)(mask)
+    assert abs(mask_angle(mask) - angle) > math.radians(3)
+    assert mask_angle(rectified) == pytest.approx(angle, abs=math.radians(1))
+
+
+def test_rectification_maps_are_cached(tmp_path):
+    path = str(tmp_path / "calibration.json")
+    save_calibration(TILTED_CAMERA, path)
+    loaded = load_calibration(path)
+    assert loaded == TILTED_CAMERA
+
+    first = Rectifier(loaded, (80, 160), 40)
+    second = Rectifier(TILTED_CAMERA, (80, 160), 40)
+    assert first._map1 is second._map1
+    assert rectification_maps.cache_info().hits > 0
+
+    with pytest.raises(ValueError):
+        first(np.zeros((120, 160), dtype=np.uint8))
+
+
+def lit_line_lab(brightness: int) -> np.ndarray:
+    """A dark line on the white field, everything scaled by the lighting"""
+    img = np.full((120, 160, 3), 200, dtype=np.uint8)
+    cv.rectangle(img, (70, 0), (90, 119), (40, 40, 40), -1)
+    img = cv.convertScaleAbs(img, alpha=brightness / 100)
+    return cv.cvtColor(img, cv.COLOR_BGR2LAB)
+
+
+def test_otsu_splits_between_modes():
+    histogram = np.zeros(256)
+    histogram[30:40] = 1
+    histogram[180:200] = 3
+    threshold, separation = otsu(histogram)
+    assert 40 <= threshold < 180
+    assert separation > 0.9
+
+
+def test_adaptive_threshold_follows_lighting():
+    adaptive = AdaptiveThreshold(initial=60)
+    for _ in range(5):
+        adaptive.update(lit_line_lab(100))
+    dim = adaptive.threshold
+
+    # brighter, so the line's L is above the calibrated 60
+    bright = lit_line_lab(180)
+    assert bright[0, 80, 0] > 60
+    for _ in range(30):
+        adaptive.update(bright)
+    assert adaptive.threshold > dim
+
+    mask = cv.inRange(bright, *adaptive.apply(DARK_BLACK_PROFILE).bounds_of("black"))
+    assert is_mat_filled(mask[:, 72:88])
+    assert is_mat_empty(mask[:, :60])
+
+
+def test_adaptive_threshold_keeps_value_without_line():
+    field = np.full((120, 160, 3), 200, dtype=np.uint8)
+    noise = np.random.default_rng(0).integers(-10, 10, field.shape)
+    field = cv.cvtColor(np.clip(field + noise, 0, 255).astype(np.uint8), cv.COLOR_BGR2LAB)
+
+    # Otsu would split the noise of the field
+    adaptive = AdaptiveThreshold(initial=60)
+    for _ in range(10):
+        adaptive.update(field)
+    assert adaptive.threshold == 60
+
+    # the forgotten line still bounds it from above
+    adaptive = AdaptiveThreshold(initial=60)
+    adaptive.update(lit_line_lab(100))
+    for _ in range(50):
+        adaptive.update(field)
+    mask = cv.inRange(field, *adaptive.apply(DARK_BLACK_PROFILE).bounds_of("black"))
+    assert is_mat_empty(mask)
+
+
+def test_adaptive_threshold_keeps_chroma_bounds():
+    adaptive = AdaptiveThreshold(initial=77)
+    adapted = adaptive.apply(DARK_BLACK_PROFILE)
+    assert adapted["black"] == ((0, 0, 0), (77, 255, 255))
+    assert adaptive.apply(DARK_BLACK_PROFILE) is adapted
+
+
+def test_adaptive_threshold_applies_with_hysteresis():
+    adaptive = AdaptiveThreshold(initial=77, apply_step=3)
+    adapted = adaptive.apply(DARK_BLACK_PROFILE)
+
+    # the frame to frame jitter does not rebuild the profile
+    for threshold in (78, 76, 79, 75):
+        adaptive.threshold = threshold
+        assert adaptive.apply(DARK_BLACK_PROFILE) is adapted
+
+    adaptive.threshold = 80
+    moved = adaptive.apply(DARK_BLACK_PROFILE)
+    assert moved["black"] == ((0, 0, 0), (80, 255, 255))
+    # the hysteresis is around the newly applied threshold
+    adaptive.threshold = 78
+    assert adaptive.apply(DARK_BLACK_PROFILE) is moved
+
+    # a new profile is adapted at once
+    other = DARK_BLACK_PROFILE.replace("green", ((1, 2, 3), (4, 5, 6)))
+    assert adaptive.apply(other)["black"] == ((0, 0, 0), (78, 255, 255))
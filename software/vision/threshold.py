@@ -0,0 +1,124 @@
+"""
+Adaptive lightness threshold of the black line.
+
+The black range of a profile is a fixed LAB box, so a darker or brighter field
+needs a recalibration. Here a running histogram of L is kept from a sparse grid
+of every frame, older frames are forgotten exponentially, and the upper L bound
+of black is Otsu's threshold of it; the a and b bounds stay as calibrated.
+A grid of every 8th pixel is 1/64 of the frame, the histogram is updated in place.
+"""
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .colors import ColorProfile, get_profile
+
+SUBSAMPLE_STEP = 8  # px, in both directions
+FORGETTING = 0.1  # weight of the newest frame
+THRESHOLD_LIMITS = (20, 140)  # L
+# Otsu splits any histogram, a frame without the line does not move the threshold
+MIN_SEPARATION = 0.85  # of the variance explained by the split, 0.75 for a flat histogram
+# Otsu's threshold wanders by a level or two from frame to frame,
+# the profile is rebuilt only when it moves further than this from the applied one
+APPLY_STEP = 3  # L
+
+
+def otsu(histogram: np.ndarray) -> Tuple[int, float]:
+    """The threshold (the last bin of the dark class) and how well it separates, 0 to 1"""
+    total = histogram.sum()
+    if total <= 0:
+        return 0, 0.0
+    p = histogram / total
+    levels = np.arange(len(p))
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * levels)
+    mu_total = mu[-1]
+    variance = float(p @ (levels - mu_total) ** 2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mu_total * omega - mu) ** 2 / (omega * (1 - omega))
+    between[~np.isfinite(between)] = 0
+    # the empty bins between the classes split them equally well, the middle of them is the safest
+    best = np.flatnonzero(between >= between.max() * (1 - 1e-9))
+    threshold = int(best[0] + best[-1]) // 2
+    separation = float(between[threshold] / variance) if variance > 0 else 0.0
+    return threshold, separation
+
+
+class AdaptiveThreshold:
+    def __init__(self, initial: Optional[int] = None, step: int = SUBSAMPLE_STEP,
+                 forgetting: float = FORGETTING,
+                 limits: Tuple[int, int] = THRESHOLD_LIMITS,
+                 apply_step: int = APPLY_STEP) -> None:
+        """initial - the upper L of black until the first frame, the profile's one by default"""
+        self.step = step
+        self.forgetting = forgetting
+        self.limits = limits
+        self.apply_step = apply_step
+
+        self.histogram = np.zeros(256, dtype=np.float64)
+        self._counts = np.zeros(256, dtype=np.float64)
+        self.threshold = initial if initial is not None else get_profile()["black"][1][0]
+        self.separation = 0.0
+
+        # (profile, threshold, the profile with it)
+        self._applied: Optional[Tuple[ColorProfile, int, ColorProfile]] = None
+
+    def update(self, lab: np.ndarray) -> int:
+        """Adds a LAB image to the histogram, returns the new threshold"""
+        samples = lab[::self.step, ::self.step, 0]
+        self._counts[:] = np.bincount(samples.ravel(), minlength=256)
+        self._counts /= samples.size
+
+        if self.histogram.any():
+            self.histogram *= 1 - self.forgetting
+            self.histogram += self.forgetting * self._counts
+        else:
+            self.histogram[:] = self._counts
+
+        threshold, self.separation = otsu(self.histogram)
+        if self.separation >= MIN_SEPARATION:
+            self.threshold = int(np.clip(threshold, *self.limits))
+        return self.threshold
+
+    def apply(self, profile: ColorProfile) -> ColorProfile:
+        """
+        The profile with the adapted black range,
+        the same object until the threshold moves by apply_step or the profile changes
+        """
+        if self._applied is not None and self._applied[0] is profile \
+                and abs(self._applied[1] - self.threshold) < self.apply_step:
+            return self._applied[2]
+
+        lower, upper = profile["black"]
+        adapted = profile.replace("black", (lower, (self.threshold, *upper[1:])))
+        self._applied = (profile, self.threshold, adapted)
+        return adapted
+
+
+def main():
+    import cv2 as cv
+
+    from .camera import CAPTURE_RESOLUTION
+
+    img = np.full((*CAPTURE_RESOLUTION[::-1], 3), 200, dtype=np.uint8)
+    cv.line(img, (CAPTURE_RESOLUTION[0] // 2, 0), (CAPTURE_RESOLUTION[0] // 2, img.shape[0]),
+            (30, 30, 30), 20)
+    lab = cv.cvtColor(img, cv.COLOR_BGR2LAB)
+    adaptive = AdaptiveThreshold()
+
+    def timed(fn, repeats=1000):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - start) / repeats * 1e3
+
+    full = timed(lambda: cv.calcHist([lab], [0], None, [256], [0, 256]))
+    incremental = timed(lambda: adaptive.update(lab))
+    print(f"full-frame histogram: {full:.3f} ms, incremental update: {incremental:.3f} ms")
+    print(f"threshold: {adaptive.threshold}, separation: {adaptive.separation:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,16 @@
 from __future__ import annotations
-from typing import List, Union
+from typing import TYPE_CHECKING, List, Union
 
 import cv2 as cv
-import skimage.measure
 import numpy as np
 
 from .common import draw_horizontal_line
 
-WINDOW_HEIGHT = 5
+if TYPE_CHECKING:
+    # skimage.measure takes longer to import than everything else, it is imported on first use
+    from skimage.measure._regionprops import RegionProperties
 
-RegionProperties = skimage.measure._regionprops.RegionProperties
+WINDOW_HEIGHT = 5
 
 
 def win2px(pos: float) -> int:
@@ -46,6 +47,8 @@ class Window:
 
     @property
     def regions(self) -> List[RegionProperties]:
+        import skimage.measure
+
         labels = skimage.measure.label(self.roi)
         return skimage.measure.regionprops(label_image=labels)
 